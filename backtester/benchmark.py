@@ -0,0 +1,465 @@
+import argparse
+import json
+import math
+import os
+import pandas as pd
+import platform
+import psutil
+import random
+import sqlite3 as sq
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from web import backtester
+from web import config
+from web import kernels
+from web import portfolio
+from web import positions
+from web import runner
+
+
+# Variable ranges for each grid size:
+# fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high, stop_loss_low, stop_loss_high, take_profit_low, take_profit_high
+GRID_PRESETS = {
+    'small': (7, 8, 14, 15, 5, 6, 8, 9),
+    'medium': (3, 12, 10, 20, 1, 6, 2, 9),
+    'large': (3, 19, 4, 20, 1, 10, 2, 15),
+}
+
+# Strategies combined by the portfolio stage
+PORTFOLIO_SIZE = 50
+
+# Times each stage is run, keeping the fastest, so one slow run doesn't look like a regression
+REPEATS = 3
+
+# A stage only counts as a regression against --compare if it is also this many seconds slower.  Stages that take
+# a few milliseconds change by more than any tolerance from run to run
+MIN_REGRESSION_SECONDS = 0.01
+
+# What each kind of process imports when it starts, timed by bench_startup in a new interpreter.  Pool workers
+# import the modules of the function they run, the command line runner cli.py, and the web app creates the Flask app
+STARTUP_IMPORTS = {
+    'worker': 'from web import backtester, metrics',
+    'cli': 'import cli',
+    'app': 'from web import create_app; create_app()',
+}
+
+# Heavy dependencies reported as loaded, or not, at startup
+HEAVY_MODULES = ['pandas', 'plotly', 'sqlite_utils', 'numba', 'pyarrow', 'flask']
+
+# Column layout of the raw market data csv file
+CSV_HEADER = 'timestamp,symbol,open,high,low,close,trades,volume,vwap'
+
+# Position_Details as it was stored before positions were encoded as integers, to compare storage against
+TEXT_POSITION_DETAILS = '''CREATE TABLE Position_Details
+                (Position_Details_ID INTEGER PRIMARY KEY, Strategy_Results_ID INTEGER, Direction TEXT, Open_Time TEXT,
+                Open_Price REAL, Close_Time TEXT, Close_Price REAL, PNL REAL);'''
+
+
+def generate_ohlc(no_of_bars, volatility=0.02, drift=0.0, kind='random_walk', start_price=40000.0, seed=None):
+    # Generate synthetic 4 hour candles as a list of dictionaries with the same columns as the raw market data csv
+    # kind='random_walk' follows a geometric random walk, kind='mean_reverting' is pulled back towards start_price
+    # Prices are rounded to the exchange's 0.5 increment
+
+    rng = random.Random(seed)
+    start_dt = datetime.strptime(backtester.START_DATETIME, '%Y-%m-%d %H:%M:%S')
+    # 20 time periods * 4 hours = 80 hours are needed before the start datetime to calculate MA20
+    start_dt = start_dt - timedelta(hours=80)
+
+    candles = []
+    close = start_price
+    for x in range(no_of_bars):
+        open_price = close
+        if kind == 'mean_reverting':
+            ret = drift + 0.1 * math.log(start_price / open_price) + rng.gauss(0.0, volatility)
+        else:
+            ret = drift + rng.gauss(0.0, volatility)
+        close = open_price * math.exp(ret)
+        # The candle's range extends past the open and close by a fraction of the volatility
+        high = max(open_price, close) * (1.0 + abs(rng.gauss(0.0, volatility / 2)))
+        low = min(open_price, close) * (1.0 - abs(rng.gauss(0.0, volatility / 2)))
+
+        candles.append({'timestamp': (start_dt + timedelta(hours=4*x)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                        'symbol': 'XBTUSD',
+                        'open': round(open_price * 2) / 2, 'high': round(high * 2) / 2,
+                        'low': round(low * 2) / 2, 'close': round(close * 2) / 2,
+                        'trades': rng.randint(10000, 50000), 'volume': rng.randint(10**8, 5*10**8),
+                        'vwap': round((open_price + close) / 2, 4)})
+
+    return candles
+
+
+def write_ohlc_csv(candles, raw_path):
+    # Write synthetic candles to a csv file in the raw market data format
+
+    with open(raw_path, 'w') as f:
+        f.write(CSV_HEADER + '\n')
+        for c in candles:
+            f.write(','.join(str(c[col]) for col in CSV_HEADER.split(',')) + '\n')
+
+
+def timed(func, *args, repeats=1):
+    # Return the result of func and the seconds it took to run, the fastest of repeats runs
+
+    best = None
+    for _ in range(repeats):
+        start_tm = time.perf_counter()
+        res = func(*args)
+        seconds = time.perf_counter() - start_tm
+        best = seconds if best is None else min(best, seconds)
+    return res, best
+
+
+def bench_grid(grid_name, grid, no_of_bars, worker_counts, persist, repeats=REPEATS):
+    # Time every stage of the pipeline for one grid size on the market data already in the working directory
+    # Stages without side effects, the kernels, storage and pool runs are timed best of repeats
+
+    stages = {}
+    test_name = f'bench_{grid_name}_{no_of_bars}'
+
+    instrument_period_dict, test_variable_range_id = backtester.create_db(test_name, *grid)
+    (variable_list, no_of_tests), stages['cartesian_product'] = timed(backtester.cartesian_product, *grid,
+                                                                     instrument_period_dict, test_variable_range_id,
+                                                                     repeats=repeats)
+    rec_dict, stages['data_load'] = timed(backtester.load_market_data, repeats=repeats)
+
+    # Run every test in this process so the signal scan, exit scan and persistence can be timed separately
+    for stage in ['signal_scan', 'exit_scan', 'lock_wait', 'db_write']:
+        stages[stage] = 0.0
+    for v in variable_list:
+        strategy = backtester.Test_Strategy(rec_dict, *v, persist=persist)
+        for stage, seconds in strategy.timings.items():
+            stages[stage] += seconds
+    stages['persistence'] = stages['lock_wait'] + stages['db_write']
+
+    kernel_runs, results_list = bench_kernels(variable_list, repeats)
+    storage_runs = bench_storage(results_list, [rec['timestamp'] for rec in rec_dict], repeats)
+
+    # Run the whole grid through a pool of workers, the same way views.run_tests does.  Each run is a new test
+    pool_runs = []
+    for workers in worker_counts:
+        summaries = [runner.run_grid(f'{test_name}_w{workers}_r{x}', *grid, workers=workers) for x in range(repeats)]
+        summary = min(summaries, key=lambda summary: summary['elapsed_seconds'])
+        test_variable_range_id = summary['test_variable_range_id']
+        pool_runs.append({'workers': workers, 'chunk_size': summary['chunk_size'], 
+                          'seconds': summary['elapsed_seconds'], 'tests_per_sec': summary['tests_per_sec']})
+
+    # Result queries used by the results pages
+    _, stages['retrieve_top_strats'] = timed(backtester.retrieve_top_strats, test_variable_range_id, repeats=repeats)
+    _, stages['retrieve_top_group_strats'] = timed(backtester.retrieve_top_group_strats, test_variable_range_id, 
+                                                   repeats=repeats)
+    # A portfolio of the best strategies, from their stored positions
+    _, stages['portfolio'] = timed(portfolio.simulate, portfolio.top_strategies(test_variable_range_id, PORTFOLIO_SIZE),
+                                   repeats=repeats)
+    top_strats = backtester.retrieve_top_strats(test_variable_range_id)
+    if top_strats:
+        # Draw the chart once first, so the one time import of pandas and plotly isn't timed as part of it
+        backtester.plot_chart(test_variable_range_id, top_strats[0]['strategy_results_id'])
+        _, stages['plot_chart'] = timed(backtester.plot_chart, test_variable_range_id, 
+                                         top_strats[0]['strategy_results_id'], repeats=repeats)
+
+    return {'grid': grid_name, 'bars': no_of_bars, 'no_of_tests': no_of_tests, 'stages': stages, 'pool_runs': pool_runs,
+            'kernel_runs': kernel_runs, 'storage_runs': storage_runs}
+
+
+def bench_kernels(variable_list, repeats=REPEATS):
+    # Scan the whole grid, without writing it, with Test_Strategy's own loop and every exit scan kernel available
+    # Each kernel is checked against Test_Strategy's results.  Numba's compile (or cache load) is timed separately
+    # Return the runs and Test_Strategy's results
+
+    # The caches are keyed by instrument period, which is reused by each benchmark database
+    backtester.market_data_cache.clear()
+    backtester.market_arrays_cache.clear()
+
+    runs = []
+    expected = None
+    for kernel in ['off', 'python'] + (['numba'] if kernels.HAS_NUMBA else []):
+        _, warm_up = timed(backtester.compute_chunk, (None, 0, variable_list[:1]), kernel)
+        (timings_list, results_list), seconds = timed(backtester.compute_chunk, (None, 0, variable_list), kernel,
+                                                      repeats=repeats)
+        expected = expected or results_list
+        runs.append({'kernel': kernel, 'seconds': seconds, 'tests_per_sec': len(variable_list) / seconds,
+                     'compile_seconds': warm_up if kernel == 'numba' else 0.0, 'identical': results_list == expected})
+
+    return runs, expected
+
+
+def bench_storage(results_list, timestamps, repeats=REPEATS):
+    # Write the positions of a grid to a scratch database with the compact Position_Details encoding
+    # and with the text encoding it replaced, and compare their size and write throughput
+    # Each encoding is written to a new database repeats times, keeping the fastest
+
+    runs = []
+    no_of_positions = sum(len(results[5]) for results in results_list)
+    for encoding in ['compact', 'text']:
+        best = None
+        for _ in range(repeats):
+            seconds, table_bytes = write_positions(encoding, results_list, timestamps)
+            best = seconds if best is None else min(best, seconds)
+
+        runs.append({'encoding': encoding, 'positions': no_of_positions, 'seconds': best, 
+                     'positions_per_sec': no_of_positions / best if best else 0.0, 'bytes': table_bytes})
+
+    return runs
+
+
+def write_positions(encoding, results_list, timestamps):
+    # Write the positions of a grid to a new scratch database with one encoding
+    # Return the seconds the writes took and the bytes the table takes
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, 'storage.db')
+        conn = sq.connect(db_path)
+        cur = conn.cursor()
+        if encoding == 'compact':
+            backtester.create_test_tables(cur)
+            query = '''INSERT INTO Position_Details (Strategy_Results_ID, Direction, Open_Bar, Open_Price, 
+                            Close_Bar, Close_Price, PNL) VALUES (?, ?, ?, ?, ?, ?, ?);'''
+            rows = [results[5] for results in results_list]
+        else:
+            cur.execute(TEXT_POSITION_DETAILS)
+            query = '''INSERT INTO Position_Details (Strategy_Results_ID, Direction, Open_Time, Open_Price, 
+                            Close_Time, Close_Price, PNL) VALUES (?, ?, ?, ?, ?, ?, ?);'''
+            rows = [[positions.decode(p, timestamps) for p in results[5]] for results in results_list]
+        conn.commit()
+        empty_bytes = os.path.getsize(db_path)
+
+        start_tm = time.perf_counter()
+        for strategy_results_id, trades in enumerate(rows, 1):
+            cur.executemany(query, [(strategy_results_id,) + p for p in trades])
+        conn.commit()
+        seconds = time.perf_counter() - start_tm
+        cur.execute('VACUUM')
+        conn.close()
+        table_bytes = os.path.getsize(db_path) - empty_bytes
+
+    return seconds, table_bytes
+
+
+def bench_startup(repeats=REPEATS):
+    # Time the imports of each kind of process in a new interpreter, best of repeats, with its memory once started
+    # and the heavy dependencies it loaded
+
+    runs = []
+    for process_kind, imports in STARTUP_IMPORTS.items():
+        code = (f'import time\nstart_tm = time.perf_counter()\n{imports}\nseconds = time.perf_counter() - start_tm\n'
+                f'import json, psutil, sys\n'
+                f'print(json.dumps({{"seconds": seconds, "rss_bytes": psutil.Process().memory_info().rss, '
+                f'"loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))')
+        samples = []
+        for _ in range(repeats):
+            res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+            samples.append(json.loads(res.stdout.strip().splitlines()[-1]))
+        best = min(samples, key=lambda sample: sample['seconds'])
+        runs.append(dict(best, process=process_kind))
+
+    return runs
+
+
+def create_new_db(test_name, *grid):
+    # Remove the database and create a test, so create_db builds the database and loads the market data each time
+
+    for path in [config.settings.db_path, config.settings.db_path + '-wal', config.settings.db_path + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+    return backtester.create_db(test_name, *grid)
+
+
+def bench_bars(no_of_bars, args, worker_counts):
+    # Point the data, database and cache locations at a temporary folder with a synthetic csv of no_of_bars candles
+    # and benchmark every grid on it.  Environment variables are used so spawned pool workers see the same settings
+
+    results = []
+    bench_env = ['BACKTESTER_DATA_DIR', 'BACKTESTER_RAW_FILE', 'BACKTESTER_DB_PATH', 'BACKTESTER_CACHE_DIR']
+    orig_env = {env_var: os.environ.get(env_var) for env_var in bench_env}
+    orig_end = backtester.END_DATETIME
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            os.environ['BACKTESTER_DATA_DIR'] = work_dir
+            os.environ['BACKTESTER_RAW_FILE'] = 'xbtusd_4h_raw.csv'
+            os.environ['BACKTESTER_DB_PATH'] = os.path.join(work_dir, 'backtester_database.db')
+            os.environ['BACKTESTER_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+            config.reload()
+
+            candles = generate_ohlc(no_of_bars, args.volatility, args.drift, args.kind, seed=args.seed)
+            write_ohlc_csv(candles, config.settings.raw_path)
+            # Test over every synthetic candle
+            backtester.END_DATETIME = candles[-1]['timestamp'].replace('T', ' ')[:19]
+
+            ingest = {}
+            _, ingest['data_import_check'] = timed(backtester.data_import_check, repeats=args.repeats)
+            df = pd.read_csv(config.settings.raw_path)
+            _, ingest['indicator_build'] = timed(backtester.add_moving_averages, df, repeats=args.repeats)
+            # The first create_db builds the database and loads the market data
+            _, ingest['create_db'] = timed(create_new_db, 'bench_ingest', *GRID_PRESETS['small'], repeats=args.repeats)
+
+            for grid_name in args.grids:
+                res = bench_grid(grid_name, GRID_PRESETS[grid_name], no_of_bars, worker_counts, not args.no_persist,
+                                 args.repeats)
+                res['stages'].update(ingest)
+                results.append(res)
+                print_result(res)
+
+        finally:
+            backtester.END_DATETIME = orig_end
+            for env_var, val in orig_env.items():
+                if val is None:
+                    os.environ.pop(env_var, None)
+                else:
+                    os.environ[env_var] = val
+            config.reload()
+
+    return results
+
+
+def print_result(res):
+    # Print a readable summary of one benchmark result
+
+    print(f"\n{res['grid']} grid, {res['bars']:,d} bars, {res['no_of_tests']:,d} tests")
+    for stage, seconds in res['stages'].items():
+        print(f'  {stage:<28}{seconds:>10.4f} s')
+    for run in res['pool_runs']:
+        print(f"  {run['workers']:>3} workers {run['seconds']:>21.4f} s  {run['tests_per_sec']:>10.1f} tests/sec")
+    for run in res['kernel_runs']:
+        print(f"  {run['kernel'] + ' kernel':<28}{run['seconds']:>10.4f} s  {run['tests_per_sec']:>10.1f} tests/sec"
+              f"{'' if run['identical'] else '  RESULTS DIFFER'}")
+    for run in res.get('storage_runs', []):
+        print(f"  {run['encoding'] + ' positions':<28}{run['seconds']:>10.4f} s  {run['positions_per_sec']:>10.1f} rows/sec"
+              f"  {run['bytes'] / max(run['positions'], 1):>6.1f} bytes/row")
+
+
+def print_startup(runs):
+    # Print a readable summary of the startup benchmark
+
+    print('\nstartup')
+    for run in runs:
+        print(f"  {run['process'] + ' imports':<28}{run['seconds']:>10.4f} s  {run['rss_bytes'] / 2**20:>8.1f} MB"
+              f"  {', '.join(run['loaded']) or 'no heavy modules'}")
+
+
+def git_revision():
+    # Identify the version of the code that was benchmarked
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare_results(results, baseline_path, tolerance, min_seconds=MIN_REGRESSION_SECONDS):
+    # Compare stage timings against a previous benchmark file
+    # Return a list of the stages that are slower than the baseline by more than tolerance and by more than
+    # min_seconds
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    base_idx = {(r['grid'], r['bars']): r for r in baseline['results']}
+    regressions = []
+    for res in results:
+        base = base_idx.get((res['grid'], res['bars']))
+        if not base:
+            continue
+        timings = dict(res['stages'])
+        base_timings = dict(base['stages'])
+        for run in res['pool_runs']:
+            timings[f"pool_{run['workers']}_workers"] = run['seconds']
+        for run in base['pool_runs']:
+            base_timings[f"pool_{run['workers']}_workers"] = run['seconds']
+        for run in res.get('kernel_runs', []):
+            timings[f"kernel_{run['kernel']}"] = run['seconds']
+        for run in base.get('kernel_runs', []):
+            base_timings[f"kernel_{run['kernel']}"] = run['seconds']
+        for run in res.get('storage_runs', []):
+            timings[f"storage_{run['encoding']}"] = run['seconds']
+        for run in base.get('storage_runs', []):
+            base_timings[f"storage_{run['encoding']}"] = run['seconds']
+
+        for stage, seconds in timings.items():
+            base_seconds = base_timings.get(stage)
+            if base_seconds and seconds > base_seconds * (1.0 + tolerance) and seconds - base_seconds > min_seconds:
+                regressions.append({'grid': res['grid'], 'bars': res['bars'], 'stage': stage,
+                                    'seconds': seconds, 'baseline_seconds': base_seconds})
+
+    return regressions
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the backtest pipeline on synthetic market data')
+    parser.add_argument('--bars', default='553', help='comma separated numbers of candles to generate')
+    parser.add_argument('--grids', default='small,medium', help='comma separated grid sizes: ' + ', '.join(GRID_PRESETS))
+    parser.add_argument('--workers', default=None, help='comma separated pool sizes (default: 1 and all physical cores)')
+    parser.add_argument('--volatility', type=float, default=0.02, help='standard deviation of each candle\'s return')
+    parser.add_argument('--drift', type=float, default=0.0, help='mean return of each candle')
+    parser.add_argument('--kind', choices=['random_walk', 'mean_reverting'], default='random_walk')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-persist', action='store_true', help='skip database writes in the timed scan')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to write the results to')
+    parser.add_argument('--compare', help='previous results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against --compare, 0.2 = 20%%')
+    parser.add_argument('--min-seconds', type=float, default=MIN_REGRESSION_SECONDS, 
+                        help='slowdown in seconds a stage must also exceed to count as a regression')
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='times each stage is run, keeping the fastest')
+    args = parser.parse_args(argv)
+
+    args.bars = [int(x) for x in args.bars.split(',')]
+    args.grids = args.grids.split(',')
+    for grid_name in args.grids:
+        if grid_name not in GRID_PRESETS:
+            parser.error(f'unknown grid {grid_name}')
+    # Rolling averages need 20 candles before the start datetime, plus a few candles to trade on
+    for no_of_bars in args.bars:
+        if no_of_bars < 30:
+            parser.error('--bars must be at least 30')
+    if args.repeats < 1:
+        parser.error('--repeats must be at least 1')
+
+    return args
+
+
+def main(argv=None):
+    # Run the benchmark and write machine readable results
+
+    args = parse_args(argv)
+    if args.workers:
+        worker_counts = [int(x) for x in args.workers.split(',')]
+    else:
+        worker_counts = sorted({1, config.settings.workers})
+
+    startup_runs = bench_startup(args.repeats)
+    print_startup(startup_runs)
+
+    results = []
+    for no_of_bars in args.bars:
+        results += bench_bars(no_of_bars, args, worker_counts)
+
+    output = {'datetime': datetime.now().replace(microsecond=0).isoformat(),
+              'revision': git_revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'physical_cores': psutil.cpu_count(logical=False),
+              'volatility': args.volatility, 'drift': args.drift, 'kind': args.kind, 'seed': args.seed,
+              'startup': startup_runs, 'results': results}
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'\nResults written to {args.output}')
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.tolerance, args.min_seconds)
+        for reg in regressions:
+            print(f"Regression: {reg['grid']} grid, {reg['bars']} bars, {reg['stage']} took {reg['seconds']:.4f} s "
+                  f"against {reg['baseline_seconds']:.4f} s")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+import argparse
+import json
+import os
+import secrets
+import sys
+from datetime import datetime
+from web import backtester
+from web import cluster
+from web import config
+from web import export
+from web import live
+from web import portfolio
+from web import pruning
+from web import robustness
+from web import runner
+
+
+# Moving averages in the Market_Data table
+MA_MIN, MA_MAX = 3, 20
+
+
+def parse_range(text):
+    # Parse 'low-high' or a single value into a (low, high) tuple of ints
+
+    parts = text.split('-')
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2:
+        raise argparse.ArgumentTypeError(f'{text} is not a range, use low-high e.g. 7-8')
+    try:
+        low, high = int(parts[0]), int(parts[1])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text} is not a range of whole numbers')
+    if low > high:
+        raise argparse.ArgumentTypeError(f'{text}: low is higher than high')
+    return low, high
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Run a grid of backtests without the web app')
+    parser.add_argument('--test-name', help='unique name of the test (default: cli_<datetime>)')
+    parser.add_argument('--instrument', default='XBTUSD', help='instrument to test, read from <instrument>_<time frame>_raw.csv')
+    parser.add_argument('--time-frame', default='4h', help='time frame of the raw market data file')
+    parser.add_argument('--raw-file', help='raw market data csv, overrides --instrument and --time-frame')
+    parser.add_argument('--fast-ma', type=parse_range, default=(7, 8), help='fast moving average range, e.g. 3-12')
+    parser.add_argument('--slow-ma', type=parse_range, default=(14, 15), help='slow moving average range, e.g. 10-20')
+    parser.add_argument('--stop-loss', type=parse_range, default=(5, 6), help='stop loss range in percent, e.g. 1-6')
+    parser.add_argument('--take-profit', type=parse_range, default=(8, 9), help='take profit range in percent, e.g. 2-9')
+    parser.add_argument('--workers', type=int, help='number of pool workers (default: workers setting)')
+    parser.add_argument('--engine', choices=runner.ENGINES, default='pool', help='how to run the tests')
+    parser.add_argument('--chunk-size', type=int, help='tests written per transaction (default: up to 64)')
+    parser.add_argument('--prune-drawdown', type=float, metavar='PCT',
+                        help='stop a combination once its PnL falls this many percent below its peak')
+    parser.add_argument('--prune-min-pnl', type=float, metavar='PCT',
+                        help='stop a combination whose PnL is below this many percent after --prune-after candles')
+    parser.add_argument('--prune-after', type=int, default=pruning.CHECKPOINT_BARS, metavar='BARS',
+                        help='candles a combination runs before --prune-min-pnl applies')
+    parser.add_argument('--resume', metavar='TEST_NAME', 
+                        help='run the unfinished chunks of an interrupted test, ignoring the range options')
+    parser.add_argument('--delete', metavar='TEST_NAME', help='delete a test and its results, freeing their space')
+    parser.add_argument('--archive', metavar='TEST_NAME', 
+                        help='move the database file of a test to the archive folder and delete the test')
+    parser.add_argument('--export', metavar='TEST_NAME', help='write every result of a test to a file')
+    parser.add_argument('--export-format', choices=export.FORMATS, default='csv', help='file format of --export')
+    parser.add_argument('--export-positions', action='store_true', help='also export every position of the test')
+    parser.add_argument('--export-dir', default='.', help='folder to write --export files to')
+    parser.add_argument('--update', action='store_true',
+                        help='append the new candles of the raw market data file and update every finished test of '
+                             'its instrument over them')
+    parser.add_argument('--robustness', metavar='TEST_NAME', 
+                        help='resample the trades of the best strategies of a test for confidence intervals')
+    parser.add_argument('--top-n', type=int, 
+                        help=f'best strategies of a test taken by --robustness (default: {robustness.TOP_N}) and '
+                             f'--portfolio (default: {portfolio.TOP_N})')
+    parser.add_argument('--resamples', type=int, default=robustness.RESAMPLES, 
+                        help='bootstrap and shuffle resamples of each strategy')
+    parser.add_argument('--portfolio', nargs='+', metavar='TEST_NAME[:IDS]',
+                        help='combine stored strategies into a portfolio without running them again: the best '
+                             '--top-n of a test, or TEST_NAME:ID,ID,... for chosen strategies')
+    parser.add_argument('--allocation', choices=portfolio.ALLOCATIONS, default='equal', 
+                        help='how --portfolio splits the capital between its strategies')
+    parser.add_argument('--weights', help='comma separated shares of the capital, one per strategy, instead of --allocation')
+    parser.add_argument('--capital', type=float, default=portfolio.CAPITAL, help='capital the portfolio starts with')
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        help='address the cluster engine serves chunks on (default: cluster_address setting)')
+    parser.add_argument('--worker', metavar='HOST:PORT',
+                        help='run chunks for the cluster coordinator at HOST:PORT instead of running a test')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes to start with --worker')
+    parser.add_argument('--profile', action='store_true', help='save a cProfile file of the run in the cache folder')
+    parser.add_argument('--format', choices=['text', 'json'], default='text',
+                        help='text, or one JSON object per line for the progress and the summary')
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='seconds between progress lines')
+    parser.add_argument('--output', help='also write the summary to this JSON file')
+    args = parser.parse_args(argv)
+
+    for name in ['fast_ma', 'slow_ma']:
+        low, high = getattr(args, name)
+        if low < MA_MIN or high > MA_MAX:
+            parser.error(f'--{name.replace("_", "-")} must be within {MA_MIN}-{MA_MAX}')
+    for name in ['stop_loss', 'take_profit']:
+        if getattr(args, name)[0] < 1:
+            parser.error(f'--{name.replace("_", "-")} must be at least 1 percent')
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1')
+    if (args.top_n is not None and args.top_n < 1) or args.resamples < 1:
+        parser.error('--top-n and --resamples must be at least 1')
+    if args.prune_drawdown is not None and args.prune_drawdown <= 0:
+        parser.error('--prune-drawdown must be more than 0 percent')
+    if args.prune_after < 0:
+        parser.error('--prune-after must be at least 0')
+    if args.capital <= 0:
+        parser.error('--capital must be more than 0')
+    if args.weights:
+        try:
+            args.weights = [float(x) for x in args.weights.split(',')]
+        except ValueError:
+            parser.error('--weights must be comma separated numbers')
+    if args.processes < 1:
+        parser.error('--processes must be at least 1')
+    if args.export and args.export_format == 'parquet' and not export.HAS_PYARROW:
+        parser.error('--export-format parquet needs pyarrow, pip install pyarrow')
+    if args.worker and not config.settings.cluster_authkey:
+        parser.error('--worker needs the coordinator\'s authkey in BACKTESTER_CLUSTER_AUTHKEY')
+
+    # Percents to fractions, like Total_PNL
+    args.prune = pruning.make_rules(None if args.prune_drawdown is None else args.prune_drawdown / 100,
+                                    None if args.prune_min_pnl is None else args.prune_min_pnl / 100, args.prune_after)
+    args.test_name = args.test_name or f'cli_{datetime.now():%Y%m%d_%H%M%S}'
+    args.raw_path = os.path.join(config.settings.data_dir,
+        args.raw_file or f'{args.instrument.lower()}_{args.time_frame.lower()}_raw.csv')
+    return args
+
+
+def emit(args, event, stats):
+    # Write a progress or summary line to stdout
+
+    if args.format == 'json':
+        print(json.dumps(dict(stats, event=event)), flush=True)
+    elif event == 'progress':
+        workers = f", {stats['workers']} workers" if 'workers' in stats else ''
+        print(f"{stats['tests_completed']:,d}/{stats['no_of_tests']:,d} tests, "
+              f"{stats['tests_per_sec']:,.1f} tests/sec, {stats['elapsed_seconds']:,.0f} s{workers}", flush=True)
+    elif event == 'summary':
+        stats = {k: v for k, v in stats.items() if k != 'profile_summary'}
+        print(json.dumps(stats, indent=2), flush=True)
+    else:
+        print(stats['message'], file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    # Run the tests and exit with 0 if every test completed, or 1 if the run failed or any test failed
+
+    args = parse_args(argv)
+
+    if args.worker:
+        exitcodes = cluster.run_workers(args.worker, config.settings.cluster_authkey, args.processes)
+        return 0 if not any(exitcodes) else 1
+
+    # Workers must be given the coordinator's authkey.  Make one up if none is configured
+    if args.engine == 'cluster':
+        args.listen = args.listen or config.settings.cluster_address
+        args.authkey = config.settings.cluster_authkey or secrets.token_hex(16)
+        emit(args, 'listen', {'message': f'Serving chunks on {args.listen}.  Start workers with '
+                                         f'BACKTESTER_CLUSTER_AUTHKEY={args.authkey} python cli.py --worker <host>:'
+                                         f'{cluster.parse_address(args.listen)[1]}'})
+    else:
+        args.authkey = None
+
+    if args.resume:
+        return resume(args)
+    if args.delete or args.archive:
+        return remove(args)
+    if args.export:
+        return export_test(args)
+    if args.update:
+        return update(args)
+    if args.robustness:
+        return robustness_study(args)
+    if args.portfolio:
+        return portfolio_study(args)
+
+    # Check the csv the first time its instrument is tested, the same way views.run_tests does
+    if not backtester.instrument_imported(args.raw_path):
+        data_import_check = backtester.data_import_check(args.raw_path)
+        if data_import_check[0] == 'Data Import Error':
+            emit(args, 'error', {'message': ' '.join(data_import_check[1])})
+            return 1
+
+    if backtester.test_name_exists(args.test_name):
+        emit(args, 'error', {'message': f'{args.test_name} is already in use.  Please enter a unique test name.'})
+        return 1
+
+    summary = runner.run_grid(args.test_name, *args.fast_ma, *args.slow_ma, *args.stop_loss, *args.take_profit,
+        workers=args.workers, engine=args.engine, profile=args.profile, raw_path=args.raw_path,
+        progress=lambda stats: emit(args, 'progress', stats), progress_interval=args.progress_interval,
+        chunk_size=args.chunk_size, address=args.listen, authkey=args.authkey, prune=args.prune)
+
+    return finish(args, summary)
+
+
+def resume(args):
+    # Run the chunks of an interrupted test that aren't in the database yet
+
+    test_run = backtester.get_test_run(args.resume)[0]
+    if test_run is None:
+        emit(args, 'error', {'message': f'There is no test named {args.resume}.'})
+        return 1
+    if test_run['status'] != 'running':
+        emit(args, 'error', {'message': f'{args.resume} has no unfinished chunks to resume.'})
+        return 1
+
+    summary = runner.resume_run(args.resume, workers=args.workers, engine=args.engine, profile=args.profile,
+        progress=lambda stats: emit(args, 'progress', stats), progress_interval=args.progress_interval,
+        address=args.listen, authkey=args.authkey)
+
+    return finish(args, summary)
+
+
+def remove(args):
+    # Delete or archive a saved test
+
+    test_name = args.archive or args.delete
+    test_run = backtester.get_test_run(test_name)[0]
+    if test_run is None:
+        emit(args, 'error', {'message': f'There is no test named {test_name}.'})
+        return 1
+
+    if args.archive:
+        archive_path = backtester.archive_test(test_run['test_variable_range_id'])
+        if not archive_path:
+            emit(args, 'error', {'message': 'The test could not be archived, see the exception log for details.'})
+            return 1
+        emit(args, 'summary', {'test_name': test_name, 'archive_path': archive_path})
+    else:
+        if not backtester.delete_test(test_run['test_variable_range_id']):
+            emit(args, 'error', {'message': 'The test could not be deleted, see the exception log for details.'})
+            return 1
+        emit(args, 'summary', {'test_name': test_name, 'deleted': True})
+
+    return 0
+
+
+def export_test(args):
+    # Write the results, and optionally the positions, of a saved test to files
+
+    test_run = backtester.get_test_run(args.export)[0]
+    if test_run is None:
+        emit(args, 'error', {'message': f'There is no test named {args.export}.'})
+        return 1
+
+    tables = export.TABLES if args.export_positions else ['strategy_results']
+    written = export.export_test(test_run['test_variable_range_id'], args.export, args.export_format, tables, 
+        args.export_dir)
+    if not written:
+        emit(args, 'error', {'message': 'The test could not be exported, see the exception log for details.'})
+        return 1
+
+    emit(args, 'summary', {'test_name': args.export, 'status': test_run['status'] or 'complete',
+                           'files': {table: {'path': path, 'bytes': size} for table, (path, size) in written.items()}})
+    return 0
+
+
+def update(args):
+    # Append new candles to the market data and carry on the saved tests of the instrument over them
+
+    summary, error = live.update_instrument(args.raw_path)
+    if error:
+        emit(args, 'error', {'message': error})
+        return 1
+
+    emit(args, 'summary', summary)
+    return 0
+
+
+def robustness_study(args):
+    # Resample the trades of a saved test's best strategies and report the most robust
+
+    test_run = backtester.get_test_run(args.robustness)[0]
+    if test_run is None:
+        emit(args, 'error', {'message': f'There is no test named {args.robustness}.'})
+        return 1
+
+    try:
+        summary = robustness.run_study(test_run['test_variable_range_id'], args.top_n or robustness.TOP_N, 
+            args.resamples, workers=args.workers)
+    except ValueError as e:
+        emit(args, 'error', {'message': str(e)})
+        return 1
+    if not summary:
+        emit(args, 'error', {'message': 'The study failed, see the exception log for details.'})
+        return 1
+
+    summary = dict(summary, test_name=args.robustness, 
+                   most_robust=robustness.load_study(test_run['test_variable_range_id'])[:10])
+    emit(args, 'summary', summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+def portfolio_study(args):
+    # Combine stored strategies of one or more tests into a portfolio and report its equity, drawdown and correlation
+    # The curves are only written to --output
+
+    strategy_ids = []
+    for spec in args.portfolio:
+        test_name, _, ids = spec.partition(':')
+        test_run = backtester.get_test_run(test_name)[0]
+        if test_run is None:
+            emit(args, 'error', {'message': f'There is no test named {test_name}.'})
+            return 1
+        test_variable_range_id = test_run['test_variable_range_id']
+        if ids:
+            try:
+                strategy_ids += [(test_variable_range_id, int(x)) for x in ids.split(',')]
+            except ValueError:
+                emit(args, 'error', {'message': f'{spec} must be TEST_NAME:ID,ID,...'})
+                return 1
+        else:
+            strategy_ids += portfolio.top_strategies(test_variable_range_id, args.top_n or portfolio.TOP_N)
+
+    try:
+        summary = portfolio.simulate(strategy_ids, args.allocation, args.weights, args.capital)
+    except ValueError as e:
+        emit(args, 'error', {'message': str(e)})
+        return 1
+    if not summary:
+        emit(args, 'error', {'message': 'The portfolio failed, see the exception log for details.'})
+        return 1
+
+    emit(args, 'summary', {k: v for k, v in summary.items() if k not in ['timestamps', 'equity', 'drawdown']})
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+def finish(args, summary):
+    # Report the summary and return the exit code
+
+    if not summary:
+        emit(args, 'error', {'message': 'The run failed, see the exception log for details.'})
+        return 1
+
+    emit(args, 'summary', summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({k: v for k, v in summary.items() if k != 'profile_summary'}, f, indent=2)
+
+    return 0 if summary['tests_failed'] == 0 and summary['status'] == 'complete' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
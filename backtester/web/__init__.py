@@ -1,20 +1,26 @@
 import os
 import secrets
 import sys
-from flask import Flask
 from . import backtester
+from . import exception_log
 
 
 def create_app():
     # Run backtester
 
     try:
+        # Flask is only imported by the app, not by pool workers and the command line runner, which import this package
+        from flask import Flask
+
         app = Flask(__name__)
         
         # Generate a secure, random string for every launch
         secret_key = secrets.token_hex(24)
         app.config['SECRET_KEY'] = secret_key
 
+        # Exceptions from the app and every pool worker are written by one listener in this process
+        exception_log.start_listener()
+
         from .views import views
 
         app.register_blueprint(views, url_prefix='/')
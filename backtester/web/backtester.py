@@ -1,34 +1,40 @@
 import itertools
 import os
-import pandas as pd
-import plotly.graph_objects as go
-import plotly.io as pio
+import shutil
 import sys
 import sqlite3 as sq
-from sqlite_utils import Database
+import time
+from . import config
+from . import exception_log
+from . import kernels
+from . import positions
+from . import pruning
+from . import surface
 from datetime import datetime, timedelta
 from operator import itemgetter
 
+# pandas, plotly and sqlite_utils are imported on first use by the functions that read csv files, create databases
+# or draw charts.  Pool workers only run tests, so they start without loading them
+
+# Market data window used for testing
+START_DATETIME = '2021-06-01 00:00:00'
+END_DATETIME = '2021-09-01 00:00:00'
+
+# Tables kept in the database file of each test, rather than the main database
+TEST_TABLES = ['Strategy_Results', 'Position_Details', 'Test_Leaderboard', 'Test_Surface', 'Test_Chunk', 'Test_Bars', 
+               'Strategy_Robustness']
+
 
 def log_exceptions(f_path, f_name, exc, desc, line_no):
-    # Print and log all exceptions to a file
+    # Queue a structured record of the exception for the log listener, which writes it as a JSON line
+    # Every pool worker writes to the same queue, so logging can't slow down the tests or interleave lines
     
     try:
-        exc_info = [f' ~ An exception has occurred. ~', 
-                        f'Datetime: \t {datetime.now().replace(microsecond=0)}', 
-                        f'File Path: \t {f_path}', 
-                        f'File Name: \t {f_name}',
-                        f'Exception: \t {exc}', 
-                        f'Description: \t {desc}', 
-                        f'Line Number: \t {line_no} \n']
-
-        for item in exc_info:
-            print(item)
-        
-        log_path = os.getcwd() + '\\web\\database\\backtester_exceptions.log'
-        with open(log_path, "a") as f:
-            for line in exc_info:
-                f.write(line + '\n')
+        exception_log.log({'file_path': f_path, 
+                            'file_name': f_name, 
+                            'exception': getattr(exc, '__name__', str(exc)), 
+                            'description': str(desc), 
+                            'line_number': line_no})
     
     except BaseException:
         exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -42,16 +48,17 @@ def log_exceptions(f_path, f_name, exc, desc, line_no):
         print('Line Number: \t', exc_tb.tb_lineno)
 
 
-def data_import_check():
+def data_import_check(raw_path=None):
     # Notify web user if there is missing data in csv file or database file is in use
     # Don't proceed until the problems are fixed 
+    # raw_path defaults to the configured market data file
 
     try:
+        import pandas as pd
         data_error = 0
 
-        dir_name = os.getcwd()
-        f_name = 'xbtusd_4h_raw.csv'
-        raw_path = dir_name + '\\web\\database\\' + f_name
+        raw_path = raw_path or config.settings.raw_path
+        dir_name, f_name = os.path.split(raw_path)
 
         # Retrieve the market data from csv
         if os.path.exists(raw_path):
@@ -65,11 +72,11 @@ def data_import_check():
         df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
         df['timestamp'] = df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
         # Start search 80 hours before start datetime because we need 20 previous periods to calculate MA20
-        start_dt = datetime.strptime('2021-06-01 00:00:00', '%Y-%m-%d %H:%M:%S')
+        start_dt = datetime.strptime(START_DATETIME, '%Y-%m-%d %H:%M:%S')
         # 20 time periods * 4 hours = 80 hours
         start_dt = start_dt - timedelta(hours=80)
         start_dt = start_dt.strftime('%Y-%m-%d %H:%M:%S')
-        df2 = df[(df.timestamp >= start_dt) & (df.timestamp <= '2021-09-01 00:00:00')] 
+        df2 = df[(df.timestamp >= start_dt) & (df.timestamp <= END_DATETIME)] 
 
          # Get the time delta between the datetimes
         df3 = df2.copy()
@@ -90,7 +97,7 @@ def data_import_check():
         # Data is missing or doesn't conform to the datetime interval of the file.
         if len(inc_datetime) > 0:
             for rec in inc_datetime:
-                log_exceptions(dir_name + '\\web\\database\\', 'xbtusd_4h_raw.csv', 'Incomplete Raw Data', \
+                log_exceptions(dir_name, f_name, 'Incomplete Raw Data', \
                     'Data is missing or doesn\'t conform to the datetime interval of the file.', rec)
             # Flash message to web user to ask user to correct the data.  Don't proceed until data is correct.
             dt_err = ', '.join(map(str, inc_datetime)) 
@@ -115,7 +122,7 @@ def data_import_check():
          # Data is missing or isn't numeric
         if len(all_nan_datetime) > 0:
             for rec in all_nan_datetime:
-                log_exceptions(dir_name + '\\web\\database\\', 'xbtusd_4h_raw.csv', 'Incomplete Raw Data', \
+                log_exceptions(dir_name, f_name, 'Incomplete Raw Data', \
                     'Price data in open, high, low, or close columns is not numeric', rec)
             # Flash message to web user to ask user to correct the data.  Don't proceed until data is correct.
             pr_err = ', '.join(map(str, all_nan_datetime))
@@ -131,14 +138,70 @@ def data_import_check():
     return 'Data Imported', ''
 
 
-def db_connect():
+def add_moving_averages(df):
+    # Add a column for every moving average that can be tested, MA3 to MA20
+
+    try:
+        for x in range(3, 21):
+            col_name = 'ma' + str(x)
+            df[col_name] = round(df['close'].rolling(x).mean(), 2)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return df
+
+
+def db_connect(test_variable_range_id=None):
     # Connect to the database
+    # With a test, attach its database file as 'test'.  The results tables are only in the test's file, 
+    # so queries find them there without naming it, and never touch other tests' rows
+    # Return None for a test without a database file.  Only writers create it, with test_db_connect, so reading
+    # a deleted or unknown test doesn't leave an empty file behind
    
     try:
-        db_path = os.getcwd() + '\\web\\database\\backtester_database.db'
+        db_path = config.settings.db_path
         
+        conn = None 
+        if test_variable_range_id is not None and not os.path.exists(test_db_path(test_variable_range_id)):
+            return conn
+        conn = sq.connect(db_path, timeout=30.0)
+        if test_variable_range_id is not None:
+            conn.execute('ATTACH DATABASE ? AS test', (test_db_path(test_variable_range_id),))
+        
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return conn
+
+
+def test_db_path(test_variable_range_id):
+    # Database file of a test's results
+
+    return os.path.join(config.settings.tests_dir, f'test_{int(test_variable_range_id)}.db')
+
+
+def test_db_connect(test_variable_range_id):
+    # Connect to the database file of a test on its own, creating it the first time
+    # Writers use this, so their transactions only lock the test's own file
+   
+    try:
+        db_path = test_db_path(test_variable_range_id)
+        new_db = not os.path.exists(db_path)
+        if new_db:
+            config.ensure_dirs()
+
         conn = None 
         conn = sq.connect(db_path, timeout=30.0)
+        if new_db:
+            from sqlite_utils import Database
+            Database(conn).enable_wal()
+            create_test_tables(conn.cursor())
+            conn.commit()
         
     except BaseException:
         exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -148,186 +211,820 @@ def db_connect():
     return conn
 
 
+def create_tables(cur):
+    # Create any of the tables that don't exist yet
+
+    # Create Instrument_Period table
+    query = '''CREATE TABLE IF NOT EXISTS Instrument_Period 
+                    (Instrument_Period_ID INTEGER, 
+                    Instrument_Name TEXT NOT NULL, 
+                    Start_Datetime TEXT, 
+                    End_Datetime TEXT, 
+                    Time_Frame TEXT,
+                    CONSTRAINT PK_Instrument_Period_ID PRIMARY KEY (Instrument_Period_ID));'''
+    cur.execute(query)
+
+    # Create Market_Data table
+    query = '''CREATE TABLE  IF NOT EXISTS Market_Data 
+                (Market_Data_ID INTEGER,
+                Instrument_Period_ID INTEGER,
+                Timestamp TEXT, Open REAL, High REAL, Low REAL, Close REAL, MA3 REAL, MA4 REAL, MA5 REAL, 
+                MA6 REAL, MA7 REAL, MA8 REAL, MA9 REAL, MA10 REAL, MA11 REAL, MA12 REAL, MA13 REAL, 
+                MA14 REAL, MA15 REAL, MA16 REAL, MA17 REAL, MA18 REAL, MA19 REAL, MA20 REAL,
+                CONSTRAINT PK_Market_Data_ID PRIMARY KEY (Market_Data_ID), 
+                FOREIGN KEY(Instrument_Period_ID) REFERENCES Instrument_Period(Instrument_Period_ID));'''       
+    cur.execute(query)
+
+    # Create Test_Variable_Range table
+    query = '''CREATE TABLE  IF NOT EXISTS Test_Variable_Range
+                (Test_Variable_Range_ID INTEGER, 
+                Instrument_Period_ID INTEGER,
+                Test_Name TEXT NOT NULL UNIQUE,
+                Fast_MA_Low INTEGER, 
+                Fast_MA_High INTEGER, 
+                Slow_MA_Low INTEGER, 
+                Slow_MA_High INTEGER, 
+                Stop_Loss_Low REAL,
+                Stop_Loss_High REAL,
+                Take_Profit_Low REAL,
+                Take_Profit_High REAL,
+                CONSTRAINT Test_Variable_Range_ID PRIMARY KEY (Test_Variable_Range_ID), 
+                FOREIGN KEY(Instrument_Period_ID) REFERENCES Instrument_Period(Instrument_Period_ID));'''
+    cur.execute(query)          
+
+    # Create Test_Run table.  Status is 'running' until every chunk of the test is written, then 'complete'
+    query = '''CREATE TABLE  IF NOT EXISTS Test_Run
+                (Test_Variable_Range_ID INTEGER,
+                No_Of_Tests INTEGER,
+                Chunk_Size INTEGER,
+                No_Of_Chunks INTEGER,
+                Status TEXT,
+                Start_Datetime TEXT,
+                End_Datetime TEXT,
+                Prune_Max_Drawdown REAL,
+                Prune_Min_PNL REAL,
+                Prune_Checkpoint_Bars INTEGER,
+                CONSTRAINT PK_Test_Run PRIMARY KEY (Test_Variable_Range_ID), 
+                FOREIGN KEY(Test_Variable_Range_ID) REFERENCES Test_Variable_Range(Test_Variable_Range_ID));'''
+    cur.execute(query)
+    # The pruning rules of the run, see pruning.py.  NULL when the test isn't pruned
+    add_columns(cur, 'Test_Run', ['Prune_Max_Drawdown REAL', 'Prune_Min_PNL REAL', 'Prune_Checkpoint_Bars INTEGER'])
+
+    # Move results saved in this database before each test had its own file
+    migrate_test_tables(cur)
+
+
+def add_columns(cur, table, columns):
+    # Add any of the columns, given as '<name> <type>', that a table made by an older version doesn't have
+
+    cur.execute(f'PRAGMA table_info({table})')
+    existing = {col[1].lower() for col in cur.fetchall()}
+    for column in columns:
+        if column.split()[0].lower() not in existing:
+            cur.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+
+
+def create_test_tables(cur):
+    # Create the tables of a test's database file, which hold its results
+
+    # Create Strategy_Results table
+    query = '''CREATE TABLE  IF NOT EXISTS Strategy_Results
+                (Strategy_Results_ID INTEGER, 
+                Test_Variable_Range_ID INTEGER,
+                Fast_MA INTEGER,
+                Slow_MA INTEGER,
+                Stop_Loss REAL, 
+                Take_Profit REAL, 
+                Total_PNL REAL,
+                Pruned_Bar INTEGER,
+                CONSTRAINT Strategy_Results_ID PRIMARY KEY (Strategy_Results_ID), 
+                FOREIGN KEY(Test_Variable_Range_ID) REFERENCES Test_Variable_Range(Test_Variable_Range_ID));'''
+    cur.execute(query)
+    # Pruned_Bar is the candle a test was stopped on by the pruning rules, see pruning.py, or NULL if it ran to the end
+    add_columns(cur, 'Strategy_Results', ['Pruned_Bar INTEGER'])
+
+    # Create Position_Details Table.  Positions are stored as integers, see positions.py
+    # Direction is -1 short or 1 long, bars index the candles of the instrument period, and prices are in half ticks
+    query = '''CREATE TABLE  IF NOT EXISTS Position_Details
+                (Position_Details_ID INTEGER,
+                Strategy_Results_ID INTEGER, 
+                Direction INTEGER,
+                Open_Bar INTEGER,
+                Open_Price INTEGER,
+                Close_Bar INTEGER,
+                Close_Price INTEGER,
+                PNL REAL,
+                CONSTRAINT Position_Details_ID PRIMARY KEY (Position_Details_ID), 
+                FOREIGN KEY(Strategy_Results_ID) REFERENCES Strategy_Results(Strategy_Results_ID));'''
+    cur.execute(query)
+
+    # Create Test_Leaderboard table.  The best results of a test per ranking metric, saved when its run finishes
+    query = '''CREATE TABLE  IF NOT EXISTS Test_Leaderboard
+                (Test_Variable_Range_ID INTEGER,
+                Metric TEXT,
+                Rank INTEGER,
+                Strategy_Results_ID INTEGER,
+                CONSTRAINT PK_Test_Leaderboard PRIMARY KEY (Test_Variable_Range_ID, Metric, Rank), 
+                FOREIGN KEY(Strategy_Results_ID) REFERENCES Strategy_Results(Strategy_Results_ID));'''
+    cur.execute(query)
+
+    # Create Test_Surface table.  Total_PNL of every combination of a test as an array saved with numpy
+    query = '''CREATE TABLE  IF NOT EXISTS Test_Surface
+                (Test_Variable_Range_ID INTEGER,
+                Shape TEXT,
+                Surface BLOB,
+                CONSTRAINT PK_Test_Surface PRIMARY KEY (Test_Variable_Range_ID), 
+                FOREIGN KEY(Test_Variable_Range_ID) REFERENCES Test_Variable_Range(Test_Variable_Range_ID));'''
+    cur.execute(query)
+
+    # Create Test_Chunk table.  A row is written in the same transaction as the results of its chunk
+    query = '''CREATE TABLE  IF NOT EXISTS Test_Chunk
+                (Test_Variable_Range_ID INTEGER,
+                Chunk_No INTEGER,
+                No_Of_Tests INTEGER,
+                Completed_Datetime TEXT,
+                CONSTRAINT PK_Test_Chunk PRIMARY KEY (Test_Variable_Range_ID, Chunk_No), 
+                FOREIGN KEY(Test_Variable_Range_ID) REFERENCES Test_Variable_Range(Test_Variable_Range_ID));'''
+    cur.execute(query)
+
+    # Create Strategy_Robustness table.  Confidence intervals of the best strategies from resampling their trades,
+    # see robustness.py.  PnLs and drawdowns are fractions, like Total_PNL
+    query = '''CREATE TABLE  IF NOT EXISTS Strategy_Robustness
+                (Strategy_Results_ID INTEGER,
+                Resamples INTEGER,
+                Confidence REAL,
+                Max_Drawdown REAL,
+                PNL_Low REAL,
+                PNL_Median REAL,
+                PNL_High REAL,
+                Loss_Probability REAL,
+                Drawdown_Low REAL,
+                Drawdown_Median REAL,
+                Drawdown_High REAL,
+                CONSTRAINT PK_Strategy_Robustness PRIMARY KEY (Strategy_Results_ID), 
+                FOREIGN KEY(Strategy_Results_ID) REFERENCES Strategy_Results(Strategy_Results_ID));'''
+    cur.execute(query)
+
+    # Create Test_Bars table.  The number of candles the results cover, written when candles are appended, see live.py
+    query = '''CREATE TABLE  IF NOT EXISTS Test_Bars
+                (Test_Variable_Range_ID INTEGER,
+                No_Of_Bars INTEGER,
+                Updated_Datetime TEXT,
+                CONSTRAINT PK_Test_Bars PRIMARY KEY (Test_Variable_Range_ID), 
+                FOREIGN KEY(Test_Variable_Range_ID) REFERENCES Test_Variable_Range(Test_Variable_Range_ID));'''
+    cur.execute(query)
+
+
+
+def instrument_name_from_path(raw_path):
+    # Raw market data files are named <instrument>_<time frame>_raw.csv, e.g. xbtusd_4h_raw.csv
+
+    f_name = os.path.basename(raw_path)
+    return f_name.split('_')[0].upper(), f_name.split('_')[1].upper()
+
+
+def get_instrument_period(cur, instrument_name):
+    # Return the Instrument_Period row of an instrument as a dictionary, or None if its market data isn't imported
+
+    cur.execute('SELECT * FROM Instrument_Period WHERE Instrument_Name = ?', (instrument_name,))
+    res = cur.fetchone()
+    if res is None:
+        return None
+
+    col = [desc[0].lower() for desc in cur.description]
+    return dict(zip(col, res))
+
+
+def import_market_data(conn, raw_path):
+    # Transform and load a raw market data csv into the Instrument_Period and Market_Data tables
+
+    import pandas as pd
+    cur = conn.cursor()
+
+    # Retrieve the market data from csv
+    df = pd.read_csv(raw_path)
+
+    # Drop unneeded columns
+    df.drop(['symbol', 'trades', 'volume', 'vwap'], axis=1, inplace=True)
+
+    # Add data for moving averages
+    df = add_moving_averages(df)
+    
+    # Remove ms and slice time range
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    df['timestamp'] = df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    df2 = df[(df.timestamp >= START_DATETIME) & (df.timestamp <= END_DATETIME)] 
+
+    # Get record data from csv file
+    instrument_name, time_frame = instrument_name_from_path(raw_path)
+    start_time = df2['timestamp'].values[0]
+    end_time = df2['timestamp'].values[-1]
+
+    # Populate Instrument_Period table  
+    query = '''INSERT INTO Instrument_Period (Instrument_Name, Start_Datetime, End_Datetime, Time_Frame) 
+                VALUES (?, ?, ?, ?);'''        
+    vals = [instrument_name, start_time, end_time, time_frame]                  
+    cur.execute(query, vals)
+    conn.commit()
+    
+    # Insert foreign key and populate Market_Data table
+    df2.insert(loc=0, column='Instrument_Period_ID', value=cur.lastrowid)
+    df2.to_sql('Market_Data', conn, if_exists='append', index=False)
+
+    return get_instrument_period(cur, instrument_name)
+
+
+def migrate_test_tables(cur):
+    # Move the results of every test in the main database to the test's own database file, then drop them from
+    # the main database and vacuum it to free their space
+
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({})".format(
+        ', '.join('?' * len(TEST_TABLES))), TEST_TABLES)
+    existing = {row[0] for row in cur.fetchall()}
+    tables = [table for table in TEST_TABLES if table in existing]
+    if 'Strategy_Results' not in tables:
+        return
+
+    conn = cur.connection
+    migrate_position_details(cur)
+    conn.commit()
+    cur.execute('SELECT Test_Variable_Range_ID FROM Test_Variable_Range')
+    for (test_variable_range_id,) in cur.fetchall():
+        test_db_connect(test_variable_range_id).close()
+        cur.execute('ATTACH DATABASE ? AS test', (test_db_path(test_variable_range_id),))
+        # OR IGNORE, so a migration that was interrupted can run again
+        for table in tables:
+            if table == 'Position_Details':
+                cur.execute('''INSERT OR IGNORE INTO test.Position_Details SELECT p.* FROM main.Position_Details p
+                                    JOIN main.Strategy_Results s ON s.Strategy_Results_ID = p.Strategy_Results_ID
+                                WHERE s.Test_Variable_Range_ID = ?''', (test_variable_range_id,))
+            else:
+                # Name the columns, as the test file's tables can have columns added since
+                cur.execute(f'PRAGMA main.table_info({table})')
+                columns = ', '.join(col[1] for col in cur.fetchall())
+                cur.execute(f'''INSERT OR IGNORE INTO test.{table} ({columns}) SELECT {columns} FROM main.{table} 
+                                WHERE Test_Variable_Range_ID = ?''', (test_variable_range_id,))
+        conn.commit()
+        cur.execute('DETACH DATABASE test')
+
+    for table in tables:
+        cur.execute(f'DROP TABLE main.{table}')
+    conn.commit()
+    cur.execute('VACUUM')
+
+
+def migrate_position_details(cur):
+    # Convert a Position_Details table saved with text times and real prices to the compact encoding in place
+
+    cur.execute('PRAGMA table_info(Position_Details)')
+    if 'Open_Time' not in [col[1] for col in cur.fetchall()]:
+        return
+
+    cur.execute('ALTER TABLE Position_Details RENAME TO Position_Details_Text')
+    cur.execute('''CREATE TABLE Position_Details
+                (Position_Details_ID INTEGER,
+                Strategy_Results_ID INTEGER, 
+                Direction INTEGER,
+                Open_Bar INTEGER,
+                Open_Price INTEGER,
+                Close_Bar INTEGER,
+                Close_Price INTEGER,
+                PNL REAL,
+                CONSTRAINT Position_Details_ID PRIMARY KEY (Position_Details_ID), 
+                FOREIGN KEY(Strategy_Results_ID) REFERENCES Strategy_Results(Strategy_Results_ID));''')
+    # Number the candles of each instrument period from 0 to find the bars of the open and close times
+    cur.execute('''INSERT INTO Position_Details 
+                    WITH Bars AS (SELECT Instrument_Period_ID, Timestamp, 
+                        ROW_NUMBER() OVER (PARTITION BY Instrument_Period_ID ORDER BY Market_Data_ID) - 1 AS Bar 
+                        FROM Market_Data)
+                    SELECT p.Position_Details_ID, p.Strategy_Results_ID, 
+                        CASE p.Direction WHEN 'short' THEN -1 ELSE 1 END, ob.Bar, CAST(ROUND(p.Open_Price * 2) AS INTEGER),
+                        cb.Bar, CAST(ROUND(p.Close_Price * 2) AS INTEGER), p.PNL
+                    FROM Position_Details_Text p
+                        JOIN Strategy_Results s ON s.Strategy_Results_ID = p.Strategy_Results_ID
+                        JOIN Test_Variable_Range t ON t.Test_Variable_Range_ID = s.Test_Variable_Range_ID
+                        JOIN Bars ob ON ob.Instrument_Period_ID = t.Instrument_Period_ID AND ob.Timestamp = p.Open_Time
+                        JOIN Bars cb ON cb.Instrument_Period_ID = t.Instrument_Period_ID AND cb.Timestamp = p.Close_Time''')
+    cur.execute('DROP TABLE Position_Details_Text')
+    cur.connection.commit()
+
+
+def load_positions(test_variable_range_id, strategy_results_id):
+    # Return the positions of a strategy decoded to the columns Position_Details had before it was compacted:
+    # [(position_details_id, strategy_results_id, direction, open_time, open_price, close_time, close_price, pnl), ...]
+
+    try:
+        position_details = []
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return position_details
+        cur = conn.cursor()
+        cur.execute('''SELECT m.Timestamp FROM Strategy_Results s
+                        JOIN Test_Variable_Range t ON t.Test_Variable_Range_ID = s.Test_Variable_Range_ID
+                        JOIN Market_Data m ON m.Instrument_Period_ID = t.Instrument_Period_ID
+                    WHERE s.Strategy_Results_ID = ? ORDER BY m.Market_Data_ID''', (strategy_results_id,))
+        timestamps = [row[0] for row in cur.fetchall()]
+        cur.execute('''SELECT Position_Details_ID, Strategy_Results_ID, Direction, Open_Bar, Open_Price, Close_Bar, 
+                        Close_Price, PNL FROM Position_Details WHERE Strategy_Results_ID = ? 
+                        ORDER BY Position_Details_ID''', (strategy_results_id,))
+        position_details = [row[:2] + positions.decode(row[2:], timestamps) for row in cur.fetchall()]
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return position_details
+
+
 def create_db(test_name, fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high,
-            stop_loss_low, stop_loss_high, take_profit_low, take_profit_high):
-    # Create the database and tables.  Transform and load raw market data csv 
+            stop_loss_low, stop_loss_high, take_profit_low, take_profit_high, raw_path=None):
+    # Create the database and tables.  Transform and load the raw market data csv if its instrument isn't in the database
+    # raw_path defaults to the configured market data file
 
     try:
-        dir_name = os.getcwd()
-        f_name = 'xbtusd_4h_raw.csv'
-        raw_path = dir_name + '\\web\\database\\' + f_name
-        db_path = dir_name + '\\web\\database\\backtester_database.db'
+        raw_path = raw_path or config.settings.raw_path
+        db_path = config.settings.db_path
+        new_db = not os.path.exists(db_path)
+        if new_db:
+            config.ensure_dirs()
 
-        # Create a new database
-        if not os.path.exists(db_path):
-            # Retrieve the market data from csv
-            df = pd.read_csv(raw_path)
+        conn = None 
+        conn = sq.connect(db_path, timeout=30.0)
 
-            conn = None 
-            conn = sq.connect(db_path, timeout=30.0)
+        # Speed up inserts and reduce DB locks with Write Ahead Logging
+        from sqlite_utils import Database
+        Database(db_path).enable_wal()
+        cur = conn.cursor()
 
-            # Speed up inserts and reduce DB locks with Write Ahead Logging
-            Database(db_path).enable_wal()
-            cur = conn.cursor()
+        create_tables(cur)
+
+        # Load the market data the first time an instrument is tested
+        instrument_name, time_frame = instrument_name_from_path(raw_path)
+        instrument_period_dict = get_instrument_period(cur, instrument_name)
+        if instrument_period_dict is None:
+            instrument_period_dict = import_market_data(conn, raw_path)
+
+        # Populate Test_Variable_Range table
+        query = '''INSERT INTO Test_Variable_Range (Instrument_Period_ID, Test_Name, Fast_MA_Low, Fast_MA_High, 
+                Slow_MA_Low, Slow_MA_High, Stop_Loss_Low, Stop_Loss_High, Take_Profit_Low, Take_Profit_High) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''' 
+        vals = [instrument_period_dict['instrument_period_id'], test_name, fast_ma_low, fast_ma_high, slow_ma_low, \
+                slow_ma_high, stop_loss_low/100, stop_loss_high/100, take_profit_low/100, take_profit_high/100]
+        cur.execute(query, vals)
+        conn.commit()
+        test_variable_range_id = cur.lastrowid
+        # Test_Variable_Range_IDs of deleted tests are reused, so start the new test's database file afresh
+        remove_test_db(test_variable_range_id)
 
-            # Drop unneeded columns
-            df.drop(['symbol', 'trades', 'volume', 'vwap'], axis=1, inplace=True)
+        if conn:
+            conn.close()
+           
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
 
-            # Add data for moving averages
-            for x in range(3, 21):
-                col_name = 'ma' + str(x)
-                df[col_name] = round(df['close'].rolling(x).mean(), 2)
-            
-            # Remove ms and slice time range
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            df['timestamp'] = df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
-            df2 = df[(df.timestamp >= '2021-06-01 00:00:00') & (df.timestamp <= '2021-09-01 00:00:00')] 
-
-            # Get record data from csv file
-            instrument_name = f_name.split('_')[0].upper()
-            time_frame = f_name.split('_')[1].upper()
-            start_time = df2['timestamp'].values[0]
-            end_time = df2['timestamp'].values[-1]
-
-            # Create Instrument_Period table
-            query = '''CREATE TABLE IF NOT EXISTS Instrument_Period 
-                            (Instrument_Period_ID INTEGER, 
-                            Instrument_Name TEXT NOT NULL, 
-                            Start_Datetime TEXT, 
-                            End_Datetime TEXT, 
-                            Time_Frame TEXT,
-                            CONSTRAINT PK_Instrument_Period_ID PRIMARY KEY (Instrument_Period_ID));'''
-            cur.execute(query)
+    return instrument_period_dict, test_variable_range_id
 
-            # Populate Instrument_Period table  
-            query = '''INSERT INTO Instrument_Period (Instrument_Name, Start_Datetime, End_Datetime, Time_Frame) 
-                        VALUES (?, ?, ?, ?);'''        
-            vals = [instrument_name, start_time, end_time, time_frame]                  
-            cur.execute(query, vals)
-            conn.commit()
-            
-            instrument_period_dict = {'instrument_period_id': cur.lastrowid, 'instrument_name':instrument_name, \
-                                'start_time':start_time, 'end_time':end_time, 'time_frame':time_frame}
-            
-            # Insert foreign key
-            df2.insert(loc=0, column='Instrument_Period_ID', value=cur.lastrowid)
-
-            # Create Market_Data table and populate it
-            query = '''CREATE TABLE  IF NOT EXISTS Market_Data 
-                        (Market_Data_ID INTEGER,
-                        Instrument_Period_ID INTEGER,
-                        Timestamp TEXT, Open REAL, High REAL, Low REAL, Close REAL, MA3 REAL, MA4 REAL, MA5 REAL, 
-                        MA6 REAL, MA7 REAL, MA8 REAL, MA9 REAL, MA10 REAL, MA11 REAL, MA12 REAL, MA13 REAL, 
-                        MA14 REAL, MA15 REAL, MA16 REAL, MA17 REAL, MA18 REAL, MA19 REAL, MA20 REAL,
-                        CONSTRAINT PK_Market_Data_ID PRIMARY KEY (Market_Data_ID), 
-                        FOREIGN KEY(Instrument_Period_ID) REFERENCES Instrument_Period(Instrument_Period_ID));'''       
-            cur.execute(query)
-            df2.to_sql('Market_Data', conn, if_exists='append', index=False)
-
-            # Create Test_Variable_Range table
-            query = '''CREATE TABLE  IF NOT EXISTS Test_Variable_Range
-                        (Test_Variable_Range_ID INTEGER, 
-                        Instrument_Period_ID INTEGER,
-                        Test_Name TEXT NOT NULL UNIQUE,
-                        Fast_MA_Low INTEGER, 
-                        Fast_MA_High INTEGER, 
-                        Slow_MA_Low INTEGER, 
-                        Slow_MA_High INTEGER, 
-                        Stop_Loss_Low REAL,
-                        Stop_Loss_High REAL,
-                        Take_Profit_Low REAL,
-                        Take_Profit_High REAL,
-                        CONSTRAINT Test_Variable_Range_ID PRIMARY KEY (Test_Variable_Range_ID), 
-                        FOREIGN KEY(Instrument_Period_ID) REFERENCES Instrument_Period(Instrument_Period_ID));'''
-            cur.execute(query)          
-
-            # Populate Test_Variable_Range table    
-            query = '''INSERT INTO Test_Variable_Range (Instrument_Period_ID, Test_Name, Fast_MA_Low, Fast_MA_High, 
-                    Slow_MA_Low, Slow_MA_High, Stop_Loss_Low, Stop_Loss_High, Take_Profit_Low, Take_Profit_High) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''' 
-            vals = [instrument_period_dict['instrument_period_id'], test_name, fast_ma_low, fast_ma_high, slow_ma_low, \
-                    slow_ma_high, stop_loss_low/100, stop_loss_high/100, take_profit_low/100, take_profit_high/100]
-            cur.execute(query, vals)
-            conn.commit()
-            test_variable_range_id = cur.lastrowid
-
-            # Create Strategy_Results table
-            query = '''CREATE TABLE  IF NOT EXISTS Strategy_Results
-                        (Strategy_Results_ID INTEGER, 
-                        Test_Variable_Range_ID INTEGER,
-                        Fast_MA INTEGER,
-                        Slow_MA INTEGER,
-                        Stop_Loss REAL, 
-                        Take_Profit REAL, 
-                        Total_PNL REAL,
-                        CONSTRAINT Strategy_Results_ID PRIMARY KEY (Strategy_Results_ID), 
-                        FOREIGN KEY(Test_Variable_Range_ID) REFERENCES Test_Variable_Range(Test_Variable_Range_ID));'''
-            cur.execute(query)
 
-            # Create Position_Details Table
-            query = '''CREATE TABLE  IF NOT EXISTS Position_Details
-                        (Position_Details_ID INTEGER,
-                        Strategy_Results_ID INTEGER, 
-                        Direction TEXT,
-                        Open_Time TEXT,
-                        Open_Price REAL,
-                        Close_Time TEXT,
-                        Close_Price REAL,
-                        PNL REAL,
-                        CONSTRAINT Position_Details_ID PRIMARY KEY (Position_Details_ID), 
-                        FOREIGN KEY(Strategy_Results_ID) REFERENCES Strategy_Results(Strategy_Results_ID));'''
-            cur.execute(query)
+def instrument_imported(raw_path=None):
+    # Check if the market data for the instrument of a raw csv file is already in the database
 
-            query = '''SELECT * FROM Instrument_Period WHERE Instrument_Name = "XBTUSD"'''
-            cur.execute(query)
-            res = list(cur.fetchone())
+    try:
+        imported = False
+        raw_path = raw_path or config.settings.raw_path
+        if os.path.exists(config.settings.db_path):
+            conn = db_connect()
+            cur = conn.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'Instrument_Period'")
+            if cur.fetchone():
+                imported = get_instrument_period(cur, instrument_name_from_path(raw_path)[0]) is not None
+            if conn:
+                conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return imported
 
-            instrument_period_dict = []
-            col = [desc[0].lower() for desc in cur.description]
-            instrument_period_dict = dict(zip(col, res))
 
+def test_name_exists(test_name):
+    # Test names must be unique
+
+    try:
+        exists = False
+        if os.path.exists(config.settings.db_path):
+            conn = db_connect()
+            cur = conn.cursor()
+            cur.execute ('SELECT Test_Name FROM Test_Variable_Range WHERE Test_Name = ?', (test_name,))
+            exists = cur.fetchone() is not None
             if conn:
                 conn.close()
 
-        # Update existing database
-        else:
-            conn = None 
-            conn = sq.connect(db_path, timeout=30.0)
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return exists
 
-            # Speed up inserts and reduce DB locks with Write Ahead Logging
-            Database(db_path).enable_wal()
+
+def get_test_name(test_variable_range_id):
+    # Return the name of a test, or None if there is no such test
+
+    try:
+        test_name = None
+        if os.path.exists(config.settings.db_path):
+            conn = db_connect()
             cur = conn.cursor()
+            cur.execute ('SELECT Test_Name FROM Test_Variable_Range WHERE Test_Variable_Range_ID = ?', 
+                (test_variable_range_id,))
+            res = cur.fetchone()
+            test_name = res[0] if res else None
+            if conn:
+                conn.close()
 
-            query = '''SELECT * FROM Instrument_Period WHERE Instrument_Name = "XBTUSD"'''
-            cur.execute(query)
-            res = list(cur.fetchone())
-
-            instrument_period_dict = []
-            col = [desc[0].lower() for desc in cur.description]
-            instrument_period_dict = dict(zip(col, res))
-
-            # Populate Test_Variable_Range table
-            query = '''INSERT INTO Test_Variable_Range (Instrument_Period_ID, Test_Name, Fast_MA_Low, Fast_MA_High, 
-                    Slow_MA_Low, Slow_MA_High, Stop_Loss_Low, Stop_Loss_High, Take_Profit_Low, Take_Profit_High) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''' 
-            vals = [instrument_period_dict['instrument_period_id'], test_name, fast_ma_low, fast_ma_high, slow_ma_low, \
-                    slow_ma_high, stop_loss_low/100, stop_loss_high/100, take_profit_low/100, take_profit_high/100]
-            cur.execute(query, vals)
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return test_name
+
+
+def get_test_run(test_name):
+    # Return the Test_Variable_Range row of a test joined with its Test_Run row, and its Instrument_Period row,
+    # as dictionaries.  Return (None, None) if there is no such test
+
+    try:
+        test_run = None
+        instrument_period_dict = None
+        conn = db_connect()
+        cur = conn.cursor()
+        create_tables(cur)
+        cur.execute('''SELECT tvr.*, tr.No_Of_Tests, tr.Chunk_Size, tr.No_Of_Chunks, tr.Status,
+                            tr.Start_Datetime, tr.End_Datetime, tr.Prune_Max_Drawdown, tr.Prune_Min_PNL,
+                            tr.Prune_Checkpoint_Bars
+                        FROM Test_Variable_Range tvr
+                            LEFT JOIN Test_Run tr ON tr.Test_Variable_Range_ID = tvr.Test_Variable_Range_ID
+                        WHERE tvr.Test_Name = ?''', (test_name,))
+        res = cur.fetchone()
+        if res is not None:
+            test_run = dict(zip([desc[0].lower() for desc in cur.description], res))
+            cur.execute('SELECT * FROM Instrument_Period WHERE Instrument_Period_ID = ?', 
+                (test_run['instrument_period_id'],))
+            instrument_period_dict = dict(zip([desc[0].lower() for desc in cur.description], cur.fetchone()))
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return test_run, instrument_period_dict
+
+
+def completed_chunks(test_variable_range_id):
+    # Chunk numbers of a test whose results are in the database
+
+    try:
+        chunk_nos = set()
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return chunk_nos
+        cur = conn.cursor()
+        cur.execute('SELECT Chunk_No FROM Test_Chunk WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        chunk_nos = {row[0] for row in cur.fetchall()}
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return chunk_nos
+
+
+def count_pruned(test_variable_range_id):
+    # Number of a test's combinations that were stopped early by its pruning rules
+
+    try:
+        pruned = 0
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return pruned
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM Strategy_Results WHERE Pruned_Bar IS NOT NULL')
+        pruned = cur.fetchone()[0]
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return pruned
+
+
+def start_test_run(test_variable_range_id, no_of_tests, chunk_size, no_of_chunks, prune=None):
+    # Record how a test is split into chunks, and its pruning rules, so a resumed run splits and prunes it the same way
+    # Return the chunk size of the test, which is the one first recorded if the run is being resumed
+
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        max_drawdown, min_pnl, checkpoint_bars = pruning.to_columns(prune)
+        cur.execute('''INSERT OR IGNORE INTO Test_Run (Test_Variable_Range_ID, No_Of_Tests, Chunk_Size, No_Of_Chunks, 
+                            Status, Start_Datetime, Prune_Max_Drawdown, Prune_Min_PNL, Prune_Checkpoint_Bars) 
+                        VALUES (?, ?, ?, ?, 'running', ?, ?, ?, ?);''', 
+                    (test_variable_range_id, no_of_tests, chunk_size, no_of_chunks, 
+                        datetime.now().strftime('%Y-%m-%d %H:%M:%S'), max_drawdown, min_pnl, checkpoint_bars))
+        conn.commit()
+        # A test file made before Pruned_Bar was added is given it before the resumed run writes to it
+        test_conn = test_db_connect(test_variable_range_id)
+        create_test_tables(test_conn.cursor())
+        test_conn.commit()
+        test_conn.close()
+        cur.execute('SELECT Chunk_Size FROM Test_Run WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        chunk_size = cur.fetchone()[0]
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return chunk_size
+
+
+def finish_test_run(test_variable_range_id):
+    # Mark a test complete once all of its chunks are written.  Return the test's status
+
+    try:
+        status = 'running'
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return status
+        cur = conn.cursor()
+        cur.execute('''UPDATE Test_Run SET Status = 'complete', End_Datetime = ?
+                        WHERE Test_Variable_Range_ID = ? AND No_Of_Chunks = 
+                            (SELECT COUNT(*) FROM Test_Chunk WHERE Test_Variable_Range_ID = ?)''',
+                    (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), test_variable_range_id, test_variable_range_id))
+        conn.commit()
+        cur.execute('SELECT Status FROM Test_Run WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        status = cur.fetchone()[0]
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return status
+
+
+def tests_completed(test_variable_range_id):
+    # Number of tests of a run whose results are in the database
+
+    try:
+        no_of_tests = 0
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return no_of_tests
+        cur = conn.cursor()
+        cur.execute('SELECT COALESCE(SUM(No_Of_Tests), 0) FROM Test_Chunk')
+        no_of_tests = cur.fetchone()[0]
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return no_of_tests
+
+
+def test_version(test_variable_range_id):
+    # The modification time and size of a test's database file and its write ahead log, or None for a missing file
+    # Every write to the test, from any process, changes it, and so does deleting the test
+
+    db_path = test_db_path(test_variable_range_id)
+    version = []
+    for path in [db_path, db_path + '-wal']:
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+def remove_test_db(test_variable_range_id):
+    # Remove the database file of a test, with its write ahead log
+
+    db_path = test_db_path(test_variable_range_id)
+    for path in [db_path, db_path + '-wal', db_path + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def delete_test(test_variable_range_id):
+    # Delete a test and its results.  Removing its database file frees their space at once
+    # Return True if there was such a test
+
+    try:
+        deleted = False
+        conn = db_connect()
+        cur = conn.cursor()
+        create_tables(cur)
+        cur.execute('DELETE FROM Test_Run WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        cur.execute('DELETE FROM Test_Variable_Range WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        deleted = cur.rowcount > 0
+        conn.commit()
+        if conn:
+            conn.close()
+        remove_test_db(test_variable_range_id)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return deleted
+
+
+def archive_test(test_variable_range_id):
+    # Move a test's database file to the archive folder and delete the test from the main database
+    # The test's Test_Variable_Range and Test_Run rows, and its instrument's market data, are copied into the file
+    # first, so the archive can be read on its own.  Return the path of the archive, or None if there's no such test
+
+    try:
+        archive_path = None
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return archive_path
+        cur = conn.cursor()
+        create_tables(cur)
+        cur.execute('SELECT Instrument_Period_ID FROM Test_Variable_Range WHERE Test_Variable_Range_ID = ?', 
+            (test_variable_range_id,))
+        res = cur.fetchone()
+        if res is None:
+            conn.close()
+            return archive_path
+
+        for table, key, val in [('Instrument_Period', 'Instrument_Period_ID', res[0]), 
+                                ('Market_Data', 'Instrument_Period_ID', res[0]),
+                                ('Test_Variable_Range', 'Test_Variable_Range_ID', test_variable_range_id), 
+                                ('Test_Run', 'Test_Variable_Range_ID', test_variable_range_id)]:
+            cur.execute(f'DROP TABLE IF EXISTS test.{table}')
+            cur.execute(f'CREATE TABLE test.{table} AS SELECT * FROM main.{table} WHERE {key} = ?', (val,))
+        conn.commit()
+        if conn:
+            conn.close()
+
+        # Fold the write ahead log into the file, so the archive is a single file
+        conn = test_db_connect(test_variable_range_id)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+
+        os.makedirs(config.settings.archive_dir, exist_ok=True)
+        archive_path = os.path.join(config.settings.archive_dir, 
+            f"test_{int(test_variable_range_id)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+        shutil.move(test_db_path(test_variable_range_id), archive_path)
+        delete_test(test_variable_range_id)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return archive_path
+
+
+def save_leaderboard(test_variable_range_id, ranks):
+    # Save the Strategy_Results_IDs of a test's best results, best first, per ranking metric
+    # ranks is returned by leaderboard.Leaderboard.ranks
+
+    try:
+        conn = test_db_connect(test_variable_range_id)
+        cur = conn.cursor()
+        cur.execute('DELETE FROM Test_Leaderboard WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        cur.executemany('''INSERT INTO Test_Leaderboard (Test_Variable_Range_ID, Metric, Rank, Strategy_Results_ID)
+                            VALUES (?, ?, ?, ?);''', 
+                        [(test_variable_range_id, metric, rank, strategy_results_id) 
+                         for metric, ids in ranks.items() for rank, strategy_results_id in enumerate(ids, 1)])
+        conn.commit()
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+
+def surface_from_results(cur, test_variable_range):
+    # Build the PnL surface of a test from its results in one query.  test_variable_range is its row as a dictionary
+    # Pruned combinations only have the PnL up to the bar they were stopped on, so they are left out, like untested ones
+
+    axes = surface.axis_values(test_variable_range)
+    cur.execute('''SELECT Fast_MA, Slow_MA, Stop_Loss, Take_Profit, Total_PNL FROM Strategy_Results 
+                    WHERE Test_Variable_Range_ID = ? AND Pruned_Bar IS NULL''', 
+                (test_variable_range['test_variable_range_id'],))
+    return axes, surface.build_surface(axes, cur.fetchall())
+
+
+def save_surface(test_variable_range_id):
+    # Build the PnL surface of a finished test and save it with the test.  Return (axes, surface)
+
+    try:
+        axes, pnl_surface = None, None
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return axes, pnl_surface
+        cur = conn.cursor()
+        cur.execute('SELECT * FROM Test_Variable_Range WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        res = cur.fetchone()
+        if res is not None:
+            axes, pnl_surface = surface_from_results(cur, dict(zip([desc[0].lower() for desc in cur.description], res)))
+            cur.execute('INSERT OR REPLACE INTO Test_Surface (Test_Variable_Range_ID, Shape, Surface) VALUES (?, ?, ?);',
+                        (test_variable_range_id, 'x'.join(str(n) for n in pnl_surface.shape), 
+                            surface.to_blob(pnl_surface)))
             conn.commit()
-            test_variable_range_id = cur.lastrowid
-           
+        if conn:
+            conn.close()
+
     except BaseException:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
         log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
 
-    return instrument_period_dict, test_variable_range_id
+    return axes, pnl_surface
+
+
+def load_surface(test_variable_range_id):
+    # Return the (axes, surface) of a test, or (None, None) if there is no such test
+    # Tests saved before surfaces were are saved now.  Running tests are built from their results so far each time
+
+    try:
+        axes, pnl_surface = None, None
+        if get_test_name(test_variable_range_id) is None:
+            return axes, pnl_surface
+
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return axes, pnl_surface
+        cur = conn.cursor()
+        cur.execute('''SELECT tvr.*, tr.Status, ts.Surface FROM Test_Variable_Range tvr
+                            LEFT JOIN Test_Run tr ON tr.Test_Variable_Range_ID = tvr.Test_Variable_Range_ID
+                            LEFT JOIN Test_Surface ts ON ts.Test_Variable_Range_ID = tvr.Test_Variable_Range_ID
+                        WHERE tvr.Test_Variable_Range_ID = ?''', (test_variable_range_id,))
+        res = cur.fetchone()
+        if res is not None:
+            test_variable_range = dict(zip([desc[0].lower() for desc in cur.description], res))
+            if test_variable_range['surface'] is not None:
+                axes = surface.axis_values(test_variable_range)
+                pnl_surface = surface.from_blob(test_variable_range['surface'])
+            elif test_variable_range['status'] == 'running':
+                axes, pnl_surface = surface_from_results(cur, test_variable_range)
+        if conn:
+            conn.close()
+
+        if res is not None and pnl_surface is None:
+            axes, pnl_surface = save_surface(test_variable_range_id)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return axes, pnl_surface
+
 
 class Test_Strategy:
     """ Populate the database with the results from the test """
 
 
-    def __init__(self, rec_dict, fast_ma, slow_ma, stop_loss, take_profit, instrument_period_dict, test_variable_range_id):
+    def __init__(self, rec_dict, fast_ma, slow_ma, stop_loss, take_profit, instrument_period_dict, test_variable_range_id,
+                prune=None, persist=True, positions=None, resume=None):
+        # prune, if given, is the rules of pruning.make_rules to stop the test early by
+        # persist=False computes the results without writing them, so the caller can write them with write_results
+        # positions, if given, is the (short_position, long_position, pruned_bar) found by kernels.scan_sub_grid,
+        # so the scan is skipped and only the results are loaded
+        # resume, if given, is (start_idx, open_position) to carry on a test from, see live.update_test
+        # Only the positions from there on are found, with open_position, if not None, closed first
+        # A third item (pnl, peak) carries on the pruning rules from the PnL of the positions before start_idx
         
         self.rec_dict = rec_dict
         self.fast_ma = 'ma' + str(fast_ma)
@@ -338,137 +1035,170 @@ class Test_Strategy:
         self.test_variable_range_id = test_variable_range_id
         self.short_position = []
         self.long_position = []
-        self.open_position()       
+        # Seconds spent in each stage of the test
+        self.timings = {'signal_scan': 0.0, 'exit_scan': 0.0, 'db_write': 0.0, 'lock_wait': 0.0}
+        self.persist = persist
+        self.results_computed = False
+        self.results_loaded = False
+        self.resume = resume
+        self.prune = prune
+        self.pruned_bar = None
+        self.pnl_sum, self.peak = resume[2] if resume is not None and len(resume) > 2 else (0.0, 0.0)
+        if positions is None:
+            self.run_strategy()
+        else:
+            self.short_position, self.long_position, self.pruned_bar = positions
+            self.load_results()
 
 
-    def open_position(self, start_idx=0):
-        # Take a position, either long (buy) or short (sell), when the fast_ma crosses the slow_ma
-        # Next run close_position
-    
+    def run_strategy(self):
+        # Alternate between open_position and close_position until the end of the market data, then load the results
+        # A loop is used instead of the two methods calling each other, so long market data can't hit the recursion limit
+
         try:
-            self.start_idx = start_idx          
-            
-            # Search for a crossover
-            for self.start_idx in range(self.start_idx, len(self.rec_dict) - 1):
-                
-                # Short when the fast_ma crosses under slow_ma
-                # Check the price at start_idx was OVER the slow_ma and then the price at start_idx+1 FELL UNDER the slow_ma
-                if self.rec_dict[self.start_idx][self.fast_ma] > self.rec_dict[self.start_idx][self.slow_ma] and \
-                    self.rec_dict[self.start_idx+1][self.fast_ma] < self.rec_dict[self.start_idx+1][self.slow_ma]:
-                    # Short the open of the next candle start_idx+2
-                    self.short_position.append( {'direction':'short', 'open_time':self.rec_dict[self.start_idx+2]['timestamp'], 
-                        'open_price':self.rec_dict[self.start_idx+2]['open']} )
-                    # Start search to close the position as soon as it is opened, start_idx+2
-                    self.start_idx += 2
-                    self.close_position(direction = 'short', start_idx=self.start_idx)
-                    return
-                
-                # Long when the fast_ma crosses over ms_slow
-                # Check the price at start_idx was UNDER the slow_ma and then the price at start_idx+1 ROSE OVER the slow_ma
-                elif self.rec_dict[self.start_idx][self.fast_ma] < self.rec_dict[self.start_idx][self.slow_ma] and \
-                    self.rec_dict[self.start_idx+1][self.fast_ma] > self.rec_dict[self.start_idx+1][self.slow_ma]:
-                    # Long the open of the next candle start_idx+2
-                    self.long_position.append( {'direction':'long', 'open_time':self.rec_dict[self.start_idx+2]['timestamp'], 
-                        'open_price':self.rec_dict[self.start_idx+2]['open']} )
-                    # Start search to close the position as soon as it is opened, start_idx+2
-                    self.start_idx += 2
-                    self.close_position(direction = 'long', start_idx=self.start_idx)
-                    return
-        
-            # End search at the end of the market data
-            else:
-                self.load_results()
-                return
-    
+            next_idx, position = (self.resume or (0, None))[:2]
+            if position is not None:
+                (self.short_position if position['direction'] == 'short' else self.long_position).append(position)
+                start_tm = time.perf_counter()
+                next_idx = self.close_position(direction=position['direction'], start_idx=next_idx)
+                self.timings['exit_scan'] += time.perf_counter() - start_tm
+                if next_idx is not None and self.prune_position():
+                    next_idx = None
+
+            while next_idx is not None:
+                start_tm = time.perf_counter()
+                next_idx = self.open_position(start_idx=next_idx)
+                self.timings['signal_scan'] += time.perf_counter() - start_tm
+                if next_idx is not None:
+                    start_tm = time.perf_counter()
+                    next_idx = self.close_position(direction=self.direction, start_idx=next_idx)
+                    self.timings['exit_scan'] += time.perf_counter() - start_tm
+                    # Positions closed at the end of the market data are the last, so there's nothing left to prune
+                    if next_idx is not None and self.prune_position():
+                        next_idx = None
+
+            self.load_results()
+
         except BaseException:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
             log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
 
 
+    def prune_position(self):
+        # Add the PnL of the position just closed, and return whether the pruning rules stop the test on its candle
+
+        if self.prune is None:
+            return False
+        position = (self.short_position if self.direction == 'short' else self.long_position)[-1]
+        self.pnl_sum += position['pnl']
+        self.peak = max(self.peak, self.pnl_sum)
+        if pruning.tripped(self.pnl_sum, self.peak, position['close_bar'], self.prune):
+            self.pruned_bar = position['close_bar']
+            return True
+        return False
+
+
+    def open_position(self, start_idx=0):
+        # Take a position, either long (buy) or short (sell), when the fast_ma crosses the slow_ma
+        # Return the index to start close_position from, or None at the end of the market data
+    
+        self.start_idx = start_idx          
+        
+        # Search for a crossover.  Stop early enough to leave a candle to open the position on
+        for self.start_idx in range(self.start_idx, len(self.rec_dict) - 2):
+            
+            # Short when the fast_ma crosses under slow_ma
+            # Check the price at start_idx was OVER the slow_ma and then the price at start_idx+1 FELL UNDER the slow_ma
+            if self.rec_dict[self.start_idx][self.fast_ma] > self.rec_dict[self.start_idx][self.slow_ma] and \
+                self.rec_dict[self.start_idx+1][self.fast_ma] < self.rec_dict[self.start_idx+1][self.slow_ma]:
+                # Short the open of the next candle start_idx+2
+                self.short_position.append( {'direction':'short', 'open_time':self.rec_dict[self.start_idx+2]['timestamp'], 
+                    'open_price':self.rec_dict[self.start_idx+2]['open'], 'open_bar':self.start_idx+2} )
+                # Start search to close the position as soon as it is opened, start_idx+2
+                self.direction = 'short'
+                return self.start_idx + 2
+            
+            # Long when the fast_ma crosses over ms_slow
+            # Check the price at start_idx was UNDER the slow_ma and then the price at start_idx+1 ROSE OVER the slow_ma
+            elif self.rec_dict[self.start_idx][self.fast_ma] < self.rec_dict[self.start_idx][self.slow_ma] and \
+                self.rec_dict[self.start_idx+1][self.fast_ma] > self.rec_dict[self.start_idx+1][self.slow_ma]:
+                # Long the open of the next candle start_idx+2
+                self.long_position.append( {'direction':'long', 'open_time':self.rec_dict[self.start_idx+2]['timestamp'], 
+                    'open_price':self.rec_dict[self.start_idx+2]['open'], 'open_bar':self.start_idx+2} )
+                # Start search to close the position as soon as it is opened, start_idx+2
+                self.direction = 'long'
+                return self.start_idx + 2
+    
+        # End search at the end of the market data
+        return None
+
+
     def close_position(self, direction, start_idx):
         # After a position, either long (buy) or short (sell), has been taken, 
         # close the position as soon as price reaches either the stop_loss or the take_profit
         # If are reached in the time frame, close the position at the stop_loss price
-        # Next look for a new postion with open_position
+        # Return the index to look for a new position from, or None at the end of the market data
         
-        try:
-            self.direction = direction
-            self.start_idx = start_idx
-
-            if self.direction == 'short':
-
-                # Exchange price increments are 0.5, so round off the exit prices
-                self.sl_price = round(self.short_position[-1]['open_price'] * (1.0 + self.stop_loss) * 2) / 2
-                self.tp_price = round(self.short_position[-1]['open_price'] * (1.0 - self.take_profit) * 2) / 2
-
-                # Close the short
-                for self.start_idx in range(self.start_idx, len(self.rec_dict)-1):
-                    # Loss.  Price went up and hit your stop_loss
-                    if self.rec_dict[self.start_idx]['high'] >= self.sl_price:
-                        self.short_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
-                            'close_price':self.sl_price, 'pnl':-self.stop_loss} )                      
-                        # Look for a new position on the next candle
-                        self.start_idx += 1
-                        self.open_position(start_idx=self.start_idx)
-                        return
-
-                    # Profit.  Price went down and hit your take_profit
-                    elif self.rec_dict[self.start_idx]['low'] <= self.tp_price:
-                        self.short_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
-                            'close_price':self.tp_price, 'pnl':self.take_profit} )
-                        # Look for a new position on the next candle
-                        self.start_idx += 1
-                        self.open_position(start_idx=self.start_idx)
-                        return
-
-                # Close the position at end of the market data at the last close price
-                else:
-                    self.urpnl = round( ( self.short_position[-1]['open_price'] - self.rec_dict[-1]['close'] ) \
-                        / self.short_position[-1]['open_price'], 4 )
-                    self.short_position[-1].update( {'close_time':self.rec_dict[-1]['timestamp'], \
-                        'close_price':self.rec_dict[-1]['close'], 'pnl':self.urpnl} )
-                    self.load_results()
-                    return
-
-            elif self.direction == 'long':
-                # Exchange price increments are 0.5, so round off the exit prices
-                self.sl_price = round(self.long_position[-1]['open_price'] * (1.0 - self.stop_loss) * 2) / 2
-                self.tp_price = round(self.long_position[-1]['open_price'] * (1.0 + self.take_profit) * 2) / 2
-
-                # Close the long
-                for self.start_idx in range(self.start_idx, len(self.rec_dict)-1):
-                    # Loss.  Price went down and hit your stop_loss
-                    if self.rec_dict[self.start_idx]['low'] <= self.sl_price:
-                        self.long_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
-                            'close_price':self.sl_price, 'pnl':-self.stop_loss} )
-                        # Look for a new position on the next candle
-                        self.start_idx += 1
-                        self.open_position(start_idx=self.start_idx)
-                        return
-
-                    # Price went up and hit your take_profit
-                    elif self.rec_dict[self.start_idx]['high'] >= self.tp_price:
-                        self.long_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
-                            'close_price':self.tp_price, 'pnl':self.take_profit} )
-                        # Look for a new position on the next candle
-                        self.start_idx += 1
-                        self.open_position(start_idx=self.start_idx)
-                        return
-
-                # Close the position at end of the market data at the last close price 
-                else:                 
-                    self.urpnl = round( ( self.rec_dict[-1]['close'] - self.long_position[-1]['open_price'] ) \
-                        / self.long_position[-1]['open_price'], 4 )
-                    self.long_position[-1].update( {'close_time':self.rec_dict[-1]['timestamp'], \
-                        'close_price':self.rec_dict[-1]['close'], 'pnl':self.urpnl} )
-                    self.load_results()
-                    return
-
-        except BaseException:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
-            log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+        self.direction = direction
+        self.start_idx = start_idx
+
+        if self.direction == 'short':
+
+            # Exchange price increments are 0.5, so round off the exit prices
+            self.sl_price = round(self.short_position[-1]['open_price'] * (1.0 + self.stop_loss) * 2) / 2
+            self.tp_price = round(self.short_position[-1]['open_price'] * (1.0 - self.take_profit) * 2) / 2
+
+            # Close the short
+            for self.start_idx in range(self.start_idx, len(self.rec_dict)-1):
+                # Loss.  Price went up and hit your stop_loss
+                if self.rec_dict[self.start_idx]['high'] >= self.sl_price:
+                    self.short_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
+                        'close_price':self.sl_price, 'pnl':-self.stop_loss, 'close_bar':self.start_idx} )                      
+                    # Look for a new position on the next candle
+                    return self.start_idx + 1
+
+                # Profit.  Price went down and hit your take_profit
+                elif self.rec_dict[self.start_idx]['low'] <= self.tp_price:
+                    self.short_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
+                        'close_price':self.tp_price, 'pnl':self.take_profit, 'close_bar':self.start_idx} )
+                    # Look for a new position on the next candle
+                    return self.start_idx + 1
+
+            # Close the position at end of the market data at the last close price
+            self.urpnl = round( ( self.short_position[-1]['open_price'] - self.rec_dict[-1]['close'] ) \
+                / self.short_position[-1]['open_price'], 4 )
+            self.short_position[-1].update( {'close_time':self.rec_dict[-1]['timestamp'], \
+                'close_price':self.rec_dict[-1]['close'], 'pnl':self.urpnl, 'close_bar':len(self.rec_dict)-1} )
+            return None
+
+        elif self.direction == 'long':
+            # Exchange price increments are 0.5, so round off the exit prices
+            self.sl_price = round(self.long_position[-1]['open_price'] * (1.0 - self.stop_loss) * 2) / 2
+            self.tp_price = round(self.long_position[-1]['open_price'] * (1.0 + self.take_profit) * 2) / 2
+
+            # Close the long
+            for self.start_idx in range(self.start_idx, len(self.rec_dict)-1):
+                # Loss.  Price went down and hit your stop_loss
+                if self.rec_dict[self.start_idx]['low'] <= self.sl_price:
+                    self.long_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
+                        'close_price':self.sl_price, 'pnl':-self.stop_loss, 'close_bar':self.start_idx} )
+                    # Look for a new position on the next candle
+                    return self.start_idx + 1
+
+                # Price went up and hit your take_profit
+                elif self.rec_dict[self.start_idx]['high'] >= self.tp_price:
+                    self.long_position[-1].update( {'close_time':self.rec_dict[self.start_idx]['timestamp'], 
+                        'close_price':self.tp_price, 'pnl':self.take_profit, 'close_bar':self.start_idx} )
+                    # Look for a new position on the next candle
+                    return self.start_idx + 1
+
+            # Close the position at end of the market data at the last close price 
+            self.urpnl = round( ( self.rec_dict[-1]['close'] - self.long_position[-1]['open_price'] ) \
+                / self.long_position[-1]['open_price'], 4 )
+            self.long_position[-1].update( {'close_time':self.rec_dict[-1]['timestamp'], \
+                'close_price':self.rec_dict[-1]['close'], 'pnl':self.urpnl, 'close_bar':len(self.rec_dict)-1} )
+            return None
 
 
     def load_results(self):
@@ -501,37 +1231,29 @@ class Test_Strategy:
             self.pnl_results.append( {'start_time':self.rec_dict[0]['timestamp'], 'end_time':self.rec_dict[-1]['timestamp'], \
                                 'stop_loss':self.stop_loss, 'take_profit':self.take_profit, 'total_pnl':self.total_pnl } )
             
-            self.conn = db_connect()
-            self.cur = self.conn.cursor()
-
-            # Populate Strategy_Results table
-            # Change to dataframe to sql for speed    
-            self.query = '''INSERT INTO Strategy_Results (Test_Variable_Range_ID, Fast_MA, Slow_MA, Stop_Loss, Take_Profit, Total_PNL) 
-                                VALUES (?, ?, ?, ?, ?, ?);'''
-
-            # Remove 'ma' and just enter the ma number in the table 
-            self.vals = [self.test_variable_range_id, self.fast_ma.split('ma')[1], self.slow_ma.split('ma')[1], 
-                            self.stop_loss, self.take_profit, self.total_pnl]
-           
-            self.cur.execute(self.query, self.vals)
-            self.conn.commit()
-            self.strategy_results_id = self.cur.lastrowid
-
             # Create a timestamp ordered nested list of all the positions taken
             #{'direction': 'short', 'open_time': '2021-06-05 04:00:00', 'open_price': 37432.5, 'close_time': '2021-06-05 08:00:00', 'close_price': 35935.0, 'pnl': 0.04}
             self.pos = []
             self.position = []
             self.pos = self.short_position + self.long_position
             self.position = sorted(self.pos, key=itemgetter('open_time'))
+            self.results_computed = True
+
+            if not self.persist:
+                return
             
-            #'''
-            # Populate Position_Detail table
-            self.position_details_df = pd.DataFrame.from_dict(self.position)
-            # Insert foreign key
-            self.position_details_df.insert(loc=0, column='Strategy_Results_ID', value=self.strategy_results_id)
-            self.position_details_df.to_sql('Position_Details', self.conn, if_exists='append', index=False)
+            # Take the write lock before inserting, so time spent waiting on other workers is measured apart from the writes
+            start_tm = time.perf_counter()
+            self.conn = test_db_connect(self.test_variable_range_id)
+            self.cur = self.conn.cursor()
+            self.cur.execute('BEGIN IMMEDIATE')
+            self.timings['lock_wait'] += time.perf_counter() - start_tm
+            start_tm = time.perf_counter()
+
+            self.write_results(self.cur)
             self.conn.commit()
-            #'''
+            self.timings['db_write'] += time.perf_counter() - start_tm
+            self.results_loaded = True
             
             if self.conn:
                 self.conn.close()
@@ -542,24 +1264,68 @@ class Test_Strategy:
             log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
 
 
-def plot_chart(strategy_results_id):
+    def results(self):
+        # The results of the test as plain tuples, compact enough to send between processes and hosts:
+        # (fast_ma, slow_ma, stop_loss, take_profit, total_pnl, [(direction, open_bar, open_price, close_bar, close_price, pnl), ...],
+        #  pruned_bar)
+        # Positions are encoded as they are stored in Position_Details, see positions.encode
+
+        return (int(self.fast_ma.split('ma')[1]), int(self.slow_ma.split('ma')[1]), self.stop_loss, self.take_profit, 
+                self.total_pnl, [positions.encode(p) for p in self.position], self.pruned_bar)
+
+
+    def write_results(self, cur):
+        # Insert the Strategy_Results row and every position in the Position_Details table
+        # The caller owns the transaction, so many tests can be written in one commit
+
+        self.strategy_results_id = insert_results(cur, self.test_variable_range_id, self.results())
+
+
+def insert_results(cur, test_variable_range_id, results):
+    # Insert the results of a test, as returned by Test_Strategy.results, and return its Strategy_Results_ID
+
+    fast_ma, slow_ma, stop_loss, take_profit, total_pnl, trades, pruned_bar = results
+
+    # Populate Strategy_Results table
+    query = '''INSERT INTO Strategy_Results (Test_Variable_Range_ID, Fast_MA, Slow_MA, Stop_Loss, Take_Profit, Total_PNL,
+                    Pruned_Bar) VALUES (?, ?, ?, ?, ?, ?, ?);'''
+    cur.execute(query, (test_variable_range_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl, pruned_bar))
+    strategy_results_id = cur.lastrowid
+
+    # Populate Position_Detail table
+    query = '''INSERT INTO Position_Details (Strategy_Results_ID, Direction, Open_Bar, Open_Price, 
+                    Close_Bar, Close_Price, PNL) VALUES (?, ?, ?, ?, ?, ?, ?);'''
+    cur.executemany(query, [(strategy_results_id,) + p for p in trades])
+
+    return strategy_results_id
+
+
+def plot_chart(test_variable_range_id, strategy_results_id):
     # Display an HTML chart that shows the market, moving averages, trades, and PNL data in a web browser
 
     try:
-        conn = db_connect()
+        import pandas as pd
+        import plotly.graph_objects as go
+        import plotly.io as pio
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return
         cur = conn.cursor()
 
-        # Retrienve the results of a selected strategy
-        cur.execute ('''SELECT Fast_MA, Slow_MA FROM Strategy_Results 
-                WHERE Strategy_Results_ID=\'{s_r_id}\''''.format(s_r_id=strategy_results_id))
+        # Retrienve the results of a selected strategy and the instrument it was tested on
+        cur.execute ('''SELECT s.Fast_MA, s.Slow_MA, i.Instrument_Period_ID, i.Instrument_Name 
+                FROM Strategy_Results AS s
+                JOIN Test_Variable_Range AS t ON s.Test_Variable_Range_ID = t.Test_Variable_Range_ID
+                JOIN Instrument_Period AS i ON t.Instrument_Period_ID = i.Instrument_Period_ID
+                WHERE s.Strategy_Results_ID = ?''', (strategy_results_id,))
         ma_length = list(cur.fetchone())
+        instrument_period_id, instrument_name = ma_length[2], ma_length[3]
 
         # Retrieve every order for a selected strategy
-        cur.execute ('''SELECT * FROM Position_details 
-                WHERE Strategy_Results_ID=\'{s_r_id}\''''.format(s_r_id=strategy_results_id))
-        position_details = list(cur.fetchall())
+        position_details = load_positions(test_variable_range_id, strategy_results_id)
 
-        df = pd.read_sql_query("SELECT * FROM Market_Data", conn)
+        df = pd.read_sql_query('SELECT * FROM Market_Data WHERE Instrument_Period_ID = ? ORDER BY Market_Data_ID', 
+            conn, params=(instrument_period_id,))
         
         # Create dataframes for the MAs
         f_ma = 'MA'+ str(ma_length[0])
@@ -573,7 +1339,7 @@ def plot_chart(strategy_results_id):
         #{'direction': 'short', 'open_time': '2021-08-30 12:00:00', 'open_price': 47909.5, 'close_time': '2021-09-01 00:00:00', 'close_price': 47046.5, 'pnl': 0.018}
         # Create a figure the the price and MA data
         fig = go.Figure( data = [ go.Candlestick (
-            name='XBTUSD',
+            name=instrument_name,
             x=df['Timestamp'],
             open=df['Open'], high=df['High'],
             low=df['Low'], close=df['Close'],
@@ -649,26 +1415,91 @@ def plot_chart(strategy_results_id):
         fig.update_layout(xaxis_rangeslider_visible=False)
 
         #fig.show()
-        pio.write_html(fig, file='web/templates/ohcl_chart.html', auto_open=False, full_html=False)
+        config.ensure_dirs()
+        pio.write_html(fig, file=config.settings.chart_path, auto_open=False, full_html=False)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+
+def plot_surface(axes, z, x, y, title=''):
+    # Return an HTML heatmap of a slice of a test's PnL surface, as returned by surface.slice_surface
+
+    try:
+        import plotly.graph_objects as go
+        import plotly.io as pio
+        html = ''
+        # Show PNL as a percentage, like the results tables
+        z = [[None if v is None else round(v * 100, 2) for v in row] for row in z]
+        fig = go.Figure(data=go.Heatmap(x=axes[x], y=axes[y], z=z, colorscale='RdYlGn', zmid=0,
+                                        colorbar=dict(title='Total PNL %'),
+                                        hovertemplate=x + ': %{x}<br>' + y + ': %{y}<br>Total PNL: %{z}%<extra></extra>'))
+        fig.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+        html = pio.to_html(fig, include_plotlyjs='cdn', full_html=True)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return html
+
+
+def plot_portfolio(portfolio_summary):
+    # Return an HTML chart of a portfolio's equity above its drawdown, as returned by portfolio.simulate
+
+    try:
+        import plotly.graph_objects as go
+        import plotly.io as pio
+        from plotly.subplots import make_subplots
+        html = ''
+        fig = make_subplots(rows=2, cols=1, shared_xaxes=True, row_heights=[0.7, 0.3], vertical_spacing=0.05)
+        fig.add_trace(go.Scatter(x=portfolio_summary['timestamps'], y=portfolio_summary['equity'], 
+                                 line=dict(color='blue', width=2), name='Equity'), row=1, col=1)
+        # Show drawdown as a percentage of the capital, like the results tables
+        fig.add_trace(go.Scatter(x=portfolio_summary['timestamps'], 
+                                 y=[round(-v * 100, 2) for v in portfolio_summary['drawdown']], fill='tozeroy', 
+                                 line=dict(color='red', width=1), name='Drawdown %'), row=2, col=1)
+        fig.update_layout(title=f"{len(portfolio_summary['strategies'])} strategies, {portfolio_summary['allocation']} "
+                                f"allocation, Total PNL {round(portfolio_summary['total_pnl'] * 100, 2)}%, "
+                                f"max drawdown {round(portfolio_summary['max_drawdown'] * 100, 2)}%")
+        html = pio.to_html(fig, include_plotlyjs='cdn', full_html=True)
 
     except BaseException:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
         log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
 
+    return html
 
 def retrieve_top_strats(test_variable_range_id):
     # Retrieve the data for the top 50 strategies to show as a test summary
+    # Read the leaderboard saved when the test's run finished, or sort the test's results if there isn't one
+    # Pruned strategies aren't ranked, as their results stop at the bar they were pruned on
 
     try:
-        conn = db_connect()
+        top_strats = []
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return top_strats
         cur = conn.cursor()
-        query = f'''SELECT * FROM Strategy_Results 
-                    WHERE Test_Variable_Range_ID = {test_variable_range_id}
-                    ORDER BY Total_PNL DESC LIMIT 50'''
+        query = f'''SELECT sr.* FROM Test_Leaderboard lb
+                        JOIN Strategy_Results sr ON sr.Strategy_Results_ID = lb.Strategy_Results_ID
+                    WHERE lb.Test_Variable_Range_ID = {int(test_variable_range_id)} AND lb.Metric = 'total_pnl'
+                    ORDER BY lb.Rank LIMIT 50'''
         cur.execute(query)
+        res = list(cur.fetchall())
+        if not res:
+            query = f'''SELECT * FROM Strategy_Results 
+                        WHERE Test_Variable_Range_ID = {int(test_variable_range_id)} AND Pruned_Bar IS NULL
+                        ORDER BY Total_PNL DESC LIMIT 50'''
+            cur.execute(query)
+            res = list(cur.fetchall())
+
         # Map column names to field values in nested dictionary
-        res = list(cur.fetchall())       
+
         col = [desc[0].lower() for desc in cur.description]
         top_strats = []
 
@@ -699,22 +1530,26 @@ def retrieve_top_strats(test_variable_range_id):
 def retrieve_top_group_strats(test_variable_range_id):
     # Of the top 200 individual strategies, group those with the same fast_ma and slow_ma
     # Display the group's averages and how many individual results it has in the top 200
+    # Pruned strategies aren't ranked, as their results stop at the bar they were pruned on
 
     try:
-        conn = db_connect()
+        top_group_strats = []
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return top_group_strats
         cur = conn.cursor()
 
         query = f'''WITH cte_ma (f_ma, s_ma, sl, tp, tot_pnl) AS (
                     SELECT Fast_MA, Slow_MA, Stop_Loss, Take_Profit, Total_PNL
                     FROM Strategy_Results
-                    WHERE Test_Variable_Range_ID = {test_variable_range_id}
+                    WHERE Test_Variable_Range_ID = {test_variable_range_id} AND Pruned_Bar IS NULL
                     ORDER BY Total_PNL DESC
                     LIMIT 200),
 
                     cte_pnl (f_ma_p, s_ma_p, top_pnl) AS (
                     SELECT Fast_MA, Slow_MA, MAX(Total_PNL)
                     FROM Strategy_Results
-                    WHERE Test_Variable_Range_ID = {test_variable_range_id}
+                    WHERE Test_Variable_Range_ID = {test_variable_range_id} AND Pruned_Bar IS NULL
                     GROUP BY Fast_MA, Slow_MA)
 
                     SELECT m.f_ma as Fast_MA, m.s_ma as Slow_MA, 
@@ -757,9 +1592,53 @@ def retrieve_top_group_strats(test_variable_range_id):
     return top_group_strats
 
 
+def retrieve_group_details(test_variable_range_id, fast_ma, slow_ma):
+    # Retrieve every result of a group, the tests with the same fast_ma and slow_ma, best first
+
+    try:
+        group_details = []
+        conn = db_connect(test_variable_range_id)
+        if conn is None:
+            return group_details
+        cur = conn.cursor()
+        cur.execute(f''' SELECT *
+                        FROM Strategy_Results
+                        WHERE Test_Variable_Range_ID = ? AND
+                            Fast_MA = ? AND Slow_MA = ?
+                        ORDER BY Total_PNL DESC''', 
+                        (test_variable_range_id, fast_ma, slow_ma))
+            
+        # Map column names to field values in nested dictionary
+        rec_list = list(cur.fetchall())       
+        col = [desc[0].lower() for desc in cur.description]
+
+        # Change float from 0.05 to 5%
+        rec_list = [list(t) for t in rec_list]
+        for x in range(len(rec_list)):
+            rec_list[x][4] = str( round(rec_list[x][4]*100, 1)) + '%'
+            rec_list[x][5] = str( round(rec_list[x][5]*100, 1)) + '%'
+            rec_list[x][6] = str( round(rec_list[x][6]*100, 1)) + '%'
+
+        # Create a  strategy results dictionary
+        for row in rec_list:
+            dic = dict(zip(col, row))
+            group_details.append(dic)
+
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return group_details
+
+
 def cartesian_product(fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high, stop_loss_low, stop_loss_high,
-             take_profit_low, take_profit_high, instrument_period_dict, test_variable_range_id):
+             take_profit_low, take_profit_high, instrument_period_dict, test_variable_range_id, prune=None):
     # Combine the range of variables so that every possible permutation can be tested
+    # prune, the rules of pruning.make_rules or None, is sent with every combination
     
     try:
         # List variable ranges
@@ -780,7 +1659,7 @@ def cartesian_product(fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high, stop
         for x in range(len(cart_prod_list)):
             if cart_prod_list[x][3] >= cart_prod_list[x][2] + 0.01 and cart_prod_list[x][0] < cart_prod_list[x][1]:
                 variable_list.append((cart_prod_list[x][0], cart_prod_list[x][1], cart_prod_list[x][2], \
-                    cart_prod_list[x][3], instrument_period_dict, test_variable_range_id))
+                    cart_prod_list[x][3], instrument_period_dict, test_variable_range_id, prune))
         
 
         no_of_tests = len(variable_list)
@@ -793,14 +1672,18 @@ def cartesian_product(fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high, stop
     return variable_list, no_of_tests
 
 
-def run_test(cart_list):
-    # Multiprocessing is necessary to complete the tests in a timely fashion
-    # This function will be called by the run_tests function in \web\views.py using a pool of workers
-    
+def load_market_data(instrument_period_id=None):
+    # Retrieve the market data of an instrument period, or all of it, as a list of dictionaries,
+    # one per candle, keyed by lower case column name
+
     try:
         conn = db_connect()
         cur = conn.cursor()
-        cur.execute ('SELECT * FROM Market_Data')
+        if instrument_period_id is None:
+            cur.execute ('SELECT * FROM Market_Data')
+        else:
+            cur.execute ('SELECT * FROM Market_Data WHERE Instrument_Period_ID = ? ORDER BY Market_Data_ID', 
+                (instrument_period_id,))
         
         # Map column names to field values in nested dictionary
         rec_list = list(cur.fetchall())       
@@ -815,14 +1698,189 @@ def run_test(cart_list):
         if conn:
             conn.close()
 
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return rec_dict
+
+
+def run_test(cart_list):
+    # Multiprocessing is necessary to complete the tests in a timely fashion
+    # This function will be called by the run_tests function in \web\views.py using a pool of workers
+    # Return the seconds spent in each stage, so the parent process can gather metrics from every worker
+    
+    stage_timings = {'pid': os.getpid(), 'failed': True}
+    try:
+        start_tm = time.perf_counter()
+        rec_dict = load_market_data(cart_list[4]['instrument_period_id'])
+        stage_timings['data_load'] = time.perf_counter() - start_tm
+
         # Create an instance to start the test
-        Test_Strategy(rec_dict, cart_list[0], cart_list[1], cart_list[2], cart_list[3], cart_list[4], cart_list[5])
+        strategy = Test_Strategy(rec_dict, cart_list[0], cart_list[1], cart_list[2], cart_list[3], cart_list[4], cart_list[5],
+            cart_list[6])
+        stage_timings.update(strategy.timings)
+        # The test only counts as complete if its results reached the database
+        stage_timings['failed'] = not strategy.results_loaded
+        stage_timings['positions'] = len(strategy.short_position) + len(strategy.long_position)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return stage_timings
+
+
+# Market data of each instrument period, loaded once per worker process by compute_chunk
+market_data_cache = {}
+
+# The same market data as float arrays for the scan kernels
+market_arrays_cache = {}
+
+
+def run_chunk(chunk):
+    # Run a chunk of tests, given as (test_variable_range_id, chunk_no, [cart_list, ...]), and write the results
+    # of all of them with the chunk's Test_Chunk row in one transaction.  A chunk is either in the database
+    # completely or not at all, so a resumed run only has to rerun the chunks missing from Test_Chunk
+    # Return the stage timings of every test in the chunk, as run_test does for one test
+
+    timings_list, results_list = compute_chunk(chunk)
+    return write_chunk(chunk[0], chunk[1], len(chunk[2]), timings_list, results_list)
+
+
+def compute_chunk(chunk, kernel=None):
+    # Run the tests of a chunk without writing them.  Return the stage timings of every test and, in the same
+    # order, the Test_Strategy.results of every test, or None for the tests that failed
+    # Market data is read from market_data_cache, and loaded into it from the database if it isn't there
+    # Unless kernel is 'off', the tests that share moving averages are scanned together by kernels.scan_sub_grid
+
+    timings_list = []
+    results_list = []
+    try:
+        kernel = kernel or config.settings.kernel
+        cart_lists = chunk[2]
+        x = 0
+        while x < len(cart_lists):
+            cart_list = cart_lists[x]
+
+            start_tm = time.perf_counter()
+            instrument_period_id = cart_list[4]['instrument_period_id']
+            if instrument_period_id not in market_data_cache:
+                market_data_cache[instrument_period_id] = load_market_data(instrument_period_id)
+            rec_dict = market_data_cache[instrument_period_id]
+            data_load = time.perf_counter() - start_tm
+
+            if kernel == 'off':
+                sub_grid = [cart_list]
+                positions = [None]
+            else:
+                # The combinations are in moving average order, so the tests of a sub-grid are next to each other
+                sub_grid = [cart_list]
+                while x + len(sub_grid) < len(cart_lists) and \
+                    cart_lists[x + len(sub_grid)][:2] == cart_list[:2] and \
+                    cart_lists[x + len(sub_grid)][4]['instrument_period_id'] == instrument_period_id:
+                    sub_grid.append(cart_lists[x + len(sub_grid)])
+
+                start_tm = time.perf_counter()
+                if instrument_period_id not in market_arrays_cache:
+                    market_arrays_cache[instrument_period_id] = kernels.market_arrays(rec_dict)
+                arrays = market_arrays_cache[instrument_period_id]
+                data_load += time.perf_counter() - start_tm
+
+                # Share the time of the sub-grid's scans between its tests
+                start_tm = time.perf_counter()
+                signals = kernels.crossover_signals(arrays[f'ma{cart_list[0]}'], arrays[f'ma{cart_list[1]}'])
+                signal_tm = (time.perf_counter() - start_tm) / len(sub_grid)
+                start_tm = time.perf_counter()
+                positions = kernels.scan_sub_grid(rec_dict, arrays, signals, [v[2] for v in sub_grid], 
+                    [v[3] for v in sub_grid], kernel, cart_list[6])
+                exit_tm = (time.perf_counter() - start_tm) / len(sub_grid)
+
+            for v, pos in zip(sub_grid, positions):
+                stage_timings = {'pid': os.getpid(), 'failed': True, 'data_load': data_load}
+                timings_list.append(stage_timings)
+                results_list.append(None)
+                data_load = 0.0
+
+                strategy = Test_Strategy(rec_dict, v[0], v[1], v[2], v[3], v[4], v[5], v[6], persist=False, positions=pos)
+                stage_timings.update(strategy.timings)
+                if pos is not None:
+                    stage_timings['signal_scan'] = signal_tm
+                    stage_timings['exit_scan'] = exit_tm
+                stage_timings['positions'] = len(strategy.short_position) + len(strategy.long_position)
+                if strategy.results_computed:
+                    results_list[-1] = strategy.results()
+            x += len(sub_grid)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return timings_list, results_list
+
+
+def write_chunk(test_variable_range_id, chunk_no, no_of_tests, timings_list, results_list):
+    # Write the results of a chunk, as returned by compute_chunk, with its Test_Chunk row in one transaction
+    # Return the stage timings with the lock wait and write time added, and the written tests marked complete
+    # with a summary of their results for the leaderboard
+
+    try:
+        # compute_chunk stops at an unexpected exception, and gives None for a test that failed.  Leave the chunk to be
+        # rerun rather than mark it written without all its results
+        if len(results_list) != no_of_tests:
+            raise ValueError(f'Chunk {chunk_no} has results for {len(results_list)} of its {no_of_tests} tests')
+        failed = sum(1 for results in results_list if results is None)
+        if failed:
+            raise ValueError(f'Chunk {chunk_no} has {failed} failed tests of its {no_of_tests} tests')
+
+        written = list(zip(timings_list, results_list))
+
+        # Take the write lock before inserting, so time spent waiting on other workers is measured apart from the writes
+        start_tm = time.perf_counter()
+        conn = test_db_connect(test_variable_range_id)
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        lock_wait = time.perf_counter() - start_tm
+
+        # Mark the chunk first.  If it was already written, the primary key stops it being written twice
+        cur.execute('''INSERT INTO Test_Chunk (Test_Variable_Range_ID, Chunk_No, No_Of_Tests, Completed_Datetime) 
+                        VALUES (?, ?, ?, ?);''', 
+                    (test_variable_range_id, chunk_no, no_of_tests, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        summaries = []
+        for stage_timings, results in written:
+            start_tm = time.perf_counter()
+            strategy_results_id = insert_results(cur, test_variable_range_id, results)
+            stage_timings['db_write'] = time.perf_counter() - start_tm
+
+            # A summary for the parent's leaderboard:
+            # (strategy_results_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl, trades, wins, pruned_bar)
+            summaries.append((strategy_results_id,) + results[:5] + 
+                             (len(results[5]), sum(1 for p in results[5] if p[5] > 0.0), results[6]))
+
+        start_tm = time.perf_counter()
+        conn.commit()
+        commit_tm = time.perf_counter() - start_tm
+
+        # Share the lock wait and commit between the tests of the chunk
+        # Tests only count as complete once their results reached the database
+        for (stage_timings, results), summary in zip(written, summaries):
+            stage_timings['lock_wait'] = lock_wait / len(written)
+            stage_timings['db_write'] += commit_tm / len(written)
+            stage_timings['failed'] = False
+            stage_timings['result'] = summary
+
+        if conn:
+            conn.close()
 
     except BaseException:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
         log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
 
+    return timings_list
 
 
 # Only run when imported
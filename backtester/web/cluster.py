@@ -0,0 +1,252 @@
+import collections
+import multiprocessing as mp
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from . import backtester
+from . import exception_log
+
+
+# Seconds a worker waits before asking again when every remaining chunk is in flight on other workers
+WAIT_INTERVAL = 0.5
+
+# Seconds a worker keeps trying to connect to a coordinator that isn't listening yet
+CONNECT_TIMEOUT = 30.0
+
+
+def parse_address(address):
+    # Split 'host:port' into a (host, port) tuple
+
+    host, _, port = address.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+class Coordinator:
+    """ Serve the chunks of a test run to workers over TCP and queue the results they send back """
+
+
+    def __init__(self, chunks, market_data, address, authkey):
+        # market_data maps the instrument_period_id of every chunk to its candles, which workers fetch once each
+
+        self.pending = collections.deque(chunks)
+        self.market_data = market_data
+        self.in_flight = {}
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = {}
+        # Every worker that sent back results, including those that have since disconnected
+        self.served = set()
+        self.closed = False
+        self.listener = Listener(parse_address(address), authkey=authkey.encode())
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+
+    def accept(self):
+        # Start a thread for every worker that connects with the right authkey
+
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, mp.AuthenticationError):
+                continue
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+
+    def serve(self, conn):
+        # Answer one worker's requests until it disconnects.  Chunks it was running are handed to other workers
+
+        worker_chunks = set()
+        worker = None
+        try:
+            while True:
+                msg = conn.recv()
+                if msg[0] == 'hello':
+                    worker = msg[1]
+                    with self.lock:
+                        self.workers[worker] = 0
+                    conn.send(True)
+
+                elif msg[0] == 'market_data':
+                    conn.send(self.market_data[msg[1]])
+
+                elif msg[0] == 'chunk':
+                    conn.send(self.next_chunk(worker_chunks))
+
+                elif msg[0] == 'results':
+                    chunk_no, timings_list, results_list = msg[1:]
+                    with self.lock:
+                        worker_chunks.discard(chunk_no)
+                        self.workers[worker] += 1
+                        self.served.add(worker)
+                        self.results.put((self.in_flight.pop(chunk_no), timings_list, results_list))
+                    conn.send(True)
+
+        except (EOFError, OSError):
+            pass
+
+        finally:
+            with self.lock:
+                for chunk_no in worker_chunks:
+                    self.pending.appendleft(self.in_flight.pop(chunk_no))
+                self.workers.pop(worker, None)
+            conn.close()
+
+
+    def next_chunk(self, worker_chunks):
+        # Return the next chunk, 'wait' if the remaining chunks are all in flight, or None once the run is over
+
+        with self.lock:
+            if self.closed:
+                return None
+            if self.pending:
+                chunk = self.pending.popleft()
+                self.in_flight[chunk[1]] = chunk
+                worker_chunks.add(chunk[1])
+                return chunk
+            return 'wait' if self.in_flight else None
+
+
+    def connected_workers(self):
+
+        with self.lock:
+            return len(self.workers)
+
+
+    def close(self):
+        # Stop handing out chunks.  Workers disconnect when they next ask for one
+        # Connect once more to wake the accept thread, so it sees the coordinator is closed and the port is freed
+
+        with self.lock:
+            self.closed = True
+        try:
+            socket.create_connection(self.listener.address, timeout=1.0).close()
+        except OSError:
+            pass
+        self.thread.join(timeout=1.0)
+        self.listener.close()
+
+
+def run_coordinator(chunks, run_metrics, address, authkey, progress=None, progress_interval=1.0):
+    # Serve the chunks to workers on other processes or hosts and write their results as they arrive
+    # The results of a chunk are written with its Test_Chunk row, the same way run_chunk writes them
+    # Return the number of workers that ran chunks
+
+    coordinator = None
+    workers = 0
+    try:
+        # Workers fetch the candles of each instrument period once, rather than reading the database
+        market_data = {}
+        for chunk in chunks:
+            for cart_list in chunk[2]:
+                instrument_period_id = cart_list[4]['instrument_period_id']
+                if instrument_period_id not in market_data:
+                    market_data[instrument_period_id] = backtester.load_market_data(instrument_period_id)
+
+        coordinator = Coordinator(chunks, market_data, address, authkey)
+        last_progress = time.monotonic()
+        for _ in range(len(chunks)):
+            while True:
+                try:
+                    chunk, timings_list, results_list = coordinator.results.get(timeout=progress_interval)
+                    break
+                except queue.Empty:
+                    if progress:
+                        progress(dict(run_metrics.progress_stats(), workers=coordinator.connected_workers()))
+                        last_progress = time.monotonic()
+
+            run_metrics.record_chunk(backtester.write_chunk(chunk[0], chunk[1], len(chunk[2]), timings_list,
+                results_list))
+            if progress and time.monotonic() - last_progress >= progress_interval:
+                progress(dict(run_metrics.progress_stats(), workers=coordinator.connected_workers()))
+                last_progress = time.monotonic()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    finally:
+        if coordinator:
+            workers = len(coordinator.served)
+            coordinator.close()
+
+    return workers
+
+
+def connect(address, authkey, timeout=CONNECT_TIMEOUT):
+    # Connect to a coordinator, waiting up to timeout seconds for it to start listening
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(parse_address(address), authkey=authkey.encode())
+        except ConnectionRefusedError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(WAIT_INTERVAL)
+
+
+def work(address, authkey, log_queue=None):
+    # Run chunks from a coordinator until it has none left.  Return the number of chunks run
+    # Only the results are sent back, as tuples; the coordinator writes them to its database
+
+    chunks_run = 0
+    try:
+        exception_log.init_worker(log_queue)
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        conn = connect(address, authkey)
+        conn.send(('hello', worker))
+        conn.recv()
+
+        while True:
+            conn.send(('chunk',))
+            chunk = conn.recv()
+            if chunk is None:
+                break
+            if chunk == 'wait':
+                time.sleep(WAIT_INTERVAL)
+                continue
+
+            # Fetch the candles the first time an instrument period is tested by this worker
+            for cart_list in chunk[2]:
+                instrument_period_id = cart_list[4]['instrument_period_id']
+                if instrument_period_id not in backtester.market_data_cache:
+                    conn.send(('market_data', instrument_period_id))
+                    backtester.market_data_cache[instrument_period_id] = conn.recv()
+
+            timings_list, results_list = backtester.compute_chunk(chunk)
+            for stage_timings in timings_list:
+                stage_timings['pid'] = worker
+            conn.send(('results', chunk[1], timings_list, results_list))
+            conn.recv()
+            chunks_run += 1
+
+        conn.close()
+
+    except (EOFError, ConnectionResetError):
+        # The coordinator finished or stopped
+        pass
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return chunks_run
+
+
+def run_workers(address, authkey, processes=1):
+    # Start processes that each work on chunks from the coordinator at address, and wait for them to finish
+
+    log_queue = exception_log.start_listener()
+    procs = [mp.Process(target=work, args=(address, authkey, log_queue)) for _ in range(processes)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return [proc.exitcode for proc in procs]
@@ -0,0 +1,136 @@
+import configparser
+import os
+import psutil
+
+
+# Folder of the web package.  The market data and database live in its database folder unless configured otherwise
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Config file read when BACKTESTER_CONFIG isn't set, next to main.py
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(PACKAGE_DIR), 'backtester.ini')
+
+# Environment variables override the [backtester] section of the config file, which overrides the defaults
+ENV_VARS = {'data_dir': 'BACKTESTER_DATA_DIR',
+            'raw_file': 'BACKTESTER_RAW_FILE',
+            'db_path': 'BACKTESTER_DB_PATH',
+            'tests_dir': 'BACKTESTER_TESTS_DIR',
+            'archive_dir': 'BACKTESTER_ARCHIVE_DIR',
+            'cache_dir': 'BACKTESTER_CACHE_DIR',
+            'log_path': 'BACKTESTER_LOG_PATH',
+            'workers': 'BACKTESTER_WORKERS',
+            'cluster_address': 'BACKTESTER_CLUSTER_ADDRESS',
+            'cluster_authkey': 'BACKTESTER_CLUSTER_AUTHKEY',
+            'kernel': 'BACKTESTER_KERNEL',
+            'result_cache_size': 'BACKTESTER_RESULT_CACHE_SIZE'}
+
+PATH_SETTINGS = ['data_dir', 'db_path', 'tests_dir', 'archive_dir', 'cache_dir', 'log_path']
+
+
+class Settings:
+    """ Locations of the market data, databases, caches and log, the number of pool workers, the cluster address,
+        the exit scan kernel and the size of the result cache """
+
+
+    def __init__(self, data_dir, raw_file, db_path, cache_dir, log_path, workers, cluster_address='127.0.0.1:5055',
+                 cluster_authkey=None, kernel='auto', tests_dir=None, archive_dir=None,
+                 result_cache_size=64):
+
+        self.data_dir = data_dir
+        self.raw_file = raw_file
+        self.db_path = db_path
+        # The results of each test are kept in their own database file in tests_dir, and moved to archive_dir to archive
+        self.tests_dir = tests_dir or os.path.join(os.path.dirname(db_path), 'tests')
+        self.archive_dir = archive_dir or os.path.join(os.path.dirname(db_path), 'archive')
+        self.cache_dir = cache_dir
+        self.log_path = log_path
+        self.workers = workers
+        self.cluster_address = cluster_address
+        self.cluster_authkey = cluster_authkey
+        self.kernel = kernel
+        # Query results kept in memory by the web app, see result_cache.py
+        self.result_cache_size = result_cache_size
+
+
+    @property
+    def raw_path(self):
+        # Raw market data csv file
+
+        return os.path.join(self.data_dir, self.raw_file)
+
+
+    @property
+    def chart_path(self):
+        # HTML chart written by backtester.plot_chart
+
+        return os.path.join(self.cache_dir, 'ohcl_chart.html')
+
+
+    def to_dict(self):
+
+        return {'data_dir': self.data_dir, 'raw_file': self.raw_file, 'db_path': self.db_path,
+                'tests_dir': self.tests_dir, 'archive_dir': self.archive_dir, 'cache_dir': self.cache_dir, 'log_path': self.log_path, 'workers': self.workers,
+                'cluster_address': self.cluster_address, 'kernel': self.kernel,
+                'result_cache_size': self.result_cache_size}
+
+
+def resolve_path(path, base_dir):
+    # Expand ~ and environment variables, and make relative paths relative to base_dir
+
+    path = os.path.expandvars(os.path.expanduser(path))
+    if not os.path.isabs(path):
+        path = os.path.join(base_dir, path)
+    return os.path.normpath(path)
+
+
+def load(config_path=None):
+    # Read the settings from the environment, the config file and the defaults, in that order of precedence
+
+    config_path = config_path or os.environ.get('BACKTESTER_CONFIG') or DEFAULT_CONFIG_PATH
+    vals = {}
+
+    # Relative paths in the config file are relative to the config file
+    if os.path.exists(config_path):
+        parser = configparser.ConfigParser()
+        parser.read(config_path)
+        if parser.has_section('backtester'):
+            config_dir = os.path.dirname(os.path.abspath(config_path))
+            for key in ENV_VARS:
+                if parser.has_option('backtester', key):
+                    val = parser.get('backtester', key)
+                    vals[key] = resolve_path(val, config_dir) if key in PATH_SETTINGS else val
+
+    # Relative paths in environment variables are relative to the current directory
+    for key, env_var in ENV_VARS.items():
+        val = os.environ.get(env_var)
+        if val:
+            vals[key] = resolve_path(val, os.getcwd()) if key in PATH_SETTINGS else val
+
+    data_dir = vals.get('data_dir', os.path.join(PACKAGE_DIR, 'database'))
+    db_path = vals.get('db_path', os.path.join(data_dir, 'backtester_database.db'))
+    cache_dir = vals.get('cache_dir', os.path.join(os.path.dirname(db_path), 'cache'))
+    log_path = vals.get('log_path', os.path.join(os.path.dirname(db_path), 'backtester_exceptions.log'))
+    workers = int(vals.get('workers') or psutil.cpu_count(logical=False) or 1)
+
+    return Settings(data_dir, vals.get('raw_file', 'xbtusd_4h_raw.csv'), db_path, cache_dir, log_path, workers,
+                    vals.get('cluster_address', '127.0.0.1:5055'), vals.get('cluster_authkey'), vals.get('kernel', 'auto'),
+                    vals.get('tests_dir'), vals.get('archive_dir'), int(vals.get('result_cache_size') or 64))
+
+
+def reload(config_path=None):
+    # Re-read the settings, e.g. after changing the environment variables
+
+    global settings
+    settings = load(config_path)
+    return settings
+
+
+def ensure_dirs():
+    # Create the folders the settings point to
+
+    for path in [os.path.dirname(settings.db_path), settings.tests_dir, settings.cache_dir, 
+                 os.path.dirname(settings.log_path)]:
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+
+settings = load()
@@ -0,0 +1,231 @@
+import atexit
+import json
+import multiprocessing as mp
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from . import config
+
+
+# Write buffered records to the log file once this many are waiting, or after FLUSH_INTERVAL seconds
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 1.0
+
+# Rotate the log file when it grows past MAX_BYTES, keeping BACKUP_COUNT old files
+MAX_BYTES = 5 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# Write at most RATE_LIMIT records with the same exception, description and location every RATE_WINDOW seconds
+# The rest are counted and reported in one summary record when the window ends
+RATE_LIMIT = 5
+RATE_WINDOW = 60.0
+
+
+def default_log_path():
+
+    config.ensure_dirs()
+    return config.settings.log_path
+
+
+class Rate_Limiter:
+    """ Suppress repeated records so an error storm can't flood the log """
+
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW):
+
+        self.limit = limit
+        self.window = window
+        # key: [window start, records seen, sample record]
+        self.seen = {}
+        # Summaries of windows that ended when a new record started the next one, until expired returns them
+        self.pending = []
+
+
+    def allow(self, rec, now):
+        # Return True if the record should be written
+
+        key = (rec.get('exception'), rec.get('description'), rec.get('file_name'), rec.get('line_number'))
+        state = self.seen.get(key)
+        if state is None or now - state[0] >= self.window:
+            # Keep the summary of the window that ended, so a storm that never pauses still reports its count
+            if state is not None and state[1] > self.limit:
+                self.pending.append(self.summary(state[2], state[1]))
+            self.seen[key] = [now, 1, rec]
+            return True
+        state[1] += 1
+        return state[1] <= self.limit
+
+
+    def summary(self, rec, cnt):
+
+        summary = dict(rec)
+        summary['datetime'] = datetime.now().isoformat(timespec='seconds')
+        summary['suppressed'] = cnt - self.limit
+        return summary
+
+
+    def expired(self, now):
+        # Return summary records for windows that have ended with suppressed records, and forget those windows
+
+        summaries, self.pending = self.pending, []
+        for key, (start, cnt, rec) in list(self.seen.items()):
+            if now - start >= self.window:
+                if cnt > self.limit:
+                    summaries.append(self.summary(rec, cnt))
+                del self.seen[key]
+        return summaries
+
+
+class Log_Writer:
+    """ Append JSON lines to the log file in batches and rotate it by size """
+
+
+    def __init__(self, log_path, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer = []
+
+
+    def add(self, rec):
+
+        self.buffer.append(json.dumps(rec, default=str))
+
+
+    def flush(self):
+
+        if not self.buffer:
+            return
+        with open(self.log_path, 'a') as f:
+            f.write('\n'.join(self.buffer) + '\n')
+            size = f.tell()
+        self.buffer = []
+        if self.max_bytes and size >= self.max_bytes:
+            self.rotate()
+
+
+    def rotate(self):
+        # backtester_exceptions.log becomes .1, .1 becomes .2 and so on.  The oldest file is removed
+
+        for x in range(self.backup_count - 1, 0, -1):
+            src = f'{self.log_path}.{x}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.log_path}.{x+1}')
+        if self.backup_count > 0:
+            os.replace(self.log_path, f'{self.log_path}.1')
+        else:
+            os.remove(self.log_path)
+
+
+class Log_Listener:
+    """ Thread in the parent process that is the only writer of the log file """
+
+
+    def __init__(self, log_queue, log_path, echo=True):
+
+        self.queue = log_queue
+        self.writer = Log_Writer(log_path)
+        self.limiter = Rate_Limiter()
+        self.echo = echo
+        self.thread = threading.Thread(target=self.listen, name='exception-log-listener', daemon=True)
+
+
+    def start(self):
+
+        self.thread.start()
+
+
+    def stop(self):
+        # Write everything still in the queue, then end the thread
+
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def write(self, rec):
+
+        self.writer.add(rec)
+        if self.echo:
+            print(' ~ An exception has occurred ~ ' + ' | '.join(f'{k}: {v}' for k, v in rec.items()), file=sys.stderr)
+
+
+    def listen(self):
+
+        last_flush = time.monotonic()
+        while True:
+            try:
+                rec = self.queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                rec = False
+            except (EOFError, OSError):
+                rec = None
+
+            now = time.monotonic()
+            if rec and self.limiter.allow(rec, now):
+                self.write(rec)
+
+            if rec is None or len(self.writer.buffer) >= BATCH_SIZE or now - last_flush >= FLUSH_INTERVAL:
+                # Report suppressed records for the rate limit windows that have ended
+                for summary in self.limiter.expired(now if rec is not None else float('inf')):
+                    self.write(summary)
+                try:
+                    self.writer.flush()
+                except OSError as e:
+                    print(f' ~ Unable to write to {self.writer.log_path}: {e}', file=sys.stderr)
+                    self.writer.buffer = []
+                last_flush = now
+
+            if rec is None:
+                return
+
+
+# Queue shared by the parent process and its pool workers, and the parent's listener
+_queue = None
+_listener = None
+_lock = threading.Lock()
+
+
+def start_listener(log_path=None):
+    # Start the log listener in this process and return the queue that workers should write to
+    # Pass the queue to pool workers with init_worker, or let forked workers inherit it
+
+    global _queue, _listener
+
+    with _lock:
+        if _listener is None:
+            _queue = mp.Queue()
+            _listener = Log_Listener(_queue, log_path or default_log_path())
+            _listener.start()
+            atexit.register(stop_listener)
+    return _queue
+
+
+def stop_listener():
+
+    global _listener
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def init_worker(log_queue):
+    # Send this process's records to the parent's listener
+
+    global _queue
+    if log_queue is not None:
+        _queue = log_queue
+
+
+def log(rec):
+    # Queue a record for the listener.  Start a listener in this process if no queue has been set up
+
+    log_queue = _queue if _queue is not None else start_listener()
+    rec.setdefault('datetime', datetime.now().isoformat(timespec='seconds'))
+    rec.setdefault('pid', os.getpid())
+    log_queue.put(rec)
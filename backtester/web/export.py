@@ -0,0 +1,202 @@
+import csv
+import importlib.util
+import io
+import os
+import re
+import sys
+import urllib.parse
+from . import backtester
+from . import positions
+
+# pyarrow is optional.  Without it results can only be exported as csv
+# It is only imported when a parquet file is written, so the app and command line runner start without it
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+# Export formats, and the tables of a test that can be exported
+FORMATS = ['csv', 'parquet']
+TABLES = ['strategy_results', 'position_details']
+
+# Rows fetched from the cursor at a time.  Memory use depends on this, not on the size of the test
+CHUNK_SIZE = 10000
+
+# Columns of each export, and their parquet types.  Positions are decoded to times and prices
+# pruned_bar is the bar a pruned combination was stopped on, so its total_pnl only covers the bars before it,
+# and empty for combinations tested over every bar
+COLUMNS = {
+    'strategy_results': [('strategy_results_id', 'int64'), ('fast_ma', 'int64'), ('slow_ma', 'int64'),
+                         ('stop_loss', 'float64'), ('take_profit', 'float64'), ('total_pnl', 'float64'),
+                         ('pruned_bar', 'int64')],
+    'position_details': [('position_details_id', 'int64'), ('strategy_results_id', 'int64'), ('direction', 'string'),
+                         ('open_time', 'string'), ('open_price', 'float64'), ('close_time', 'string'),
+                         ('close_price', 'float64'), ('pnl', 'float64')],
+}
+
+
+def check_format(fmt, table='strategy_results'):
+    # Raise ValueError for an unknown table or format, or ImportError for parquet without pyarrow
+
+    if table not in TABLES:
+        raise ValueError(f"table must be one of {', '.join(TABLES)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if fmt == 'parquet' and not HAS_PYARROW:
+        raise ImportError('Exporting parquet needs pyarrow, pip install pyarrow')
+
+
+def file_name(test_variable_range_id, test_name, table, fmt):
+    # Name of a table's export file.  Test names are free text, so only the safe ASCII part of the name is used,
+    # or test_<id> if nothing is left of it, and the file is always written inside the export folder
+
+    from werkzeug.utils import secure_filename
+    return f'{secure_filename(test_name) or f"test_{int(test_variable_range_id)}"}_{table}.{fmt}'
+
+
+def content_disposition(test_variable_range_id, test_name, table, fmt):
+    # Content-Disposition header of a download.  filename is the safe ASCII name, and filename* the test's own
+    # name, UTF-8 encoded, without the characters that can't be in a file name
+
+    name = re.sub(r'[\x00-\x1f\x7f/\\:*?"<>|]', '_', test_name).strip(' .') or f'test_{int(test_variable_range_id)}'
+    return (f'attachment; filename="{file_name(test_variable_range_id, test_name, table, fmt)}"; '
+            f"filename*=UTF-8''{urllib.parse.quote(f'{name}_{table}.{fmt}', safe='')}")
+
+
+def iter_rows(test_variable_range_id, table, chunk_size=CHUNK_SIZE):
+    # Yield the rows of a test's table as lists of at most chunk_size tuples, read with one cursor
+    # The connection stays open until the last chunk is read, or the generator is closed
+    # A test without a database file has no rows
+
+    conn = backtester.db_connect(test_variable_range_id)
+    if conn is None:
+        return
+    try:
+        cur = conn.cursor()
+        timestamps = None
+        if table == 'position_details':
+            # Candle times to decode the bars of positions with
+            cur.execute('''SELECT m.Timestamp FROM Test_Variable_Range t
+                                JOIN Market_Data m ON m.Instrument_Period_ID = t.Instrument_Period_ID
+                            WHERE t.Test_Variable_Range_ID = ? ORDER BY m.Market_Data_ID''', (test_variable_range_id,))
+            timestamps = [row[0] for row in cur.fetchall()]
+            cur.execute('''SELECT Position_Details_ID, Strategy_Results_ID, Direction, Open_Bar, Open_Price, Close_Bar,
+                            Close_Price, PNL FROM Position_Details ORDER BY Position_Details_ID''')
+        else:
+            cur.execute('''SELECT Strategy_Results_ID, Fast_MA, Slow_MA, Stop_Loss, Take_Profit, Total_PNL, Pruned_Bar
+                            FROM Strategy_Results ORDER BY Strategy_Results_ID''')
+
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            if timestamps is not None:
+                rows = [row[:2] + positions.decode(row[2:], timestamps) for row in rows]
+            yield rows
+
+    finally:
+        conn.close()
+
+
+def iter_csv(test_variable_range_id, table, chunk_size=CHUNK_SIZE):
+    # Yield a test's table as csv text, a chunk of rows at a time
+
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow([col for col, _ in COLUMNS[table]])
+    for rows in iter_rows(test_variable_range_id, table, chunk_size):
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+class Chunk_Sink:
+    """ Write-only file for pyarrow that hands back what was written since it was last emptied """
+
+
+    def __init__(self):
+
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+
+    def write(self, data):
+
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+
+    def tell(self):
+
+        return self.position
+
+
+    def flush(self):
+
+        pass
+
+
+    def close(self):
+
+        self.closed = True
+
+
+    def empty(self):
+
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_parquet(test_variable_range_id, table, chunk_size=CHUNK_SIZE):
+    # Yield a test's table as a parquet file, one row group per chunk of rows
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(col, getattr(pa, col_type)()) for col, col_type in COLUMNS[table]])
+    sink = Chunk_Sink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in iter_rows(test_variable_range_id, table, chunk_size):
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays([pa.array(columns[n], type=field.type)
+                                                 for n, field in enumerate(schema)], schema=schema))
+        yield sink.empty()
+    writer.close()
+    yield sink.empty()
+
+
+def iter_export(test_variable_range_id, table, fmt, chunk_size=CHUNK_SIZE):
+    # Yield a test's table in the export format, for a streamed response or to write to a file
+
+    check_format(fmt, table)
+    if fmt == 'parquet':
+        return iter_parquet(test_variable_range_id, table, chunk_size)
+    return iter_csv(test_variable_range_id, table, chunk_size)
+
+
+def export_test(test_variable_range_id, test_name, fmt='csv', tables=('strategy_results',), out_dir='.'):
+    # Write tables of a test to files in out_dir.  Return {table: (path, bytes written)}
+
+    try:
+        written = {}
+        check_format(fmt)
+        os.makedirs(out_dir, exist_ok=True)
+        for table in tables:
+            path = os.path.join(out_dir, file_name(test_variable_range_id, test_name, table, fmt))
+            size = 0
+            with open(path, 'wb') as f:
+                for data in iter_export(test_variable_range_id, table, fmt):
+                    data = data.encode() if isinstance(data, str) else data
+                    f.write(data)
+                    size += len(data)
+            written[table] = (path, size)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+        written = None
+
+    return written
@@ -0,0 +1,219 @@
+import importlib.util
+import numpy as np
+from . import pruning
+
+# Numba is optional.  Without it the same kernel runs as plain Python on lists
+# It takes longer to import than a small grid takes to run, so it is only imported when the kernel is first compiled
+HAS_NUMBA = importlib.util.find_spec('numba') is not None
+
+
+# How a position was closed, as returned by scan_exits
+EXIT_END, EXIT_STOP_LOSS, EXIT_TAKE_PROFIT = 0, 1, 2
+
+# Ways to scan a test's exits.  'auto' uses numba when it is installed, 'off' uses Test_Strategy's own loop
+KERNELS = ['auto', 'numba', 'python', 'off']
+
+
+def scan_exits(signal, next_signal, open_, high, low, stop_losses, take_profits, max_trades,
+               max_drawdown, min_pnl, checkpoint_bars,
+               directions, open_idxs, close_idxs, close_prices, exits, no_of_trades, pruned_bars):
+    # Walk the market data once for every stop loss / take profit pair of a sub-grid that shares its moving averages
+    # Positions are opened and closed exactly as Test_Strategy.open_position and close_position do
+    # The trades of pair c are written to rows c*max_trades onwards of the output arrays, and their count to no_of_trades[c]
+    # A pair is stopped early by the pruning rules, see pruning.tripped, and the candle it stopped on written to
+    # pruned_bars[c], which is otherwise left at -1
+
+    n = len(open_)
+    for c in range(len(stop_losses)):
+        stop_loss = stop_losses[c]
+        take_profit = take_profits[c]
+        row = c * max_trades
+        idx = 0
+        pnl = 0.0
+        peak = 0.0
+        while idx < n - 2:
+            # Open on the candle after the next crossover, if there is one early enough to leave a candle to open on
+            sig_idx = next_signal[idx]
+            if sig_idx >= n - 2:
+                break
+            direction = signal[sig_idx]
+            open_idx = sig_idx + 2
+            open_price = open_[open_idx]
+            directions[row] = direction
+            open_idxs[row] = open_idx
+
+            # Close at the end of the market data unless the stop loss or take profit is hit first
+            exits[row] = EXIT_END
+            close_idxs[row] = n - 1
+            idx = n
+
+            # Exchange price increments are 0.5, so round off the exit prices
+            if direction < 0:
+                sl_price = round(open_price * (1.0 + stop_loss) * 2) / 2
+                tp_price = round(open_price * (1.0 - take_profit) * 2) / 2
+                for x in range(open_idx, n - 1):
+                    if high[x] >= sl_price:
+                        exits[row] = EXIT_STOP_LOSS
+                        close_prices[row] = sl_price
+                        close_idxs[row] = x
+                        idx = x + 1
+                        break
+                    elif low[x] <= tp_price:
+                        exits[row] = EXIT_TAKE_PROFIT
+                        close_prices[row] = tp_price
+                        close_idxs[row] = x
+                        idx = x + 1
+                        break
+            else:
+                sl_price = round(open_price * (1.0 - stop_loss) * 2) / 2
+                tp_price = round(open_price * (1.0 + take_profit) * 2) / 2
+                for x in range(open_idx, n - 1):
+                    if low[x] <= sl_price:
+                        exits[row] = EXIT_STOP_LOSS
+                        close_prices[row] = sl_price
+                        close_idxs[row] = x
+                        idx = x + 1
+                        break
+                    elif high[x] >= tp_price:
+                        exits[row] = EXIT_TAKE_PROFIT
+                        close_prices[row] = tp_price
+                        close_idxs[row] = x
+                        idx = x + 1
+                        break
+
+            row += 1
+
+            # Positions closed at the end of the market data are the last, so there's nothing left to prune
+            if exits[row - 1] != EXIT_END:
+                pnl += -stop_loss if exits[row - 1] == EXIT_STOP_LOSS else take_profit
+                peak = max(peak, pnl)
+                if peak - pnl > max_drawdown or (close_idxs[row - 1] >= checkpoint_bars and pnl < min_pnl):
+                    pruned_bars[c] = close_idxs[row - 1]
+                    break
+        no_of_trades[c] = row - c * max_trades
+
+
+# scan_exits compiled by numba the first time it's called, and cached on disk for later processes, see jit_kernel
+scan_exits_jit = None
+
+
+def jit_kernel():
+    # Return scan_exits compiled by numba, importing numba and compiling it, or loading it from numba's cache,
+    # the first time it is needed in this process
+
+    global scan_exits_jit
+    if scan_exits_jit is None:
+        import numba
+        scan_exits_jit = numba.njit(cache=True, nogil=True)(scan_exits)
+    return scan_exits_jit
+
+
+def resolve_kernel(kernel):
+    # The kernel that will actually run for a kernel setting
+
+    if kernel == 'auto':
+        return 'numba' if HAS_NUMBA else 'python'
+    if kernel == 'numba' and not HAS_NUMBA:
+        raise ImportError('The numba kernel was requested, but numba is not installed')
+    return kernel
+
+
+def market_arrays(rec_dict):
+    # Columns of the market data as float arrays, so they can be passed to the compiled kernel
+
+    return {col: np.array([rec[col] for rec in rec_dict], dtype=np.float64) for col in rec_dict[0]
+            if col not in ('timestamp', 'market_data_id', 'instrument_period_id')}
+
+
+def crossover_signals(fast, slow):
+    # Return the crossover of every candle, -1 to short or 1 to go long on the open two candles later, or 0,
+    # and for every candle the index of the next candle with a crossover, or len(fast) if there are none
+    # Uses the same strict comparisons as Test_Strategy.open_position, which only searches up to len(fast) - 3
+
+    n = len(fast)
+    signal = np.zeros(n, dtype=np.int64)
+    signal[:-1][(fast[:-1] > slow[:-1]) & (fast[1:] < slow[1:])] = -1
+    signal[:-1][(fast[:-1] < slow[:-1]) & (fast[1:] > slow[1:])] = 1
+    signal[max(n - 2, 0):] = 0
+
+    sig_idxs = np.append(np.flatnonzero(signal), n)
+    next_signal = sig_idxs[np.searchsorted(sig_idxs, np.arange(n))]
+    return signal, next_signal
+
+
+def scan_sub_grid(rec_dict, arrays, signals, stop_losses, take_profits, kernel='auto', prune=None):
+    # Find the positions of every stop loss / take profit pair for one pair of moving averages in one kernel call
+    # signals is the pair returned by crossover_signals for the moving averages, prune the rules of pruning.make_rules
+    # Return (short_position, long_position, pruned_bar) per stop loss / take profit pair, the same lists
+    # Test_Strategy builds, so its results are identical, and the candle the pair was pruned on or None
+
+    kernel = resolve_kernel(kernel)
+    signal, next_signal = signals
+    max_drawdown, min_pnl, checkpoint_bars = pruning.limits(prune)
+    no_of_pairs = len(stop_losses)
+    # Every trade is opened on a different crossover
+    max_trades = max(1, int(np.count_nonzero(signal)))
+
+    if kernel == 'numba':
+        directions = np.zeros(no_of_pairs * max_trades, dtype=np.int64)
+        open_idxs = np.zeros(no_of_pairs * max_trades, dtype=np.int64)
+        close_idxs = np.zeros(no_of_pairs * max_trades, dtype=np.int64)
+        close_prices = np.zeros(no_of_pairs * max_trades, dtype=np.float64)
+        exits = np.zeros(no_of_pairs * max_trades, dtype=np.int64)
+        no_of_trades = np.zeros(no_of_pairs, dtype=np.int64)
+        pruned_bars = np.full(no_of_pairs, -1, dtype=np.int64)
+        jit_kernel()(signal, next_signal, arrays['open'], arrays['high'], arrays['low'],
+                       np.array(stop_losses, dtype=np.float64), np.array(take_profits, dtype=np.float64), max_trades,
+                       float(max_drawdown), float(min_pnl), int(checkpoint_bars),
+                       directions, open_idxs, close_idxs, close_prices, exits, no_of_trades, pruned_bars)
+
+        # Keep only the rows that were written, as Python numbers
+        used = np.concatenate([np.arange(c * max_trades, c * max_trades + no_of_trades[c]) for c in range(no_of_pairs)])
+        trades = list(zip(directions[used].tolist(), open_idxs[used].tolist(), close_idxs[used].tolist(), 
+                          close_prices[used].tolist(), exits[used].tolist()))
+        no_of_trades = no_of_trades.tolist()
+        pruned_bars = pruned_bars.tolist()
+
+    else:
+        # Python lists are much faster than numpy arrays to index one item at a time
+        directions = [0] * (no_of_pairs * max_trades)
+        open_idxs = [0] * (no_of_pairs * max_trades)
+        close_idxs = [0] * (no_of_pairs * max_trades)
+        close_prices = [0.0] * (no_of_pairs * max_trades)
+        exits = [0] * (no_of_pairs * max_trades)
+        no_of_trades = [0] * no_of_pairs
+        pruned_bars = [-1] * no_of_pairs
+        scan_exits(signal.tolist(), next_signal.tolist(), arrays['open'].tolist(), arrays['high'].tolist(),
+                   arrays['low'].tolist(), list(stop_losses), list(take_profits), max_trades,
+                   max_drawdown, min_pnl, checkpoint_bars,
+                   directions, open_idxs, close_idxs, close_prices, exits, no_of_trades, pruned_bars)
+        trades = [(directions[row], open_idxs[row], close_idxs[row], close_prices[row], exits[row])
+                  for c in range(no_of_pairs) for row in range(c * max_trades, c * max_trades + no_of_trades[c])]
+
+    # Build the position dictionaries from the candles, so prices and times are the stored values
+    positions = []
+    last = rec_dict[-1]
+    start = 0
+    for c in range(no_of_pairs):
+        short_position = []
+        long_position = []
+        for direction, open_idx, close_idx, close_price, exit in trades[start:start + no_of_trades[c]]:
+            open_rec = rec_dict[open_idx]
+            open_price = open_rec['open']
+            if exit == EXIT_STOP_LOSS:
+                pnl = -stop_losses[c]
+            elif exit == EXIT_TAKE_PROFIT:
+                pnl = take_profits[c]
+            elif direction < 0:
+                close_price, pnl = last['close'], round((open_price - last['close']) / open_price, 4)
+            else:
+                close_price, pnl = last['close'], round((last['close'] - open_price) / open_price, 4)
+
+            position = {'direction': 'short' if direction < 0 else 'long', 'open_time': open_rec['timestamp'],
+                        'open_price': open_price, 'close_time': rec_dict[close_idx]['timestamp'],
+                        'close_price': close_price, 'pnl': pnl, 'open_bar': open_idx, 'close_bar': close_idx}
+            (short_position if direction < 0 else long_position).append(position)
+        positions.append((short_position, long_position, pruned_bars[c] if pruned_bars[c] >= 0 else None))
+        start += no_of_trades[c]
+
+    return positions
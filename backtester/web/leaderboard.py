@@ -0,0 +1,61 @@
+import heapq
+import threading
+
+
+# Metrics results are ranked by, highest first
+METRICS = ['total_pnl', 'win_rate', 'avg_pnl']
+
+# Results kept per metric.  The results page shows the top 50, the group results use the top 200
+TOP_K = 200
+
+
+def summary_row(result):
+    # Turn the summary tuple written by backtester.write_chunk into a dictionary with every ranking metric
+    # (strategy_results_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl, trades, wins, pruned_bar)
+
+    strategy_results_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl, trades, wins, pruned_bar = result
+    return {'strategy_results_id': strategy_results_id, 'fast_ma': fast_ma, 'slow_ma': slow_ma,
+            'stop_loss': stop_loss, 'take_profit': take_profit, 'total_pnl': total_pnl, 'trades': trades,
+            'win_rate': round(wins / trades, 4) if trades else 0.0,
+            'avg_pnl': round(total_pnl / trades, 4) if trades else 0.0, 'pruned_bar': pruned_bar}
+
+
+class Leaderboard:
+    """ Bounded top-K heaps of test results per ranking metric, updated as the results arrive """
+
+
+    def __init__(self, k=TOP_K):
+
+        self.k = k
+        self.heaps = {metric: [] for metric in METRICS}
+        self.lock = threading.Lock()
+
+
+    def add(self, result):
+        # Offer one test's summary tuple to every heap.  Each heap's smallest item is replaced once it is full
+        # Ties go to the lower Strategy_Results_ID, the first written
+        # Pruned tests aren't ranked.  Their metrics stop at the bar they were pruned on
+
+        row = summary_row(result)
+        if row['pruned_bar'] is not None:
+            return
+        with self.lock:
+            for metric, heap in self.heaps.items():
+                item = (row[metric], -row['strategy_results_id'], row)
+                if len(heap) < self.k:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+
+
+    def top(self, metric='total_pnl', n=50):
+        # The best n results by metric, best first
+
+        with self.lock:
+            return [item[2] for item in heapq.nlargest(n, self.heaps[metric], key=lambda item: item[:2])]
+
+
+    def ranks(self):
+        # The Strategy_Results_IDs of every heap, best first, to save with backtester.save_leaderboard
+
+        return {metric: [row['strategy_results_id'] for row in self.top(metric, self.k)] for metric in METRICS}
@@ -0,0 +1,317 @@
+import os
+import sys
+import numpy as np
+from . import backtester
+from . import config
+from . import leaderboard
+from . import positions
+from . import pruning
+from datetime import datetime
+
+
+# Moving averages in the Market_Data table, MA3 to MA20
+MA_PERIODS = list(range(3, 21))
+
+
+def moving_averages(closes, new_closes):
+    # Continue the moving averages of the Market_Data table over new closes, from the rolling state of the
+    # closes already stored.  Only the last MA_PERIODS[-1] - 1 of them are needed
+    # Return a list of [ma3, ..., ma20] per new close, rounded as add_moving_averages rounds them
+
+    state = list(closes)[-(MA_PERIODS[-1] - 1):]
+    # Prices are whole half ticks, so the running sums, and the averages, are exact
+    sums = np.concatenate([[0.0], np.cumsum(np.array(state + list(new_closes), dtype=np.float64))])
+    end = np.arange(len(state) + 1, len(sums))
+    mas = np.full((len(new_closes), len(MA_PERIODS)), np.nan)
+    for n, x in enumerate(MA_PERIODS):
+        full = end >= x
+        mas[full, n] = (sums[end[full]] - sums[end[full] - x]) / x
+    return [[None if np.isnan(v) else v for v in row] for row in np.round(mas, 2).tolist()]
+
+
+def read_new_candles(raw_path, last_timestamp, time_frame):
+    # Return the candles of a raw market data csv after last_timestamp as a DataFrame, and an error message or None
+    # New candles must follow on from last_timestamp at the time frame's interval and have numeric prices
+
+    # pandas is imported on first use, like backtester's csv functions, so the command line runner starts without it
+    import pandas as pd
+    df = pd.read_csv(raw_path)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce').dt.strftime('%Y-%m-%d %H:%M:%S')
+    df = df[df.timestamp > last_timestamp][['timestamp', 'open', 'high', 'low', 'close']].reset_index(drop=True)
+    if df.empty:
+        return df, None
+
+    expected = pd.date_range(pd.Timestamp(last_timestamp), periods=len(df) + 1, freq=time_frame)[1:]
+    gaps = df.timestamp[df.timestamp != expected.strftime('%Y-%m-%d %H:%M:%S')]
+    if len(gaps):
+        return df, f'Datetime data at {gaps.iloc[0]} is missing or doesn\'t conform to the datetime interval of the file.'
+
+    for col in ['open', 'high', 'low', 'close']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    nans = df.timestamp[df.isnull().any(axis=1)]
+    if len(nans):
+        return df, f'Price data in open, high, low, or close columns at {nans.iloc[0]} is not numeric'
+
+    return df, None
+
+
+def append_market_data(raw_path=None):
+    # Append the candles of a raw market data csv that are newer than its instrument's market data
+    # The moving averages of the new candles are continued from the last stored closes, not recomputed
+    # Return (instrument_period_dict, candles appended, error message or None)
+    # raw_path defaults to the configured market data file
+
+    try:
+        instrument_period_dict, appended, error = None, 0, None
+        raw_path = raw_path or config.settings.raw_path
+        if not os.path.exists(raw_path):
+            return instrument_period_dict, appended, f'File not found at {raw_path}'
+
+        conn = backtester.db_connect()
+        cur = conn.cursor()
+        backtester.create_tables(cur)
+        instrument_name, time_frame = backtester.instrument_name_from_path(raw_path)
+        instrument_period_dict = backtester.get_instrument_period(cur, instrument_name)
+        if instrument_period_dict is None:
+            conn.close()
+            return instrument_period_dict, appended, f'There is no market data for {instrument_name} to append to.'
+        instrument_period_id = instrument_period_dict['instrument_period_id']
+
+        # A test that is still running would mix results from before and after the new candles
+        cur.execute('''SELECT tvr.Test_Variable_Range_ID, tvr.Test_Name, tr.Status FROM Test_Variable_Range tvr
+                            LEFT JOIN Test_Run tr ON tr.Test_Variable_Range_ID = tvr.Test_Variable_Range_ID
+                        WHERE tvr.Instrument_Period_ID = ?''', (instrument_period_id,))
+        tests = cur.fetchall()
+        running = [test_name for _, test_name, status in tests if status == 'running']
+        if running:
+            conn.close()
+            return instrument_period_dict, appended, \
+                f"{', '.join(running)} must be resumed or deleted before candles are appended to {instrument_name}."
+
+        # The rolling state of the moving averages
+        cur.execute('''SELECT Timestamp, Close FROM Market_Data WHERE Instrument_Period_ID = ?
+                        ORDER BY Market_Data_ID DESC LIMIT ?''', (instrument_period_id, MA_PERIODS[-1] - 1))
+        last = cur.fetchall()[::-1]
+        cur.execute('SELECT COUNT(*) FROM Market_Data WHERE Instrument_Period_ID = ?', (instrument_period_id,))
+        no_of_bars = cur.fetchone()[0]
+
+        df, error = read_new_candles(raw_path, last[-1][0], instrument_period_dict['time_frame'])
+        if error or df.empty:
+            conn.close()
+            return instrument_period_dict, appended, error
+
+        # Record the candles every test covers before there are more of them
+        for test_variable_range_id, _, _ in tests:
+            record_bars(test_variable_range_id, no_of_bars, replace=False)
+
+        mas = moving_averages([close for _, close in last], df['close'].tolist())
+        cur.executemany(f'''INSERT INTO Market_Data (Instrument_Period_ID, Timestamp, Open, High, Low, Close,
+                                {', '.join(f'MA{x}' for x in MA_PERIODS)})
+                            VALUES ({', '.join('?' * (6 + len(MA_PERIODS)))});''',
+                        [[instrument_period_id] + candle + ma for candle, ma in zip(df.values.tolist(), mas)])
+        cur.execute('UPDATE Instrument_Period SET End_Datetime = ? WHERE Instrument_Period_ID = ?',
+            (df.timestamp.iloc[-1], instrument_period_id))
+        conn.commit()
+        appended = len(df)
+        instrument_period_dict = backtester.get_instrument_period(cur, instrument_name)
+        if conn:
+            conn.close()
+
+        # Market data cached by a serial run in this process is out of date
+        backtester.market_data_cache.pop(instrument_period_id, None)
+        backtester.market_arrays_cache.pop(instrument_period_id, None)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+        error = 'The candles could not be appended, see the exception log for details.'
+
+    return instrument_period_dict, appended, error
+
+
+def record_bars(test_variable_range_id, no_of_bars, replace=True, cur=None):
+    # Record the number of candles a test's results cover in its Test_Bars row
+    # replace=False keeps a row that is already there.  cur, if given, writes in the caller's transaction
+
+    query = f'''INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO Test_Bars 
+                    (Test_Variable_Range_ID, No_Of_Bars, Updated_Datetime) VALUES (?, ?, ?);'''
+    vals = (test_variable_range_id, no_of_bars, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    if cur is not None:
+        cur.execute(query, vals)
+        return
+
+    conn = backtester.test_db_connect(test_variable_range_id)
+    cur = conn.cursor()
+    # Test files made before Test_Bars was added don't have it yet
+    backtester.create_test_tables(cur)
+    cur.execute(query, vals)
+    conn.commit()
+    conn.close()
+
+
+def resume_state(trades, no_of_bars):
+    # Where to carry on a test over new candles from, given its positions as stored in Position_Details,
+    # oldest first, when the market data had no_of_bars candles.  Return (start_idx, open_position_row)
+    # A position closed on the last candle was still open, and is closed again from there; its row is returned
+    # Otherwise the search for a crossover carries on from the first candle it couldn't check before
+
+    if trades and trades[-1][3] == no_of_bars - 1:
+        return no_of_bars - 1, trades[-1]
+    start_idx = trades[-1][3] + 1 if trades else 0
+    return max(start_idx, no_of_bars - 2), None
+
+
+def update_test(test_variable_range_id, instrument_period_dict, rec_dict, prune=None):
+    # Carry on every strategy of a finished test over the candles appended since its results were written,
+    # rather than running it again.  rec_dict is all of the instrument's market data, from load_market_data
+    # Positions that were closed at the end of the old market data are closed again, and new positions added
+    # prune is the test's pruning rules.  Strategies they stopped stay as they are, and the rest can be stopped
+    # Return a summary of the update
+
+    try:
+        summary = {}
+        start_tm = datetime.now()
+        conn = backtester.test_db_connect(test_variable_range_id)
+        cur = conn.cursor()
+        backtester.create_test_tables(cur)
+        conn.commit()
+
+        # A test without a Test_Bars row was run after the last candles were appended
+        cur.execute('SELECT No_Of_Bars FROM Test_Bars WHERE Test_Variable_Range_ID = ?', (test_variable_range_id,))
+        res = cur.fetchone()
+        no_of_bars = res[0] if res else len(rec_dict)
+        summary = {'test_variable_range_id': test_variable_range_id, 'bars_added': len(rec_dict) - no_of_bars,
+                   'no_of_tests': 0, 'positions_updated': 0, 'positions_added': 0, 'elapsed_seconds': 0.0}
+        if not summary['bars_added']:
+            record_bars(test_variable_range_id, no_of_bars, replace=False, cur=cur)
+            conn.commit()
+            conn.close()
+            return summary
+
+        # One pass over the positions for the state of every strategy
+        cur.execute('''SELECT Strategy_Results_ID, Direction, Open_Bar, Open_Price, Close_Bar, Close_Price, PNL,
+                        Position_Details_ID FROM Position_Details ORDER BY Position_Details_ID''')
+        trades = {}
+        for row in cur.fetchall():
+            trades.setdefault(row[0], []).append(row[1:])
+        cur.execute('''SELECT Strategy_Results_ID, Fast_MA, Slow_MA, Stop_Loss, Take_Profit, Total_PNL, Pruned_Bar 
+                        FROM Strategy_Results''')
+        strategies = cur.fetchall()
+
+        cur.execute('BEGIN IMMEDIATE')
+        board = leaderboard.Leaderboard()
+        for strategy_results_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl, pruned_bar in strategies:
+            old = trades.get(strategy_results_id, [])
+            if pruned_bar is not None:
+                board.add((strategy_results_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl, len(old), 
+                           sum(1 for p in old if p[5] > 0.0), pruned_bar))
+                continue
+
+            start_idx, open_row = resume_state(old, no_of_bars)
+            open_position = None
+            if open_row is not None:
+                old = old[:-1]
+                open_position = {'direction': 'short' if open_row[0] == positions.SHORT else 'long',
+                                 'open_time': rec_dict[open_row[1]]['timestamp'], 
+                                 'open_price': rec_dict[open_row[1]]['open'], 'open_bar': open_row[1]}
+            # The pruning rules carry on from the PnL of the positions that were closed, in the order they closed
+            pnl, peak = 0.0, 0.0
+            for p in old:
+                pnl += p[5]
+                peak = max(peak, pnl)
+            strategy = backtester.Test_Strategy(rec_dict, fast_ma, slow_ma, stop_loss, take_profit, 
+                instrument_period_dict, test_variable_range_id, prune, persist=False, 
+                resume=(start_idx, open_position, (pnl, peak)))
+            if not strategy.results_computed:
+                raise RuntimeError(f'Strategy {strategy_results_id} could not be updated')
+            new = strategy.results()[5]
+
+            # The position that was open keeps its row.  It is always the first of the new positions
+            if open_row is not None:
+                cur.execute('''UPDATE Position_Details SET Close_Bar = ?, Close_Price = ?, PNL = ? 
+                                WHERE Position_Details_ID = ?''', new[0][3:] + (open_row[6],))
+                summary['positions_updated'] += 1
+            added = new[1:] if open_row is not None else new
+            cur.executemany('''INSERT INTO Position_Details (Strategy_Results_ID, Direction, Open_Bar, Open_Price, 
+                                Close_Bar, Close_Price, PNL) VALUES (?, ?, ?, ?, ?, ?, ?);''', 
+                            [(strategy_results_id,) + p for p in added])
+            summary['positions_added'] += len(added)
+            old = [p[:6] for p in old] + new
+
+            # Sum the shorts, then the longs, in the order Test_Strategy.load_results does, so the Total_PNL
+            # is the one a new run over all of the candles would give
+            short_pnl, long_pnl = 0, 0
+            for p in old:
+                if p[0] == positions.SHORT:
+                    short_pnl += p[5]
+                else:
+                    long_pnl += p[5]
+            total_pnl = round(short_pnl + long_pnl, 2)
+            cur.execute('UPDATE Strategy_Results SET Total_PNL = ?, Pruned_Bar = ? WHERE Strategy_Results_ID = ?', 
+                (total_pnl, strategy.pruned_bar, strategy_results_id))
+            board.add((strategy_results_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl, len(old), 
+                       sum(1 for p in old if p[5] > 0.0), strategy.pruned_bar))
+            summary['no_of_tests'] += 1
+
+        # A robustness study of the old trades no longer applies
+        cur.execute('DELETE FROM Strategy_Robustness')
+        record_bars(test_variable_range_id, len(rec_dict), cur=cur)
+        conn.commit()
+        if conn:
+            conn.close()
+
+        # The leaderboard and surface are rebuilt from the updated results
+        backtester.save_leaderboard(test_variable_range_id, board.ranks())
+        backtester.save_surface(test_variable_range_id)
+        summary['elapsed_seconds'] = round((datetime.now() - start_tm).total_seconds(), 3)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+        summary = {}
+
+    return summary
+
+
+def update_instrument(raw_path=None):
+    # Append the new candles of a raw market data csv, then update every finished test of its instrument
+    # Return (summary, error message or None)
+
+    try:
+        summary = {}
+        instrument_period_dict, appended, error = append_market_data(raw_path)
+        if error:
+            return summary, error
+
+        conn = backtester.db_connect()
+        cur = conn.cursor()
+        # Tests run before runs were recorded have no Test_Run row, and are finished
+        cur.execute('''SELECT tvr.Test_Variable_Range_ID, tvr.Test_Name, tr.Prune_Max_Drawdown, tr.Prune_Min_PNL,
+                            tr.Prune_Checkpoint_Bars FROM Test_Variable_Range tvr
+                            LEFT JOIN Test_Run tr ON tr.Test_Variable_Range_ID = tvr.Test_Variable_Range_ID
+                        WHERE tvr.Instrument_Period_ID = ? AND COALESCE(tr.Status, 'complete') = 'complete' ''', 
+                    (instrument_period_dict['instrument_period_id'],))
+        tests = cur.fetchall()
+        if conn:
+            conn.close()
+
+        rec_dict = backtester.load_market_data(instrument_period_dict['instrument_period_id'])
+        summary = {'instrument_name': instrument_period_dict['instrument_name'], 'candles_appended': appended,
+                   'end_datetime': instrument_period_dict['end_datetime'], 'tests': []}
+        for test_variable_range_id, test_name, *prune_columns in tests:
+            test_summary = update_test(test_variable_range_id, instrument_period_dict, rec_dict, 
+                                       pruning.from_columns(*prune_columns))
+            if not test_summary:
+                error = f'{test_name} could not be updated, see the exception log for details.'
+                break
+            summary['tests'].append(dict(test_summary, test_name=test_name))
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+        error = 'The tests could not be updated, see the exception log for details.'
+
+    return summary, error
@@ -0,0 +1,265 @@
+import cProfile
+import glob
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from multiprocessing import util
+from . import backtester
+from . import exception_log
+from . import leaderboard
+
+
+# Stages timed by Test_Strategy, run_test and run_chunk in every pool worker
+STAGES = ['data_load', 'signal_scan', 'exit_scan', 'db_write', 'lock_wait']
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """ Count observations in fixed buckets and keep their sum """
+
+
+    def __init__(self, buckets=BUCKETS):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+
+        for x, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[x] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def cumulative(self):
+        # Return (upper bound, observations less than or equal to the bound) pairs, ending with +Inf
+
+        total = 0
+        res = []
+        for bound, cnt in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += cnt
+            res.append((bound, total))
+        return res
+
+
+class Run_Metrics:
+    """ Counters, stage histograms and the leaderboard of one test run, gathered from the pool workers' results """
+
+
+    def __init__(self, test_name, no_of_tests, workers, test_variable_range_id=None):
+
+        self.test_name = test_name
+        self.test_variable_range_id = test_variable_range_id
+        self.no_of_tests = no_of_tests
+        self.workers = workers
+        self.start_tm = time.time()
+        self.end_tm = None
+        self.tests_completed = 0
+        self.tests_failed = 0
+        self.positions = 0
+        self.worker_tests = {}
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.leaderboard = leaderboard.Leaderboard()
+        self.lock = threading.Lock()
+
+
+    def record(self, stage_timings):
+        # Add the stage timings of one test, as returned by backtester.run_test
+
+        with self.lock:
+            if not stage_timings or stage_timings.get('failed'):
+                self.tests_failed += 1
+                return
+            self.tests_completed += 1
+            self.positions += stage_timings.get('positions', 0)
+            pid = stage_timings.get('pid')
+            self.worker_tests[pid] = self.worker_tests.get(pid, 0) + 1
+            for stage in STAGES:
+                if stage in stage_timings:
+                    self.histograms[stage].observe(stage_timings[stage])
+        if 'result' in stage_timings:
+            self.leaderboard.add(stage_timings['result'])
+
+
+    def record_chunk(self, timings_list):
+        # Add the stage timings of every test in a chunk, as returned by backtester.run_chunk
+
+        for stage_timings in timings_list:
+            self.record(stage_timings)
+
+
+    def finish(self):
+
+        with self.lock:
+            self.end_tm = time.time()
+
+
+    def elapsed(self):
+
+        return (self.end_tm or time.time()) - self.start_tm
+
+
+    def stage_totals(self):
+        # Seconds spent in each stage, summed over every worker
+
+        with self.lock:
+            return {stage: self.histograms[stage].sum for stage in STAGES}
+
+
+    def to_dict(self):
+
+        with self.lock:
+            elapsed = (self.end_tm or time.time()) - self.start_tm
+            return {'test_name': self.test_name,
+                    'running': self.end_tm is None,
+                    'no_of_tests': self.no_of_tests,
+                    'workers': self.workers,
+                    'elapsed_seconds': round(elapsed, 3),
+                    'tests_completed': self.tests_completed,
+                    'tests_failed': self.tests_failed,
+                    'positions': self.positions,
+                    'tests_per_sec': round(self.tests_completed / elapsed, 2) if elapsed else 0.0,
+                    'worker_tests': {str(k): v for k, v in self.worker_tests.items()},
+                    'stages': {stage: {'count': h.count, 'sum': round(h.sum, 6),
+                                       'buckets': [['+Inf' if b == float('inf') else b, c] for b, c in h.cumulative()]}
+                               for stage, h in self.histograms.items()}}
+
+
+    def progress_stats(self):
+        # The counters of a run in progress, without the stage histograms
+
+        stats = self.to_dict()
+        return {key: stats[key] for key in ['test_name', 'no_of_tests', 'tests_completed', 'tests_failed',
+                                            'positions', 'elapsed_seconds', 'tests_per_sec']}
+
+
+    def to_prometheus(self):
+        # Render the metrics in the Prometheus text exposition format
+
+        with self.lock:
+            label = 'test_name="{}"'.format(str(self.test_name).replace('\\', '\\\\').replace('"', '\\"'))
+            lines = ['# TYPE backtester_tests_total counter',
+                     f'backtester_tests_total{{{label}}} {self.no_of_tests}',
+                     '# TYPE backtester_tests_completed counter',
+                     f'backtester_tests_completed{{{label}}} {self.tests_completed}',
+                     '# TYPE backtester_tests_failed counter',
+                     f'backtester_tests_failed{{{label}}} {self.tests_failed}',
+                     '# TYPE backtester_positions counter',
+                     f'backtester_positions{{{label}}} {self.positions}',
+                     '# TYPE backtester_run_running gauge',
+                     f'backtester_run_running{{{label}}} {int(self.end_tm is None)}',
+                     '# TYPE backtester_run_elapsed_seconds gauge',
+                     f'backtester_run_elapsed_seconds{{{label}}} {(self.end_tm or time.time()) - self.start_tm:.3f}',
+                     '# TYPE backtester_worker_tests counter']
+            for pid, cnt in self.worker_tests.items():
+                lines.append(f'backtester_worker_tests{{{label},pid="{pid}"}} {cnt}')
+
+            lines.append('# TYPE backtester_stage_seconds histogram')
+            for stage, h in self.histograms.items():
+                for bound, cnt in h.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'backtester_stage_seconds_bucket{{{label},stage="{stage}",le="{le}"}} {cnt}')
+                lines.append(f'backtester_stage_seconds_sum{{{label},stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'backtester_stage_seconds_count{{{label},stage="{stage}"}} {h.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# The run in progress, or the last one to finish, served by the /metrics endpoint
+_current_run = None
+_current_lock = threading.Lock()
+
+
+def start_run(test_name, no_of_tests, workers, test_variable_range_id=None):
+    # Replace the current run's metrics with a new, empty set
+
+    global _current_run
+    with _current_lock:
+        _current_run = Run_Metrics(test_name, no_of_tests, workers, test_variable_range_id)
+    return _current_run
+
+
+def current_run():
+
+    with _current_lock:
+        return _current_run
+
+
+# Per-worker profiler, only set when a run is started with profiling
+_profiler = None
+_profile_path = None
+
+
+def init_worker(profile_path=None, log_queue=None):
+    # Pool initializer.  Send exceptions to the parent's log listener through log_queue
+    # Start a cProfile profiler in the worker when profile_path is given
+    # Each worker writes its stats to profile_path + '.<pid>' when the pool is closed and joined
+
+    global _profiler, _profile_path
+
+    try:
+        exception_log.init_worker(log_queue)
+        if profile_path:
+            _profiler = cProfile.Profile()
+            _profile_path = f'{profile_path}.{os.getpid()}'
+            util.Finalize(None, dump_worker_profile, exitpriority=10)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+
+def profiled_run_chunk(chunk):
+    # Run backtester.run_chunk under the worker's profiler, if there is one
+
+    if _profiler is None:
+        return backtester.run_chunk(chunk)
+
+    _profiler.enable()
+    try:
+        return backtester.run_chunk(chunk)
+    finally:
+        _profiler.disable()
+
+
+def dump_worker_profile():
+
+    if _profiler is not None:
+        _profiler.dump_stats(_profile_path)
+
+
+def merge_profiles(profile_path, no_of_lines=30):
+    # Combine the workers' profile files into profile_path and return a summary of the most expensive functions
+
+    try:
+        summary = ''
+        worker_files = glob.glob(glob.escape(profile_path) + '.*')
+        if worker_files:
+            stats = pstats.Stats(*worker_files)
+            stats.dump_stats(profile_path)
+            for f in worker_files:
+                os.remove(f)
+
+            out = io.StringIO()
+            pstats.Stats(profile_path, stream=out).sort_stats('cumulative').print_stats(no_of_lines)
+            summary = out.getvalue()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return summary
@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import numpy as np
+from . import backtester
+from . import positions
+from . import robustness
+
+
+# How the capital is split between the strategies of a portfolio, unless weights are given
+# 'equal' gives each the same share, 'inverse_volatility' gives each a share inverse to the spread of its candle PnLs
+ALLOCATIONS = ['equal', 'inverse_volatility']
+
+# Strategies of a test taken for a portfolio when only the test is named, best Total_PNL first
+TOP_N = 10
+
+# Capital the equity curve starts from
+CAPITAL = 10000.0
+
+
+def parse_strategies(text):
+    # Parse strategies given as '<test id>:<strategy id>,...', e.g. '1:52,1:90,3:7', to [(test id, strategy id), ...]
+    # Raise ValueError for a bad list
+
+    try:
+        strategy_ids = [tuple(int(x) for x in item.split(':')) for item in text.split(',') if item.strip()]
+    except ValueError:
+        raise ValueError('strategies must be a list of <test id>:<strategy id>, e.g. 1:52,1:90,3:7')
+    if not strategy_ids or any(len(ids) != 2 for ids in strategy_ids):
+        raise ValueError('strategies must be a list of <test id>:<strategy id>, e.g. 1:52,1:90,3:7')
+    return strategy_ids
+
+
+def top_strategies(test_variable_range_id, top_n=TOP_N):
+    # The (test id, strategy id) of a test's best strategies by Total_PNL
+
+    strategy_ids = []
+    conn = backtester.db_connect(test_variable_range_id)
+    if conn is None:
+        return strategy_ids
+    cur = conn.cursor()
+    cur.execute('''SELECT Strategy_Results_ID FROM Strategy_Results WHERE Test_Variable_Range_ID = ?
+                    ORDER BY Total_PNL DESC, Strategy_Results_ID LIMIT ?''', (test_variable_range_id, top_n))
+    strategy_ids = [(test_variable_range_id, row[0]) for row in cur.fetchall()]
+    if conn:
+        conn.close()
+    return strategy_ids
+
+
+def load_strategies(strategy_ids):
+    # Read the stored results and positions of strategies given as [(test id, strategy id), ...], from as many tests
+    # and instruments as they come from, with the candle times and closes of every instrument
+    # Return ([strategy dictionary, ...], {instrument_period_id: (timestamps, closes)}), strategies in the order given
+    # Raise ValueError for a strategy that isn't in the database or is given more than once
+
+    duplicates = dict.fromkeys(f'{tvr}:{sr}' for tvr, sr in strategy_ids if strategy_ids.count((tvr, sr)) > 1)
+    if duplicates:
+        raise ValueError(f"Strategy {', '.join(duplicates)} is given more than once, "
+                         'use weights to give it a larger share')
+
+    strategies = {}
+    market_data = {}
+    conn = backtester.db_connect()
+    try:
+        cur = conn.cursor()
+        for test_variable_range_id in dict.fromkeys(ids[0] for ids in strategy_ids):
+            cur.execute('''SELECT t.Test_Name, i.Instrument_Period_ID, i.Instrument_Name, i.Time_Frame
+                            FROM Test_Variable_Range t
+                                JOIN Instrument_Period i ON i.Instrument_Period_ID = t.Instrument_Period_ID
+                            WHERE t.Test_Variable_Range_ID = ?''', (test_variable_range_id,))
+            res = cur.fetchone()
+            if res is None:
+                raise ValueError(f'There is no test {test_variable_range_id}')
+            test_name, instrument_period_id, instrument_name, time_frame = res
+
+            if instrument_period_id not in market_data:
+                cur.execute('''SELECT Timestamp, Close FROM Market_Data
+                                WHERE Instrument_Period_ID = ? ORDER BY Market_Data_ID''', (instrument_period_id,))
+                rows = cur.fetchall()
+                market_data[instrument_period_id] = (np.array([row[0] for row in rows]),
+                                                     np.array([row[1] for row in rows], dtype=np.float64))
+
+            # The positions of every strategy of the test in one query
+            # A test without a database file has no strategies
+            ids = [strategy_results_id for tvr, strategy_results_id in strategy_ids if tvr == test_variable_range_id]
+            test_conn = backtester.db_connect(test_variable_range_id)
+            if test_conn is None:
+                continue
+            try:
+                test_cur = test_conn.cursor()
+                test_cur.execute(f'''SELECT Strategy_Results_ID, Fast_MA, Slow_MA, Stop_Loss, Take_Profit, Total_PNL
+                                    FROM Strategy_Results
+                                    WHERE Strategy_Results_ID IN ({', '.join('?' * len(ids))})''', ids)
+                for strategy_results_id, fast_ma, slow_ma, stop_loss, take_profit, total_pnl in test_cur.fetchall():
+                    strategies[(test_variable_range_id, strategy_results_id)] = {
+                        'test_variable_range_id': test_variable_range_id, 'strategy_results_id': strategy_results_id,
+                        'test_name': test_name, 'instrument_name': instrument_name, 'time_frame': time_frame,
+                        'instrument_period_id': instrument_period_id, 'fast_ma': fast_ma, 'slow_ma': slow_ma,
+                        'stop_loss': stop_loss, 'take_profit': take_profit, 'total_pnl': total_pnl, 'trades': []}
+                test_cur.execute(f'''SELECT Strategy_Results_ID, Direction, Open_Bar, Open_Price, Close_Bar,
+                                        Close_Price, PNL
+                                    FROM Position_Details WHERE Strategy_Results_ID IN ({', '.join('?' * len(ids))})
+                                    ORDER BY Position_Details_ID''', ids)
+                for row in test_cur.fetchall():
+                    strategies[(test_variable_range_id, row[0])]['trades'].append(row[1:])
+            finally:
+                test_conn.close()
+
+    finally:
+        conn.close()
+
+    missing = [f'{tvr}:{sr}' for tvr, sr in strategy_ids if (tvr, sr) not in strategies]
+    if missing:
+        raise ValueError(f"There is no strategy {', '.join(missing)}")
+    return [strategies[ids] for ids in strategy_ids], market_data
+
+
+def pnl_curves(strategies, closes):
+    # The PnL of each of a set of strategies on one instrument at the close of every candle, as one array with a row
+    # per strategy.  Closed positions count their stored PNL from their close candle on, so a curve ends at the
+    # strategy's Total_PNL.  The open position is marked to the candle's close until the candle it closes on
+
+    curves = np.zeros((len(strategies), len(closes)))
+    rows = np.array([s for s, strategy in enumerate(strategies) for _ in strategy['trades']], dtype=np.int64)
+    if not len(rows):
+        return curves
+    trades = np.array([trade for strategy in strategies for trade in strategy['trades']], dtype=np.float64)
+    direction, open_bar, close_bar, pnl = trades[:, 0], trades[:, 1].astype(np.int64), trades[:, 3].astype(np.int64), \
+        trades[:, 5]
+    open_price = positions.from_half_ticks(trades[:, 2])
+
+    # PnL realised on the close candles, carried on to the end
+    np.add.at(curves, (rows, close_bar), pnl)
+    curves = np.cumsum(curves, axis=1)
+
+    # Every candle each position is open on before its close candle, all positions at once.  A strategy has one
+    # position at a time, so no candle of a row is marked twice
+    lengths = close_bar - open_bar
+    bars = np.repeat(open_bar, lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    curves[np.repeat(rows, lengths), bars] += np.repeat(direction, lengths) * \
+        (closes[bars] - np.repeat(open_price, lengths)) / np.repeat(open_price, lengths)
+    return curves
+
+
+def allocate(increments, allocation='equal', weights=None):
+    # Shares of the capital for strategies with the given candle PnLs, a row per strategy, adding up to 1
+    # Raise ValueError for an unknown allocation or bad weights
+
+    if weights is not None:
+        weights = np.array(weights, dtype=np.float64)
+        if len(weights) != len(increments) or (weights < 0).any() or not weights.sum() > 0:
+            raise ValueError(f'weights must be {len(increments)} numbers of 0 or more, not all 0')
+    elif allocation == 'equal':
+        weights = np.ones(len(increments))
+    elif allocation == 'inverse_volatility':
+        # Strategies that never traded get nothing, unless none did
+        volatility = increments.std(axis=1)
+        weights = np.divide(1.0, volatility, out=np.zeros(len(increments)), where=volatility > 0)
+        if not weights.sum() > 0:
+            weights = np.ones(len(increments))
+    else:
+        raise ValueError(f"allocation must be one of {', '.join(ALLOCATIONS)}")
+    return weights / weights.sum()
+
+
+def simulate(strategy_ids, allocation='equal', weights=None, capital=CAPITAL):
+    # Combine stored strategies, given as [(test id, strategy id), ...], into a portfolio without running them again
+    # Their PnL curves are put on one timeline of every candle of their instruments, held at their last value
+    # between an instrument's candles, and weighted by their share of the capital.  PnLs are fractions of the capital,
+    # like Total_PNL.  Return the portfolio's equity and drawdown at every candle, and the correlation of the
+    # strategies' candle PnLs
+    # Raise ValueError for unknown strategies, an unknown allocation, bad weights or capital
+
+    try:
+        summary = {}
+        if not capital > 0:
+            raise ValueError('capital must be more than 0')
+        start_tm = time.perf_counter()
+        strategies, market_data = load_strategies(strategy_ids)
+
+        # The common timeline.  Timestamps are ISO text, so they sort in time order
+        timestamps = np.unique(np.concatenate([times for times, _ in market_data.values()]))
+        curves = np.zeros((len(strategies), len(timestamps)))
+        for instrument_period_id, (times, closes) in market_data.items():
+            rows = [s for s, strategy in enumerate(strategies) if strategy['instrument_period_id'] == instrument_period_id]
+            if not rows:
+                continue
+            # Each timeline candle takes the instrument's latest candle at or before it, or 0 before its first candle
+            bars = np.searchsorted(times, timestamps, side='right') - 1
+            instrument_curves = pnl_curves([strategies[s] for s in rows], closes)
+            curves[rows] = np.where(bars >= 0, instrument_curves[:, np.maximum(bars, 0)], 0.0)
+
+        increments = np.diff(curves, axis=1, prepend=0.0)
+        weighted = weights is not None
+        weights = allocate(increments, allocation, weights)
+        pnl = weights @ curves
+        drawdown = np.maximum.accumulate(np.maximum(pnl, 0.0)) - pnl
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = np.atleast_2d(np.corrcoef(increments))
+        # Strategies that never traded have no correlation
+        off_diagonal = correlation[~np.eye(len(strategies), dtype=bool)]
+        average_correlation = round(float(np.nanmean(off_diagonal)), 4) if np.isfinite(off_diagonal).any() else None
+        strategy_drawdowns = robustness.max_drawdowns(increments)
+
+        # The strategies without their positions, with their share of the capital and their own drawdown
+        results = [{**{k: v for k, v in strategy.items() if k != 'trades'},
+                 'weight': round(float(weights[s]), 6), 'max_drawdown': round(float(strategy_drawdowns[s]), 4)}
+                for s, strategy in enumerate(strategies)]
+
+        summary = {'strategies': results,
+                   'allocation': 'weights' if weighted else allocation,
+                   'capital': capital,
+                   'bars': len(timestamps),
+                   'start_datetime': str(timestamps[0]),
+                   'end_datetime': str(timestamps[-1]),
+                   'total_pnl': round(float(pnl[-1]), 4),
+                   'final_equity': round(capital * (1.0 + float(pnl[-1])), 2),
+                   'max_drawdown': round(float(drawdown.max()), 4),
+                   'average_correlation': average_correlation,
+                   'correlation': [[None if np.isnan(v) else round(v, 4) for v in row] for row in correlation.tolist()],
+                   'timestamps': timestamps.tolist(),
+                   'equity': np.round(capital * (1.0 + pnl), 4).tolist(),
+                   'drawdown': np.round(drawdown, 4).tolist(),
+                   'elapsed_seconds': round(time.perf_counter() - start_tm, 3)}
+
+    except ValueError:
+        raise
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return summary
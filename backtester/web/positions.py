@@ -0,0 +1,32 @@
+# Position_Details stores a trade as integers, and decodes it back to times and prices for charts and views:
+# a direction flag, the index of its open and close candles within the instrument period's market data,
+# and prices in half ticks, since exchange price increments are 0.5 and the engine already rounds to them
+SHORT, LONG = -1, 1
+
+
+def to_half_ticks(price):
+
+    return int(round(price * 2))
+
+
+def from_half_ticks(half_ticks):
+
+    return half_ticks / 2
+
+
+def encode(position):
+    # Return a position dictionary built by Test_Strategy or kernels.scan_sub_grid as a Position_Details row:
+    # (direction, open_bar, open_price, close_bar, close_price, pnl)
+
+    return (SHORT if position['direction'] == 'short' else LONG, position['open_bar'],
+            to_half_ticks(position['open_price']), position['close_bar'], to_half_ticks(position['close_price']),
+            position['pnl'])
+
+
+def decode(row, timestamps):
+    # Return an encoded position as (direction, open_time, open_price, close_time, close_price, pnl)
+    # timestamps are those of the instrument period's candles, in Market_Data_ID order
+
+    direction, open_bar, open_price, close_bar, close_price, pnl = row
+    return ('short' if direction == SHORT else 'long', timestamps[open_bar], from_half_ticks(open_price),
+            timestamps[close_bar], from_half_ticks(close_price), pnl)
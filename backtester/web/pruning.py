@@ -0,0 +1,49 @@
+import math
+
+
+# Candles a test runs before its PnL is held to min_pnl, 20 days of 4 hour candles
+CHECKPOINT_BARS = 120
+
+
+def make_rules(max_drawdown=None, min_pnl=None, checkpoint_bars=CHECKPOINT_BARS):
+    # Pruning rules as a tuple small enough to send with every combination, or None if no rule is set
+    # A test is stopped as soon as a trade closes with its PnL more than max_drawdown below its peak, or, from
+    # checkpoint_bars candles on, below min_pnl.  PnLs are fractions, like Total_PNL
+
+    if max_drawdown is None and min_pnl is None:
+        return None
+    return (math.inf if max_drawdown is None else max_drawdown, -math.inf if min_pnl is None else min_pnl,
+            checkpoint_bars)
+
+
+def limits(rules):
+    # (max_drawdown, min_pnl, checkpoint_bars) for the scans, which prune nothing when there are no rules
+
+    return rules if rules is not None else (math.inf, -math.inf, 0)
+
+
+def tripped(pnl, peak, close_bar, rules):
+    # Whether a test is pruned after a trade closes on close_bar, leaving it with pnl and a highest pnl of peak
+    # kernels.scan_exits checks the same conditions
+
+    max_drawdown, min_pnl, checkpoint_bars = limits(rules)
+    return peak - pnl > max_drawdown or (close_bar >= checkpoint_bars and pnl < min_pnl)
+
+
+def to_columns(rules):
+    # The rules as the Prune_Max_Drawdown, Prune_Min_PNL, Prune_Checkpoint_Bars columns of Test_Run
+    # A rule that isn't set is NULL, as are all three without rules
+
+    if rules is None:
+        return None, None, None
+    max_drawdown, min_pnl, checkpoint_bars = rules
+    return (None if math.isinf(max_drawdown) else max_drawdown, None if math.isinf(min_pnl) else min_pnl,
+            checkpoint_bars)
+
+
+def from_columns(max_drawdown, min_pnl, checkpoint_bars):
+    # The rules saved in Test_Run by to_columns
+
+    if checkpoint_bars is None:
+        return None
+    return make_rules(max_drawdown, min_pnl, checkpoint_bars)
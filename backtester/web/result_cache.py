@@ -0,0 +1,59 @@
+import collections
+import threading
+from . import backtester
+from . import config
+
+
+class Result_Cache:
+    """ Least recently used cache of the query results of tests, for the pages of the web app """
+
+
+    def __init__(self, max_entries):
+
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, test_variable_range_id, name, loader, *params):
+        # Return loader(test_variable_range_id, *params), from the cache unless the test was written or deleted since
+        # it was cached, by this or any other process.  The least recently used entry is dropped when the cache is full
+
+        test_variable_range_id = int(test_variable_range_id)
+        key = (test_variable_range_id, name) + params
+        version = backtester.test_version(test_variable_range_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Query outside the lock, so other pages aren't held up
+        value = loader(test_variable_range_id, *params)
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+
+    def invalidate(self, test_variable_range_id):
+        # Drop every entry of a test
+
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == int(test_variable_range_id)]:
+                del self.entries[key]
+
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+
+
+cache = Result_Cache(config.settings.result_cache_size)
@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import numpy as np
+from concurrent import futures
+from . import backtester
+from . import config
+from . import exception_log
+from . import metrics
+
+
+# Strategies studied, resamples of each, and the width of the confidence intervals
+TOP_N = 200
+RESAMPLES = 1000
+CONFIDENCE = 0.9
+
+# Most strategies resampled together in one array, which holds strategies * resamples * trades PnLs
+MAX_CHUNK_SIZE = 25
+
+
+def max_drawdowns(paths):
+    # The largest fall of the cumulative PnL from its peak along each row of trade PnLs, with the peak starting at 0
+
+    if paths.shape[-1] == 0:
+        return np.zeros(paths.shape[:-1])
+    equity = np.cumsum(paths, axis=-1)
+    peaks = np.maximum.accumulate(np.maximum(equity, 0.0), axis=-1)
+    return (peaks - equity).max(axis=-1)
+
+
+def resample_chunk(chunk):
+    # Resample the trades of a chunk of strategies, given as ([(strategy_results_id, [pnl, ...]), ...],
+    # resamples, confidence, seed), and return a Strategy_Robustness row per strategy
+    # Bootstrap resamples draw each strategy's trades with replacement, for the spread of its Total_PNL
+    # Shuffles reorder its trades, which keeps the Total_PNL, for the spread of its drawdown
+    # The draws of each strategy are seeded by its Strategy_Results_ID, so they don't depend on the chunks
+
+    strategies, resamples, confidence, seed = chunk
+    no_of_trades = np.array([len(pnls) for _, pnls in strategies])
+    width = max(1, int(no_of_trades.max()))
+
+    # Trades past a strategy's last are 0, which doesn't move its PnL or drawdown
+    trades = np.zeros((len(strategies), width))
+    boot_draws = np.zeros((len(strategies), resamples, width))
+    shuffle_keys = np.full((len(strategies), resamples, width), np.inf)
+    for s, (strategy_results_id, pnls) in enumerate(strategies):
+        trades[s, :len(pnls)] = pnls
+        rng = np.random.default_rng([seed, strategy_results_id])
+        boot_draws[s, :, :len(pnls)] = rng.random((resamples, len(pnls)))
+        shuffle_keys[s, :, :len(pnls)] = rng.random((resamples, len(pnls)))
+
+    # Every strategy and resample at once
+    rows = np.arange(len(strategies))[:, None, None]
+    used = np.arange(width)[None, None, :] < no_of_trades[:, None, None]
+    boot = np.where(used, trades[rows, (boot_draws * no_of_trades[:, None, None]).astype(np.int64)], 0.0)
+    shuffled = trades[rows, np.argsort(shuffle_keys, axis=-1)]
+
+    # Trade PnLs have 4 decimals.  Round off the float error of the sums, so a break even total is exactly 0
+    boot_pnl = np.round(boot.sum(axis=-1), 8)
+    shuffle_drawdown = max_drawdowns(shuffled)
+    tail = (1.0 - confidence) / 2
+    pnl_low, pnl_median, pnl_high = np.quantile(boot_pnl, [tail, 0.5, 1.0 - tail], axis=1)
+    dd_low, dd_median, dd_high = np.quantile(shuffle_drawdown, [tail, 0.5, 1.0 - tail], axis=1)
+    loss_probability = (boot_pnl <= 0.0).mean(axis=1)
+    drawdown = max_drawdowns(trades)
+
+    return [(strategy_results_id, resamples, confidence, round(float(drawdown[s]), 4),
+             round(float(pnl_low[s]), 4), round(float(pnl_median[s]), 4), round(float(pnl_high[s]), 4),
+             round(float(loss_probability[s]), 4),
+             round(float(dd_low[s]), 4), round(float(dd_median[s]), 4), round(float(dd_high[s]), 4))
+            for s, (strategy_results_id, _) in enumerate(strategies)]
+
+
+def load_trades(test_variable_range_id, top_n):
+    # The trade PnLs of a test's best strategies by Total_PNL, oldest trade first, as [(strategy_results_id, [pnl, ...]), ...]
+
+    conn = backtester.db_connect(test_variable_range_id)
+    if conn is None:
+        return []
+    cur = conn.cursor()
+    cur.execute('''SELECT Strategy_Results_ID FROM Strategy_Results WHERE Test_Variable_Range_ID = ?
+                    ORDER BY Total_PNL DESC, Strategy_Results_ID LIMIT ?''', (test_variable_range_id, top_n))
+    strategy_results_ids = [row[0] for row in cur.fetchall()]
+    pnls = {strategy_results_id: [] for strategy_results_id in strategy_results_ids}
+    cur.execute(f'''SELECT Strategy_Results_ID, PNL FROM Position_Details
+                    WHERE Strategy_Results_ID IN ({', '.join('?' * len(strategy_results_ids))})
+                    ORDER BY Position_Details_ID''', strategy_results_ids)
+    for strategy_results_id, pnl in cur.fetchall():
+        pnls[strategy_results_id].append(pnl)
+    if conn:
+        conn.close()
+
+    return [(strategy_results_id, pnls[strategy_results_id]) for strategy_results_id in strategy_results_ids]
+
+
+def run_study(test_variable_range_id, top_n=TOP_N, resamples=RESAMPLES, confidence=CONFIDENCE, workers=None, seed=0):
+    # Resample the trades of a test's top_n strategies and save their confidence intervals in Strategy_Robustness,
+    # replacing those of any earlier study.  The chunks of strategies are spread over a pool of workers
+    # Return a summary of the study
+    # Raise ValueError for a test that isn't in the database
+
+    try:
+        summary = {}
+        if backtester.get_test_name(test_variable_range_id) is None:
+            raise ValueError(f'There is no test {test_variable_range_id}')
+        start_tm = time.perf_counter()
+        strategies = load_trades(test_variable_range_id, top_n)
+        workers = workers or config.settings.workers
+        chunk_size = max(1, min(MAX_CHUNK_SIZE, -(-len(strategies) // (workers * 4))))
+        chunks = [(strategies[x:x + chunk_size], resamples, confidence, seed)
+                  for x in range(0, len(strategies), chunk_size)]
+
+        if workers == 1 or len(chunks) <= 1:
+            rows = [row for chunk in chunks for row in resample_chunk(chunk)]
+        else:
+            log_queue = exception_log.start_listener()
+            with futures.ProcessPoolExecutor(min(workers, len(chunks)), initializer=metrics.init_worker,
+                                             initargs=(None, log_queue)) as executor:
+                rows = [row for chunk_rows in executor.map(resample_chunk, chunks) for row in chunk_rows]
+
+        conn = backtester.test_db_connect(test_variable_range_id)
+        cur = conn.cursor()
+        # Test files made before Strategy_Robustness was added don't have it yet
+        backtester.create_test_tables(cur)
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute('DELETE FROM Strategy_Robustness')
+        cur.executemany('''INSERT INTO Strategy_Robustness (Strategy_Results_ID, Resamples, Confidence, Max_Drawdown,
+                            PNL_Low, PNL_Median, PNL_High, Loss_Probability, Drawdown_Low, Drawdown_Median,
+                            Drawdown_High) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''', rows)
+        conn.commit()
+        if conn:
+            conn.close()
+
+        summary = {'test_variable_range_id': test_variable_range_id, 'strategies': len(rows), 'resamples': resamples,
+                   'confidence': confidence, 'workers': workers if len(chunks) > 1 else 1,
+                   'elapsed_seconds': round(time.perf_counter() - start_tm, 3)}
+
+    except ValueError:
+        raise
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return summary
+
+
+def load_study(test_variable_range_id):
+    # The saved study of a test joined with the strategies' results as dictionaries, most robust first:
+    # highest lower bound of the Total_PNL confidence interval
+
+    try:
+        study = []
+        if not os.path.exists(backtester.test_db_path(test_variable_range_id)):
+            return study
+        conn = backtester.test_db_connect(test_variable_range_id)
+        cur = conn.cursor()
+        backtester.create_test_tables(cur)
+        cur.execute('''SELECT sr.Strategy_Results_ID, sr.Fast_MA, sr.Slow_MA, sr.Stop_Loss, sr.Take_Profit, sr.Total_PNL,
+                            rb.Max_Drawdown, rb.PNL_Low, rb.PNL_Median, rb.PNL_High, rb.Loss_Probability,
+                            rb.Drawdown_Low, rb.Drawdown_Median, rb.Drawdown_High
+                        FROM Strategy_Robustness rb
+                            JOIN Strategy_Results sr ON sr.Strategy_Results_ID = rb.Strategy_Results_ID
+                        ORDER BY rb.PNL_Low DESC, sr.Total_PNL DESC''')
+        col = [desc[0].lower() for desc in cur.description]
+        study = [dict(zip(col, row)) for row in cur.fetchall()]
+        if conn:
+            conn.close()
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return study
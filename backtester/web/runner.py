@@ -0,0 +1,266 @@
+import collections
+import cProfile
+import os
+import sys
+import time
+from concurrent import futures
+from concurrent.futures import process
+from . import backtester
+from . import cluster
+from . import config
+from . import exception_log
+from . import metrics
+from . import pruning
+
+
+# Ways to run the tests of a grid
+ENGINES = ['pool', 'serial', 'cluster']
+
+# Largest number of tests written in one transaction
+MAX_CHUNK_SIZE = 64
+
+# Times a broken pool of workers is replaced before a run gives up
+MAX_POOL_RESTARTS = 3
+
+
+def run_grid(test_name, fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high, stop_loss_low, stop_loss_high,
+             take_profit_low, take_profit_high, workers=None, engine='pool', profile=False, raw_path=None,
+             progress=None, progress_interval=1.0, chunk_size=None, address=None, authkey=None, prune=None):
+    # Create a test, run every combination of its variables and return the summary stats
+    # Used by both views.run_tests and the command line runner, so both write the same results
+    # engine='pool' runs the tests on a pool of workers, engine='serial' runs them in this process and
+    # engine='cluster' serves them to workers on any host that connect to address with authkey
+    # progress, if given, is called with the run's progress at most every progress_interval seconds
+    # prune, if given, is the rules of pruning.make_rules that stop a combination early once it falls behind
+
+    try:
+        summary = {}
+        check_authkey(engine, authkey)
+        imported = backtester.instrument_imported(raw_path)
+
+        # Load raw data only once before running tests
+        instrument_period_dict, test_variable_range_id = backtester.create_db(test_name, fast_ma_low, fast_ma_high,
+            slow_ma_low, slow_ma_high, stop_loss_low, stop_loss_high, take_profit_low, take_profit_high, raw_path)
+
+        summary = run_chunks(test_name, (fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high, stop_loss_low, 
+            stop_loss_high, take_profit_low, take_profit_high), instrument_period_dict, test_variable_range_id,
+            workers, engine, profile, progress, progress_interval, chunk_size, address, authkey, prune)
+
+        # Rows inserted also include the Test_Variable_Range row, 
+        # plus the Instrument_Period row and market data if this run imported them
+        summary['rows_written'] += 1
+        if not imported:
+            conn = backtester.db_connect()
+            cur = conn.cursor()
+            cur.execute('SELECT COUNT(*) FROM Market_Data WHERE Instrument_Period_ID = ?',
+                (instrument_period_dict['instrument_period_id'],))
+            summary['rows_written'] += cur.fetchone()[0] + 1
+            if conn:
+                conn.close()
+        if summary['elapsed_seconds']:
+            summary['rows_per_sec'] = round(summary['rows_written'] / summary['elapsed_seconds'], 2)
+
+    except ValueError:
+        raise
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return summary
+
+
+def resume_run(test_name, workers=None, engine='pool', profile=False, progress=None, progress_interval=1.0,
+               address=None, authkey=None):
+    # Run the chunks of an interrupted test that aren't in the database yet and return the summary stats
+    # Return an empty summary if the test doesn't exist or has already completed
+
+    try:
+        summary = {}
+        check_authkey(engine, authkey)
+        test_run, instrument_period_dict = backtester.get_test_run(test_name)
+        if test_run is None or test_run['status'] != 'running':
+            return summary
+
+        # Stop losses and take profits are stored as fractions
+        ranges = (test_run['fast_ma_low'], test_run['fast_ma_high'], test_run['slow_ma_low'], test_run['slow_ma_high'], 
+                  round(test_run['stop_loss_low']*100), round(test_run['stop_loss_high']*100), 
+                  round(test_run['take_profit_low']*100), round(test_run['take_profit_high']*100))
+
+        # The rest of the combinations are pruned by the rules the test was started with
+        prune = pruning.from_columns(test_run['prune_max_drawdown'], test_run['prune_min_pnl'], 
+                                     test_run['prune_checkpoint_bars'])
+
+        summary = run_chunks(test_name, ranges, instrument_period_dict, test_run['test_variable_range_id'],
+            workers, engine, profile, progress, progress_interval, test_run['chunk_size'], address, authkey, prune)
+
+    except ValueError:
+        raise
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return summary
+
+
+def check_authkey(engine, authkey):
+    # Raise ValueError for a cluster run without an authkey, given or configured, as workers can't connect without one
+
+    if engine == 'cluster' and not (authkey or config.settings.cluster_authkey):
+        raise ValueError('engine=cluster needs an authkey, or one in BACKTESTER_CLUSTER_AUTHKEY')
+
+
+def run_chunks(test_name, ranges, instrument_period_dict, test_variable_range_id, workers=None, engine='pool', 
+               profile=False, progress=None, progress_interval=1.0, chunk_size=None, address=None, authkey=None,
+               prune=None):
+    # Split the combinations of a test into chunks and run the ones that aren't in Test_Chunk yet
+    # Each chunk is written in one transaction, so an interrupted run loses at most the chunks in flight,
+    # which the pool holds to one per worker
+
+    try:
+        summary = {}
+
+        # Created nested list of variable sets
+        variable_list, no_of_tests = backtester.cartesian_product(*ranges, instrument_period_dict, test_variable_range_id,
+                                                                  prune)
+
+        workers = 1 if engine == 'serial' else (workers or config.settings.workers)
+
+        # A resumed test keeps the chunk size it was started with, so its chunk numbers mean the same combinations
+        chunk_size = chunk_size or max(1, min(MAX_CHUNK_SIZE, no_of_tests // (workers * 8)))
+        no_of_chunks = -(-no_of_tests // chunk_size)
+        chunk_size = backtester.start_test_run(test_variable_range_id, no_of_tests, chunk_size, no_of_chunks, prune)
+        no_of_chunks = -(-no_of_tests // chunk_size)
+        done = backtester.completed_chunks(test_variable_range_id)
+        chunks = [(test_variable_range_id, chunk_no, variable_list[chunk_no*chunk_size:(chunk_no+1)*chunk_size])
+                  for chunk_no in range(no_of_chunks) if chunk_no not in done]
+
+        tests_to_run = sum(len(chunk[2]) for chunk in chunks)
+        run_metrics = metrics.start_run(test_name, tests_to_run, workers, test_variable_range_id)
+
+        # Profile every worker if requested.  Their stats are merged into one file when the run finishes
+        profile_path = None
+        if profile:
+            config.ensure_dirs()
+            profile_path = os.path.join(config.settings.cache_dir, f'profile_{test_variable_range_id}.prof')
+
+        if engine == 'serial':
+            profiler = cProfile.Profile() if profile_path else None
+            if profiler:
+                profiler.enable()
+            last_progress = time.monotonic()
+            for chunk in chunks:
+                run_metrics.record_chunk(backtester.run_chunk(chunk))
+                if progress and time.monotonic() - last_progress >= progress_interval:
+                    progress(run_metrics.progress_stats())
+                    last_progress = time.monotonic()
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(f'{profile_path}.{os.getpid()}')
+
+        elif engine == 'cluster':
+            # Report the workers that served the run rather than the local worker setting
+            workers = cluster.run_coordinator(chunks, run_metrics, address or config.settings.cluster_address, 
+                authkey or config.settings.cluster_authkey, progress, progress_interval)
+
+        else:
+            run_pool(chunks, run_metrics, workers, profile_path, progress, progress_interval)
+
+        run_metrics.finish()
+        status = backtester.finish_test_run(test_variable_range_id)
+
+        # The leaderboard only has every result of the test if no chunks were run before this run
+        if status == 'complete' and not done:
+            backtester.save_leaderboard(test_variable_range_id, run_metrics.leaderboard.ranks())
+        if status == 'complete':
+            backtester.save_surface(test_variable_range_id)
+
+        # Rows inserted: a Strategy_Results row per test and its positions
+        stats = run_metrics.to_dict()
+        rows_written = stats['tests_completed'] + stats['positions']
+        tests_pruned = backtester.count_pruned(test_variable_range_id) if prune is not None else 0
+
+        summary = {'test_name': test_name,
+                   'test_variable_range_id': test_variable_range_id,
+                   'instrument_name': instrument_period_dict['instrument_name'],
+                   'engine': engine,
+                   'workers': workers,
+                   'no_of_tests': no_of_tests,
+                   'chunk_size': chunk_size,
+                   'chunks_skipped': len(done),
+                   'tests_skipped': no_of_tests - tests_to_run,
+                   'tests_completed': stats['tests_completed'],
+                   'tests_failed': stats['tests_failed'],
+                   'tests_pruned': tests_pruned,
+                   'positions': stats['positions'],
+                   'rows_written': rows_written,
+                   'status': status,
+                   'elapsed_seconds': stats['elapsed_seconds'],
+                   'tests_per_sec': stats['tests_per_sec'],
+                   'rows_per_sec': round(rows_written / stats['elapsed_seconds'], 2) if stats['elapsed_seconds'] else 0.0,
+                   'stage_seconds': {stage: round(secs, 3) for stage, secs in run_metrics.stage_totals().items()},
+                   'profile_path': profile_path}
+
+        if profile_path:
+            summary['profile_summary'] = metrics.merge_profiles(profile_path)
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return summary
+
+
+def run_pool(chunks, run_metrics, workers, profile_path=None, progress=None, progress_interval=1.0):
+    # Run the chunks on a pool of workers, with at most one chunk per worker in flight
+    # If a worker dies, the pool is replaced and its chunks in flight are requeued, unless they reached the database
+
+    pending = collections.deque(chunks)
+    in_flight = {}
+    restarts = 0
+    last_progress = time.monotonic()
+    log_queue = exception_log.start_listener()
+    executor = futures.ProcessPoolExecutor(workers, initializer=metrics.init_worker, 
+        initargs=(profile_path, log_queue))
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                chunk = pending.popleft()
+                in_flight[executor.submit(metrics.profiled_run_chunk, chunk)] = chunk
+
+            # Gather the stage timings of each chunk as it finishes, so /metrics can show the run in progress
+            finished, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                chunk = in_flight.pop(future)
+                try:
+                    run_metrics.record_chunk(future.result())
+                except process.BrokenProcessPool:
+                    broken = True
+                    pending.appendleft(chunk)
+
+            if broken:
+                restarts += 1
+                if restarts > MAX_POOL_RESTARTS:
+                    raise RuntimeError(f'The pool of workers broke {restarts} times, giving up')
+                pending.extendleft(in_flight.values())
+                in_flight = {}
+                executor.shutdown(wait=True)
+
+                # A chunk may have been committed just before its worker died
+                done = backtester.completed_chunks(chunks[0][0])
+                pending = collections.deque(chunk for chunk in pending if chunk[1] not in done)
+                executor = futures.ProcessPoolExecutor(workers, initializer=metrics.init_worker, 
+                    initargs=(profile_path, log_queue))
+
+            if progress and time.monotonic() - last_progress >= progress_interval:
+                progress(run_metrics.progress_stats())
+                last_progress = time.monotonic()
+
+    finally:
+        # Wait for the workers to exit, so their queued exception records and profiles are written
+        executor.shutdown(wait=True)
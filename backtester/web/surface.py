@@ -0,0 +1,82 @@
+import io
+import warnings
+import numpy as np
+
+
+# Dimensions of a test's PnL surface.  Stop losses and take profits are whole percents, as entered on the form
+AXES = ['fast_ma', 'slow_ma', 'stop_loss', 'take_profit']
+
+# Ways to collapse the dimensions of a slice that aren't fixed to one value
+AGGREGATES = {'max': np.nanmax, 'mean': np.nanmean, 'min': np.nanmin}
+
+
+def axis_values(test_variable_range):
+    # The values along each axis of a test's surface, from its Test_Variable_Range row as a dictionary
+
+    tvr = test_variable_range
+    return {'fast_ma': list(range(tvr['fast_ma_low'], tvr['fast_ma_high'] + 1)),
+            'slow_ma': list(range(tvr['slow_ma_low'], tvr['slow_ma_high'] + 1)),
+            'stop_loss': list(range(round(tvr['stop_loss_low'] * 100), round(tvr['stop_loss_high'] * 100) + 1)),
+            'take_profit': list(range(round(tvr['take_profit_low'] * 100), round(tvr['take_profit_high'] * 100) + 1))}
+
+
+def build_surface(axes, rows):
+    # Fill a dense array of Total_PNL from (fast_ma, slow_ma, stop_loss, take_profit, total_pnl) rows
+    # Combinations that weren't tested, e.g. a fast_ma above the slow_ma, are NaN
+
+    surface = np.full([len(axes[axis]) for axis in AXES], np.nan)
+    if rows:
+        res = np.array(rows, dtype=np.float64)
+        idx = (res[:, 0].astype(int) - axes['fast_ma'][0],
+               res[:, 1].astype(int) - axes['slow_ma'][0],
+               np.rint(res[:, 2] * 100).astype(int) - axes['stop_loss'][0],
+               np.rint(res[:, 3] * 100).astype(int) - axes['take_profit'][0])
+        surface[idx] = res[:, 4]
+    return surface
+
+
+def to_blob(surface):
+
+    buf = io.BytesIO()
+    np.save(buf, surface, allow_pickle=False)
+    return buf.getvalue()
+
+
+def from_blob(blob):
+
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+def slice_surface(axes, surface, x='fast_ma', y='slow_ma', fixed=None, agg='max'):
+    # Return a 2-D slice of the surface as z[y][x], with None where there is no result
+    # fixed maps the other axes to a value; axes without one are collapsed with agg
+    # Raise ValueError for an unknown axis or aggregate, or a fixed value outside the test's range
+
+    fixed = fixed or {}
+    if x not in AXES or y not in AXES or x == y:
+        raise ValueError(f"x and y must be two different axes of {', '.join(AXES)}")
+    if agg not in AGGREGATES:
+        raise ValueError(f"agg must be one of {', '.join(AGGREGATES)}")
+
+    # Index the fixed axes, then collapse the rest, so only x and y are left
+    index = []
+    for axis in AXES:
+        if axis in (x, y) or axis not in fixed:
+            index.append(slice(None))
+        elif fixed[axis] in axes[axis]:
+            index.append(axes[axis].index(fixed[axis]))
+        else:
+            raise ValueError(f'{axis} {fixed[axis]} is outside the range of the test')
+    part = surface[tuple(index)]
+    left = [axis for axis in AXES if axis in (x, y) or axis not in fixed]
+    collapse = tuple(n for n, axis in enumerate(left) if axis not in (x, y))
+
+    # Slices with no results at all warn and give NaN, which is returned as None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if collapse:
+            part = AGGREGATES[agg](part, axis=collapse)
+    if left.index(x) < left.index(y):
+        part = part.T
+
+    return [[None if np.isnan(v) else round(float(v), 4) for v in row] for row in part]
@@ -1,11 +1,17 @@
-import multiprocessing as mp
 import os
-import psutil
+import pathlib
 import sys
 import webbrowser
-from datetime import datetime
-from flask import Blueprint, render_template, flash, redirect, url_for, request, session
+from flask import Blueprint, render_template, flash, redirect, url_for, request, session, jsonify, Response
 from . import backtester
+from . import config
+from . import export
+from . import leaderboard
+from . import metrics
+from . import portfolio
+from . import result_cache
+from . import runner
+from . import surface
 
 
 views = Blueprint('views', __name__)
@@ -16,11 +22,11 @@ def run_tests():
     # Use the variable ranges submitted to start testing through backtester.run_test()
 
     try:
-        db_path = os.getcwd() + '\\web\\database\\backtester_database.db'
+        db_path = config.settings.db_path
         data_import_check = False
 
-        # Check if the database doesn't exist
-        if not os.path.exists(db_path):
+        # Check if the market data hasn't been imported into the database yet
+        if not backtester.instrument_imported():
             # Check if the csv to make sure there is no missing or non-conforming data
             data_import_check = backtester.data_import_check()
             if data_import_check[0] == 'Data Import Error':
@@ -28,7 +34,7 @@ def run_tests():
                 flash(data_import_check[1][0], category='error')
                 flash(data_import_check[1][1], category='error')
                 return render_template('run_tests.html')
-        else:
+        if os.path.exists(db_path):
             # There is a database so saved_results.html can appear on nav bar
             session['saved_results_exist'] = True
 
@@ -43,67 +49,31 @@ def run_tests():
             take_profit_low = int(request.form.get('take_profit_low'))
             take_profit_high = int(request.form.get('take_profit_high'))
           
-            # Database contains tests, so check if the test_name is unique
-            if data_import_check == False:
-                conn = backtester.db_connect()
-                cur = conn.cursor()
-                # Make sure the Test_Name is unique.
-                cur.execute ('SELECT Test_Name FROM Test_Variable_Range WHERE Test_Name = ?', (test_name,))
-                res = cur.fetchone()
+            # Make sure the Test_Name is unique.
+            if backtester.test_name_exists(test_name):
                 # Test_Name already exits, so ask user to input unique name
-                if res:
-                    flash(f'{test_name} is already in use.  Please enter a unique test name to proceed with testing.', category='error')
-                    return render_template("run_tests.html")
+                flash(f'{test_name} is already in use.  Please enter a unique test name to proceed with testing.', category='error')
+                return render_template("run_tests.html")
 
-            # Load raw data only once before running tests
-            instrument_period_dict, test_variable_range_id = backtester.create_db(test_name, fast_ma_low, fast_ma_high,  
-                slow_ma_low, slow_ma_high, stop_loss_low, stop_loss_high, take_profit_low, take_profit_high)
+            # Create the test and run every set of variables on a pool of workers
+            summary = runner.run_grid(test_name, fast_ma_low, fast_ma_high, slow_ma_low, slow_ma_high, 
+                stop_loss_low, stop_loss_high, take_profit_low, take_profit_high, 
+                profile=bool(request.form.get('profile')))
             
-            session['test_variable_range_id'] = test_variable_range_id
-            
-            # Created nested list of variable sets
-            variable_list, no_of_tests = backtester.cartesian_product(fast_ma_low, fast_ma_high, 
-                    slow_ma_low, slow_ma_high, stop_loss_low, stop_loss_high, take_profit_low, take_profit_high, 
-                    instrument_period_dict, test_variable_range_id)
-
-            start_tm = datetime.now().replace(microsecond=0)
-
-            # Use all physical CPU cores to run the tests quickly
-            pool = psutil.cpu_count(logical=False)
-            pool = mp.Pool(pool)
-            
-            # Start multiprocessing.  Each worker will run a test with a list of variables
-            pool.map_async(backtester.run_test, variable_list).get()
+            session['test_variable_range_id'] = summary['test_variable_range_id']
             session['saved_results_exist'] = True
-            
-            pool = int(psutil.cpu_count(logical = False))
-            end_tm = datetime.now().replace(microsecond=0)
-            time_elapsed = round((end_tm-start_tm).total_seconds())
 
             # We have data, so all links can appear on nav bar
             session['data_exists'] = True
 
-            conn = backtester.db_connect()
-            cur = conn.cursor()
-            # Get number of rows inserted
-            cur.execute (f'''SELECT COUNT(Position_Details_ID) 
-                            FROM Position_Details AS p
-                            JOIN Strategy_Results as S
-                            ON p.Strategy_Results_ID = s.Strategy_Results_ID
-                            WHERE s.Test_Variable_Range_ID = ?''', (session['test_variable_range_id'],))
-            res = list(cur.fetchone()) 
-            no_of_inserts = res[0] + no_of_tests + 2
-            
-            if data_import_check == 'Data Imported':
-                cur.execute ('SELECT COUNT(*) FROM Market_Data')
-                res = list(cur.fetchone()) 
-                no_of_inserts += res[0]
-            
-            if conn:
-                conn.close()
-
             # Flash message about test stats
-            flash(f'{pool} cores completed {no_of_tests:,d} tests and inserted {no_of_inserts:,d} records into the database in {time_elapsed} seconds', category='success')
+            flash(f"{summary['workers']} cores completed {summary['no_of_tests']:,d} tests and inserted {summary['rows_written']:,d} " 
+                f"records into the database in {round(summary['elapsed_seconds'])} seconds", category='success')
+            flash('Seconds across all cores: ' + ', '.join(f'{stage.replace("_", " ")} {secs:,.1f}' 
+                for stage, secs in summary['stage_seconds'].items()), category='success')
+
+            if summary['profile_path']:
+                flash(f"Profile saved to {summary['profile_path']}", category='success')
 
             return redirect(url_for("views.results"))
         
@@ -115,6 +85,211 @@ def run_tests():
     return render_template("run_tests.html")
 
 
+@views.route('/metrics', methods=['GET'])
+def show_metrics():
+    # Serve the counters and stage histograms of the run in progress, or the last run to finish
+    # Prometheus text format by default, JSON with ?format=json
+
+    try:
+        run_metrics = metrics.current_run()
+        if request.args.get('format') == 'json':
+            return jsonify(run_metrics.to_dict() if run_metrics else {})
+        return Response(run_metrics.to_prometheus() if run_metrics else '', mimetype='text/plain')
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return Response('', mimetype='text/plain')
+
+
+@views.route('/leaderboard', methods=['GET'])
+def show_leaderboard():
+    # Serve the best results of the run in progress, or the last run to finish, as JSON
+    # ?metric= one of leaderboard.METRICS (default total_pnl), ?n= number of results (default 50)
+
+    try:
+        run_metrics = metrics.current_run()
+        metric = request.args.get('metric', 'total_pnl')
+        if metric not in leaderboard.METRICS:
+            return jsonify({'error': f"metric must be one of {', '.join(leaderboard.METRICS)}"}), 400
+        n = request.args.get('n', '50')
+        if not n.isdigit() or int(n) < 1:
+            return jsonify({'error': 'n must be a whole number of at least 1'}), 400
+        n = min(int(n), leaderboard.TOP_K)
+        if not run_metrics:
+            return jsonify({})
+
+        stats = run_metrics.progress_stats()
+        return jsonify(dict(stats, running=run_metrics.end_tm is None, metric=metric,
+                            test_variable_range_id=run_metrics.test_variable_range_id,
+                            results=run_metrics.leaderboard.top(metric, n)))
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return jsonify({})
+
+
+def surface_slice(test_variable_range_id):
+    # Read a slice of a test's PnL surface from the query string.  Return (axes, z, args), or None for no test
+    # ?x= and ?y= axes (default fast_ma and slow_ma), ?agg= max, mean or min, and a value for any other axis to fix
+    # Raise ValueError for a bad query string
+
+    axes, pnl_surface = backtester.load_surface(test_variable_range_id)
+    if pnl_surface is None:
+        return None
+    x = request.args.get('x', 'fast_ma')
+    y = request.args.get('y', 'slow_ma')
+    agg = request.args.get('agg', 'max')
+    fixed = {axis: int(request.args[axis]) for axis in surface.AXES if axis not in (x, y) and axis in request.args}
+    z = surface.slice_surface(axes, pnl_surface, x, y, fixed, agg)
+    return axes, z, dict(x=x, y=y, agg=agg, fixed=fixed)
+
+
+@views.route('/surface/<int:test_variable_range_id>', methods=['GET'])
+def show_surface(test_variable_range_id):
+    # Serve a 2-D slice of a test's PnL surface as JSON, z[y][x] with null where there is no result
+    # Stop losses and take profits are whole percents
+
+    try:
+        res = surface_slice(test_variable_range_id)
+        if res is None:
+            return jsonify({'error': 'No such test'}), 404
+        axes, z, args = res
+        return jsonify(dict(args, test_variable_range_id=test_variable_range_id, 
+                            x_values=axes[args['x']], y_values=axes[args['y']], z=z))
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return jsonify({})
+
+
+@views.route('/surface/<int:test_variable_range_id>/heatmap', methods=['GET'])
+def show_heatmap(test_variable_range_id):
+    # Show a slice of a test's PnL surface as a heatmap.  Takes the same query string as /surface
+
+    try:
+        res = surface_slice(test_variable_range_id)
+        if res is None:
+            return Response('No such test', status=404, mimetype='text/plain')
+        axes, z, args = res
+        fixed = ', '.join(f'{axis} {value}' for axis, value in args['fixed'].items())
+        title = f"{args['agg']} Total PNL" + (f' at {fixed}' if fixed else '')
+        return Response(backtester.plot_surface(axes, z, args['x'], args['y'], title), mimetype='text/html')
+
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return Response('', mimetype='text/plain')
+
+
+@views.route('/export/<int:test_variable_range_id>/<table>', methods=['GET'])
+def export_results(test_variable_range_id, table):
+    # Stream every row of a test's strategy_results or position_details table as a download
+    # ?format= csv (default) or parquet
+
+    try:
+        fmt = request.args.get('format', 'csv')
+        test_name = backtester.get_test_name(test_variable_range_id)
+        if test_name is None:
+            return Response('No such test', status=404, mimetype='text/plain')
+        chunks = export.iter_export(test_variable_range_id, table, fmt)
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/vnd.apache.parquet'
+        return Response(chunks, mimetype=mimetype, headers={'Content-Disposition': 
+            export.content_disposition(test_variable_range_id, test_name, table, fmt)})
+
+    except (ValueError, ImportError) as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return Response('', mimetype='text/plain')
+
+
+def portfolio_args():
+    # Run the portfolio given by the query string: ?strategies=<test id>:<strategy id>,... and optionally
+    # ?allocation= equal or inverse_volatility, ?weights= comma separated shares of the capital, and ?capital=
+    # Raise ValueError for a bad query string
+
+    strategy_ids = portfolio.parse_strategies(request.args.get('strategies', ''))
+    weights = [float(x) for x in request.args['weights'].split(',')] if request.args.get('weights') else None
+    return portfolio.simulate(strategy_ids, request.args.get('allocation', 'equal'), weights, 
+                              float(request.args.get('capital', portfolio.CAPITAL)))
+
+
+@views.route('/portfolio', methods=['GET'])
+def show_portfolio():
+    # Serve a portfolio of stored strategies as JSON: its equity and drawdown at every candle of their instruments,
+    # and the correlation of the strategies' candle PnLs
+
+    try:
+        summary = portfolio_args()
+        if not summary:
+            return jsonify({'error': 'The portfolio failed, see the exception log for details'}), 500
+        return jsonify(summary)
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return jsonify({})
+
+
+@views.route('/portfolio/chart', methods=['GET'])
+def show_portfolio_chart():
+    # Chart a portfolio's equity and drawdown.  Takes the same query string as /portfolio
+
+    try:
+        summary = portfolio_args()
+        if not summary:
+            return Response('The portfolio failed, see the exception log for details', status=500, 
+                            mimetype='text/plain')
+        return Response(backtester.plot_portfolio(summary), mimetype='text/html')
+
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+
+    except BaseException:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
+        backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
+
+    return Response('', mimetype='text/plain')
+
+
+def cached_results(name, *params):
+    # Results of the session's test from the result cache, so moving between pages doesn't query them again
+    # name is one of the retrieve functions of backtester.py
+
+    loader = {'top_strats': backtester.retrieve_top_strats, 
+              'top_group_strats': backtester.retrieve_top_group_strats,
+              'group_details': backtester.retrieve_group_details,
+              'pruned': backtester.count_pruned}[name]
+    return result_cache.cache.get(session['test_variable_range_id'], name, loader, *params)
+
+
 @views.route('/results/', methods=['GET', 'POST'])
 def results():
     # Show results of test in desc order.  Select chart to open in new browser window
@@ -122,26 +297,24 @@ def results():
     try:
         session['data_exists'] = True
         # Display individual results
+        # Results are kept in the result cache, not the session cookie, which older versions filled with them
+        session.pop('top_results', None)
+        session.pop('top_group_results', None)
         if request.method == 'GET':
-            top_results = backtester.retrieve_top_strats(session['test_variable_range_id'])
-            session['top_results'] = top_results
-
-            #Preload group data in case of test rerunning tests and nav clicking around
-            top_group_results = backtester.retrieve_top_group_strats(session['test_variable_range_id'])
-            session['top_group_results'] = top_group_results   
-            return render_template("results.html", top_results=top_results)
+            top_results = cached_results('top_strats')
+            return render_template("results.html", top_results=top_results, pruned=cached_results('pruned'),
+                                   test_variable_range_id=session['test_variable_range_id'])
     
         elif request.method == 'POST':
             # Display group results
             if 'group_results' in request.form:
-                top_group_results = backtester.retrieve_top_group_strats(session['test_variable_range_id'])
-                session['top_group_results'] = top_group_results
+                top_group_results = cached_results('top_group_strats')
                 return render_template("group_results.html", top_group_results=top_group_results)
 
             # View Chart by creating and opening html chart on HD
             elif 'strat_res_id' in request.form:
-                backtester.plot_chart(request.form.get('strat_res_id'))
-                url = os.getcwd() + '\\web\\templates\\ohcl_chart.html'
+                backtester.plot_chart(session['test_variable_range_id'], request.form.get('strat_res_id'))
+                url = pathlib.Path(config.settings.chart_path).as_uri()
                 webbrowser.open(url)
 
     except BaseException:
@@ -149,7 +322,8 @@ def results():
         f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
         backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
                
-    return render_template("results.html", top_results= session['top_results'])
+    return render_template("results.html", top_results=cached_results('top_strats'), pruned=cached_results('pruned'),
+                           test_variable_range_id=session.get('test_variable_range_id'))
 
 
 @views.route('/group_results', methods=['GET', 'POST'])
@@ -168,50 +342,28 @@ def group_results():
         f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
         backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
 
-    return render_template("group_results.html", top_group_results=session['top_group_results'])
+    return render_template("group_results.html", top_group_results=cached_results('top_group_strats'))
 
 
 @views.route('/group_details', methods=['GET', 'POST'])
 def group_details():
 
     try:
+        group_details = []
         # Get the MAs for the group, adjust idx to python's start at 0
         idx = int(session['idx']) - 1
-        fast_ma = session['top_group_results'][idx]['fast_ma']
-        slow_ma = session['top_group_results'][idx]['slow_ma']
+        top_group_results = cached_results('top_group_strats')
+        fast_ma = top_group_results[idx]['fast_ma']
+        slow_ma = top_group_results[idx]['slow_ma']
 
         # Retrieve all results for the top group performers
-        conn = backtester.db_connect()
-        cur = conn.cursor()
-        cur.execute(f''' SELECT *
-                        FROM Strategy_Results
-                        WHERE Test_Variable_Range_ID = ? AND
-                            Fast_MA = ? AND Slow_MA = ?
-                        ORDER BY Total_PNL DESC''', 
-                        (session['test_variable_range_id'], fast_ma, slow_ma))
-            
-        # Map column names to field values in nested dictionary
-        rec_list = list(cur.fetchall())       
-        col = [desc[0].lower() for desc in cur.description]
-        group_details = []
-
-        # Change float from 0.05 to 5%
-        rec_list = [list(t) for t in rec_list]
-        for x in range(len(rec_list)):
-            rec_list[x][4] = str( round(rec_list[x][4]*100, 1)) + '%'
-            rec_list[x][5] = str( round(rec_list[x][5]*100, 1)) + '%'
-            rec_list[x][6] = str( round(rec_list[x][6]*100, 1)) + '%'
-
-        # Create a  strategy results dictionary
-        for row in rec_list:
-            dic = dict(zip(col, row))
-            group_details.append(dic)
+        group_details = cached_results('group_details', fast_ma, slow_ma)
         
         if request.method == 'POST':
         # View Chart by creating and opening html chart on HD
             if 'strat_res_id' in request.form:
-                backtester.plot_chart(request.form.get('strat_res_id'))
-                url = os.getcwd() + '\\web\\templates\\ohcl_chart.html'
+                backtester.plot_chart(session['test_variable_range_id'], request.form.get('strat_res_id'))
+                url = pathlib.Path(config.settings.chart_path).as_uri()
                 webbrowser.open(url)
     
     except BaseException:
@@ -229,12 +381,21 @@ def saved_results():
     try:
         conn = backtester.db_connect()
         cur = conn.cursor()
-        cur.execute ('SELECT * FROM Test_Variable_Range')
+        backtester.create_tables(cur)
+        # Tests run before runs were recorded have no Test_Run row and are shown as complete
+        cur.execute ('''SELECT tvr.*, tr.Status, tr.No_Of_Tests
+                        FROM Test_Variable_Range tvr
+                            LEFT JOIN Test_Run tr ON tr.Test_Variable_Range_ID = tvr.Test_Variable_Range_ID''')
         res = cur.fetchall()
         col = [desc[0].lower() for desc in cur.description]
+        if conn:
+            conn.close()
         test_name = []
         for row in res:
             dic = dict(zip(col, row))
+            # Only the database files of unfinished tests are opened, to count their tests
+            if dic['status'] == 'running':
+                dic['tests_completed'] = backtester.tests_completed(dic['test_variable_range_id'])
             test_name.append(dic)
 
         # Redirect to the saved results of a previous test
@@ -243,9 +404,51 @@ def saved_results():
                 session['test_variable_range_id'] = request.form.get('test_variable_range_id')
                 return redirect(url_for("views.results"))
 
+            # Run the chunks of an interrupted test that aren't in the database yet
+            elif 'resume_test_name' in request.form:
+                summary = runner.resume_run(request.form.get('resume_test_name'))
+                if not summary:
+                    flash('The test could not be resumed, see the exception log for details.', category='error')
+                    return redirect(url_for("views.saved_results"))
+
+                session['test_variable_range_id'] = summary['test_variable_range_id']
+                session['data_exists'] = True
+                flash(f"{summary['workers']} cores completed the remaining {summary['tests_completed']:,d} of "
+                    f"{summary['no_of_tests']:,d} tests in {round(summary['elapsed_seconds'])} seconds", category='success')
+                return redirect(url_for("views.results"))
+
+            # Delete a test, or move its database file to the archive folder
+            elif 'delete_test_variable_range_id' in request.form or 'archive_test_variable_range_id' in request.form:
+                archive = 'archive_test_variable_range_id' in request.form
+                test_variable_range_id = int(request.form.get('archive_test_variable_range_id' if archive 
+                                                              else 'delete_test_variable_range_id'))
+                run_metrics = metrics.current_run()
+                if run_metrics and run_metrics.end_tm is None and \
+                    run_metrics.test_variable_range_id == test_variable_range_id:
+                    flash('The test is still running.', category='error')
+                    return redirect(url_for("views.saved_results"))
+
+                result_cache.cache.invalidate(test_variable_range_id)
+                if archive:
+                    archive_path = backtester.archive_test(test_variable_range_id)
+                    if archive_path:
+                        flash(f'The test was archived to {archive_path}', category='success')
+                    else:
+                        flash('The test could not be archived, see the exception log for details.', category='error')
+                else:
+                    if backtester.delete_test(test_variable_range_id):
+                        flash('The test was deleted.', category='success')
+                    else:
+                        flash('The test could not be deleted, see the exception log for details.', category='error')
+
+                if str(session.get('test_variable_range_id')) == str(test_variable_range_id):
+                    session.pop('test_variable_range_id', None)
+                    session.pop('data_exists', None)
+                return redirect(url_for("views.saved_results"))
+
     except BaseException:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         f_path, f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)
         backtester.log_exceptions(f_path, f_name, exc_type, exc_obj, exc_tb.tb_lineno)
     
-    return render_template("saved_results.html", test_name=test_name)
\ No newline at end of file
+    return render_template("saved_results.html", test_name=test_name)
\ No newline at end of file